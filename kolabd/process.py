@@ -27,6 +27,9 @@ from pykolab.translate import _
 log = pykolab.getLogger('pykolab.daemon')
 conf = pykolab.getConf()
 
+# The longest to wait in between attempts to reconnect to LDAP, in seconds.
+max_retry_interval = 60
+
 
 class KolabdProcess(multiprocessing.Process):
     def __init__(self, domain):
@@ -48,16 +51,47 @@ class KolabdProcess(multiprocessing.Process):
         else:
             sync_interval = (int)(sync_interval)
 
+        # Follow the changes as they happen, for as long as the LDAP server
+        # supports it. Only otherwise poll every sync_interval.
+        persistent = True
+        retry_interval = 1
+
         while True:
+            started = time.time()
+
             try:
                 auth = Auth(domain)
                 auth.connect(domain)
-                auth.synchronize()
-                time.sleep(sync_interval)
+
+                if persistent and auth.synchronize(persistent=True):
+                    log.warning(
+                        _("Lost track of changes for domain %s, reconnecting") % (domain)
+                    )
+                else:
+                    if persistent:
+                        log.info(
+                            _("Changes for domain %s cannot be followed, polling instead") % (
+                                domain
+                            )
+                        )
+
+                        persistent = False
+
+                    auth.synchronize()
+                    time.sleep(sync_interval)
+                    continue
+
             except KeyboardInterrupt:
                 break
             except Exception as errmsg:
                 log.error(_("Error in process %r, terminating:\n\t%r") % (self.name, errmsg))
                 import traceback
                 traceback.print_exc()
-                time.sleep(1)
+
+            # Back off while reconnecting fails over and over again.
+            if time.time() - started > max_retry_interval:
+                retry_interval = 1
+            else:
+                retry_interval = min(retry_interval * 2, max_retry_interval)
+
+            time.sleep(retry_interval)
@@ -36,13 +36,17 @@ class Auth(Base):
         This is the Authentication and Authorization module for PyKolab.
     """
 
-    def __init__(self, domain=None):
+    def __init__(self, domain=None, keepalive=False):
         """
             Initialize the authentication class.
+
+            With keepalive, the backend connection is retained after an
+            authentication attempt, so that it may be re-used for the next.
         """
         Base.__init__(self, domain=domain)
 
         self._auth = None
+        self.keepalive = keepalive
 
     def authenticate(self, login):
         """
@@ -165,6 +169,7 @@ class Auth(Base):
             from pykolab.auth.ldap import LDAP
             self._auth = LDAP(self.domain)
 
+        self._auth.keepalive = self.keepalive
         self._auth.connect()
 
     def disconnect(self, domain=None):
@@ -284,8 +289,8 @@ class Auth(Base):
 
         return self.domains
 
-    def synchronize(self, mode=0, callback=None):
-        self._auth.synchronize(mode=mode, callback=callback)
+    def synchronize(self, mode=0, callback=None, persistent=False):
+        return self._auth.synchronize(mode=mode, callback=callback, persistent=persistent)
 
     def domain_default_quota(self, domain):
         return self._auth._domain_default_quota(domain)
@@ -20,6 +20,7 @@
 from __future__ import print_function
 
 import datetime
+from collections import OrderedDict
 # Catch python-ldap-2.4 changes
 from distutils import version
 import logging
@@ -50,6 +51,10 @@ from pykolab.translate import _ as _l
 
 import auth_cache
 import cache
+import connection_pool
+import entry_cache
+import entry_filter
+import verdict_cache
 
 # pylint: disable=invalid-name
 log = pykolab.getLogger('pykolab.auth')
@@ -73,16 +78,66 @@ class LDAP(Base):
         self.ldap_priv = None
         self.bind = None
 
+        # Retain the connection in between authentication attempts.
+        self.keepalive = False
+
+        # Whether the last authentication attempt concluded with a verdict.
+        self._concluded = False
+
+        # Whether the last bind failed because the LDAP server was unavailable.
+        self._server_down = False
+
+        # The modifications held back until the synchronization is done with
+        # an entry, by the entry's (lower-case) DN.
+        self._modifications = {}
+
+        # The modifications sent but not yet completed, as (message ID, DN,
+        # modlist), and how many there may be.
+        self._pipelined = []
+        self._pipeline_depth = None
+
         if domain is None:
             self.domain = conf.get('kolab', 'primary_domain')
         else:
             self.domain = domain
 
+    def authenticate(self, login, realm):
+        """
+            Authenticate the login, consulting the verdict cache first.
+        """
+        verdict = verdict_cache.get_verdict(login, realm)
+
+        if verdict is not None:
+            try:
+                log.debug(
+                    _l("Using cached verdict %r for user %s in realm %s") % (
+                        verdict,
+                        login[0],
+                        realm
+                    ),
+                    level=8
+                )
+
+            except Exception:
+                pass
+
+            return verdict
+
+        self._concluded = False
+
+        retval = self._authenticate(login, realm)
+
+        # Only cache verdicts, not failures to reach a verdict.
+        if self._concluded:
+            verdict_cache.set_verdict(login, realm, retval)
+
+        return retval
+
     # pylint: disable=too-many-branches
     # pylint: disable=too-many-locals
     # pylint: disable=too-many-return-statements
     # pylint: disable=too-many-statements
-    def authenticate(self, login, realm):
+    def _authenticate(self, login, realm):
         """
             Find the entry corresponding to login, and attempt a bind.
 
@@ -246,7 +301,7 @@ class LDAP(Base):
                 except Exception:
                     pass
 
-                self._disconnect()
+                self._release()
                 return False
 
             else:
@@ -260,7 +315,7 @@ class LDAP(Base):
                 except Exception:
                     pass
 
-                self._disconnect()
+                self._release()
                 return False
 
             if entry_dn is None:
@@ -274,7 +329,7 @@ class LDAP(Base):
                 except Exception:
                     pass
 
-                self._disconnect()
+                self._release()
                 return False
 
             try:
@@ -293,6 +348,12 @@ class LDAP(Base):
                     except Exception:
                         pass
 
+                elif self._server_down:
+                    log.error(_l("Authentication failed, LDAP server unavailable"))
+                    self._disconnect()
+
+                    return False
+
                 else:
                     try:
                         log.info(
@@ -304,7 +365,7 @@ class LDAP(Base):
                     except Exception:
                         pass
 
-                    self._disconnect()
+                    self._release()
                     return False
 
                 try:
@@ -341,6 +402,13 @@ class LDAP(Base):
 
                 if retval:
                     log.info(_l("Authentication for %r succeeded") % (login[0]))
+
+                elif self._server_down:
+                    log.error(_l("Authentication failed, LDAP server unavailable"))
+                    self._disconnect()
+
+                    return False
+
                 else:
                     log.info(
                         _l("Authentication for %r failed (password)") % (
@@ -348,7 +416,7 @@ class LDAP(Base):
                         )
                     )
 
-                    self._disconnect()
+                    self._release()
                     return False
 
             except ldap.NO_SUCH_OBJECT as errmsg:
@@ -367,7 +435,7 @@ class LDAP(Base):
                 except Exception:
                     log.error(_l("Authentication cache failed to clear entry"))
 
-                retval = self.authenticate(login, realm)
+                return self._authenticate(login, realm)
 
             except Exception as errmsg:
                 log.debug(_l("Exception occured: %r") % (errmsg))
@@ -386,7 +454,7 @@ class LDAP(Base):
                 self._disconnect()
                 return False
 
-        self._disconnect()
+        self._release()
 
         return retval
 
@@ -408,6 +476,13 @@ class LDAP(Base):
 
         log.debug(_l("Attempting to use LDAP URI %s") % (uri), level=8)
 
+        # Hold off after failing to reach the server
+        wait = connection_pool.backoff(uri)
+
+        if wait > 0 and not immediate:
+            log.debug(_l("Waiting %.1fs to connect to %s") % (wait, uri), level=8)
+            time.sleep(wait)
+
         trace_level = 0
 
         if conf.debuglevel > 8:
@@ -458,6 +533,13 @@ class LDAP(Base):
         if self._entry_dict(entry_id):
             return entry_id['dn']
 
+        uri = self.config_get('ldap_uri')
+
+        entry_dn = entry_cache.get_dn(uri, entry_id)
+
+        if entry_dn is not None:
+            return entry_dn
+
         unique_attribute = self.config_get('unique_attribute')
         config_base_dn = self.config_get('base_dn')
         ldap_base_dn = self._kolab_domain_root_dn(self.domain)
@@ -486,6 +568,8 @@ class LDAP(Base):
         if len(_result_data) >= 1:
             (entry_dn, _) = _result_data[0]
 
+            entry_cache.set_dn(uri, entry_id, entry_dn)
+
         return entry_dn
 
     def get_entry_attribute(self, entry_id, attribute):
@@ -497,6 +581,9 @@ class LDAP(Base):
 
         entry_attrs = self.get_entry_attributes(entry_id, [attribute])
 
+        if entry_attrs is None:
+            return None
+
         if attribute in entry_attrs:
             return entry_attrs[attribute]
 
@@ -516,35 +603,75 @@ class LDAP(Base):
         entry_dn = self.entry_dn(entry_id)
         log.debug(_l("Entry DN: %r") % (entry_dn), level=8)
 
-        log.debug(
-            _l("ldap search: (%r, %r, filterstr='(objectclass=*)', attrlist=[ 'dn' ] + %r") % (
+        if entry_dn is None:
+            return None
+
+        uri = self.config_get('ldap_uri')
+
+        _entry_dn = entry_dn
+        _entry_attrs = entry_cache.get_attributes(uri, entry_dn, attributes)
+
+        if _entry_attrs is None:
+            # Fetch everything else there is about the entry while at it, for
+            # the next time.
+            if entry_cache.enabled() and '*' not in attributes:
+                attrlist = ['*'] + attributes
+            else:
+                attrlist = attributes
+
+            log.debug(
+                _l("ldap search: (%r, %r, filterstr='(objectclass=*)', attrlist=[ 'dn' ] + %r") % (
+                    entry_dn,
+                    ldap.SCOPE_BASE,
+                    attrlist
+                ),
+                level=8
+            )
+
+            _search = self.ldap.search_ext(
                 entry_dn,
                 ldap.SCOPE_BASE,
-                attributes
-            ),
-            level=8
-        )
+                filterstr='(objectclass=*)',
+                attrlist=['dn'] + attrlist
+            )
 
-        _search = self.ldap.search_ext(
-            entry_dn,
-            ldap.SCOPE_BASE,
-            filterstr='(objectclass=*)',
-            attrlist=['dn'] + attributes
-        )
+            (
+                _result_type,
+                _result_data,
+                _result_msgid,
+                _result_controls
+            ) = self.ldap.result3(_search)
 
-        (
-            _result_type,
-            _result_data,
-            _result_msgid,
-            _result_controls
-        ) = self.ldap.result3(_search)
+            if len(_result_data) >= 1:
+                (_entry_dn, _entry_attrs) = _result_data[0]
+            else:
+                return None
 
-        if len(_result_data) >= 1:
-            (_entry_dn, _entry_attrs) = _result_data[0]
-        else:
-            return None
+            entry_cache.set_attributes(uri, _entry_dn, attrlist, _entry_attrs)
+
+            if not attrlist == attributes:
+                names = [x.lower() for x in attributes]
+
+                _entry_attrs = dict(
+                    [(x, y) for (x, y) in _entry_attrs.items() if x.lower() in names]
+                )
+
+        _entry_attrs = utils.normalize(_entry_attrs)
+
+        # Modifications not yet written are what the entry is to look like.
+        buffered = self._modifications.get(_entry_dn.lower())
+
+        if buffered is not None:
+            for attribute, value in buffered['changes'].items():
+                if attribute not in [x.lower() for x in attributes] and '*' not in attributes:
+                    continue
 
-        return utils.normalize(_entry_attrs)
+                if value is None:
+                    _entry_attrs.pop(attribute, None)
+                else:
+                    _entry_attrs[attribute] = value
+
+        return _entry_attrs
 
     def list_recipient_addresses(self, entry_id):
         """
@@ -856,6 +983,10 @@ class LDAP(Base):
 
             return entry_modifications
 
+        # Addresses assigned to other entries must have been written before
+        # looking for them.
+        self._complete_modifications(mail_attributes)
+
         want_attrs = []
 
         log.debug(_l("Applying recipient policy to %r") % (entry_dn), level=8)
@@ -1210,6 +1341,12 @@ class LDAP(Base):
 
     def reconnect(self):
         bind = self.bind
+
+        # The connections may well be broken, so keep them out of the pool.
+        for conn in [self.ldap, self.ldap_priv]:
+            if conn is not None:
+                connection_pool.forget(conn)
+
         self._disconnect()
         self.connect()
         if bind is not None:
@@ -1255,6 +1392,17 @@ class LDAP(Base):
 
         entry_dn = self.entry_dn(entry_id)
 
+        buffered = None
+
+        if entry_dn is not None:
+            buffered = self._modifications.get(entry_dn.lower())
+
+        if buffered is not None:
+            for attribute, value in attributes.items():
+                buffered['changes'][attribute.lower()] = value
+
+            return
+
         entry = self.get_entry_attributes(entry_dn, ['*'])
 
         attrs = {}
@@ -1276,30 +1424,204 @@ class LDAP(Base):
                 else:
                     modlist.append((ldap.MOD_REPLACE, attribute, value))
 
-        dn = entry_dn
+        self._modify(entry_dn, modlist)
 
-        if modlist and self._bind_priv() is True:
-            try:
+    def _buffer_modifications(self, entry_dn, entry_attrs):
+        """
+            Hold back the modifications to an entry until
+            _flush_modifications(), so that they are written all at once.
+
+            The entry_attrs are the entry's attributes as fetched with '*',
+            and the modifications are computed against them, rather than
+            against the entry as fetched again.
+        """
+        attrs = {}
+
+        for attribute, value in entry_attrs.items():
+            if isinstance(value, list):
+                attrs[attribute.lower()] = value
+            else:
+                attrs[attribute.lower()] = [value]
+
+        self._modifications[entry_dn.lower()] = {
+            'dn': entry_dn,
+            'attrs': attrs,
+            'changes': OrderedDict()
+        }
+
+    def _flush_modifications(self, pipeline=False):
+        """
+            Write the modifications held back, with a single modify per entry
+            for those attributes that change.
+
+            With pipeline, up to [ldap] modify_pipeline_depth modifications
+            are left to complete while the synchronization moves on.
+        """
+        modifications = self._modifications
+        self._modifications = {}
+
+        for buffered in modifications.values():
+            modlist = []
+
+            for attribute, value in buffered['changes'].items():
+                current = buffered['attrs'].get(attribute)
+
+                if not current:
+                    if value is not None:
+                        modlist.append((ldap.MOD_ADD, attribute, value))
+
+                elif value is None:
+                    modlist.append((ldap.MOD_DELETE, attribute, current))
+
+                else:
+                    if not isinstance(value, list):
+                        value = [value]
+
+                    if not sorted(["%s" % (x) for x in value]) == sorted(current):
+                        modlist.append((ldap.MOD_REPLACE, attribute, value))
+
+            self._modify(buffered['dn'], modlist, pipeline=pipeline)
+
+    def _modify(self, dn, modlist, pipeline=False):
+        if not modlist or not self._bind_priv() is True:
+            return
+
+        if self._pipeline_depth is None:
+            self._pipeline_depth = int(conf.get('ldap', 'modify_pipeline_depth'))
+
+        depth = 0
+
+        if pipeline:
+            depth = self._pipeline_depth
+
+        try:
+            if depth > 0:
+                msgid = self.ldap_priv.modify_ext(dn, modlist)
+                self._pipelined.append((msgid, dn, modlist))
+            else:
                 self.ldap_priv.modify_s(dn, modlist)
-            except Exception as errmsg:
-                log.error(
-                    _l("Could not update dn:\nDN: %r\nModlist: %r\nError Message: %r") % (
-                        dn,
-                        modlist,
-                        errmsg
-                    )
+
+        except Exception as errmsg:
+            log.error(
+                _l("Could not update dn:\nDN: %r\nModlist: %r\nError Message: %r") % (
+                    dn,
+                    modlist,
+                    errmsg
                 )
+            )
 
-                log.error(traceback.format_exc())
+            log.error(traceback.format_exc())
+
+        entry_cache.invalidate(self.config_get('ldap_uri'), dn)
 
-    def synchronize(self, mode=0, callback=None):
+        while len(self._pipelined) > depth:
+            self._complete_modification()
+
+    def _complete_modifications(self, attributes=None):
+        """
+            Wait for the modifications sent before to complete, or only for
+            those modifying any of the attributes.
+        """
+        if attributes is None:
+            pending = len(self._pipelined)
+        else:
+            attributes = [x.lower() for x in attributes]
+            pending = 0
+
+            for (index, (msgid, dn, modlist)) in enumerate(self._pipelined):
+                if [x for x in modlist if x[1] in attributes]:
+                    pending = index + 1
+
+        for _ in range(pending):
+            self._complete_modification()
+
+    def _complete_modification(self):
+        (msgid, dn, modlist) = self._pipelined.pop(0)
+
+        try:
+            self.ldap_priv.result(msgid)
+        except Exception as errmsg:
+            log.error(
+                _l("Could not update dn:\nDN: %r\nModlist: %r\nError Message: %r") % (
+                    dn,
+                    modlist,
+                    errmsg
+                )
+            )
+
+        # The entry may have been fetched again before the modification
+        # completed.
+        entry_cache.invalidate(self.config_get('ldap_uri'), dn, signal=False)
+
+    def synchronize(self, mode=0, callback=None, persistent=False):
         """
             Synchronize with LDAP
+
+            With persistent, the changes are followed for as long as the
+            connection lasts, using syncrepl or, failing that, persistent
+            search. Returns False if neither control is supported.
         """
         self._bind()
 
+        if mode != 0:
+            override_search = mode
+        elif persistent:
+            override_search = self._persistent_control()
+
+            if override_search is None:
+                return False
+        else:
+            override_search = self._batch_control()
+
+        config_base_dn = self.config_get('base_dn')
+        ldap_base_dn = self._kolab_domain_root_dn(self.domain)
+
+        if ldap_base_dn is not None and not ldap_base_dn == config_base_dn:
+            base_dn = ldap_base_dn
+        else:
+            base_dn = config_base_dn
+
+        if callback is None:
+            callback = self._synchronize_callback
+
+        attrlist = [
+            '*',
+            self.config_get('unique_attribute'),
+            conf.get('cyrus-sasl', 'result_attribute'),
+            'modifytimestamp'
+        ]
+
         _filter = self._kolab_filter()
 
+        if persistent:
+            log.info(
+                _l("Following changes below %s using %s") % (base_dn, override_search)
+            )
+
+            if override_search == '_sync_repl':
+                # The syncrepl cookie tells the server where we left off.
+                self._sync_repl(
+                    base_dn,
+                    filterstr=_filter,
+                    attrlist=attrlist,
+                    callback=callback
+                )
+
+            else:
+                # Persistent search has no such thing, so catch up on what
+                # changed in the meanwhile once the search is registered with
+                # the server, and changes are no longer missed.
+                self._persistent_search(
+                    base_dn,
+                    filterstr=_filter,
+                    attrlist=attrlist,
+                    callback=callback,
+                    changes_only=True,
+                    started=lambda: self.synchronize(callback=callback)
+                )
+
+            return True
+
         modified_after = None
 
         if hasattr(conf, 'resync'):
@@ -1323,34 +1645,13 @@ class LDAP(Base):
 
         log.debug(_l("Synchronization is using filter %r") % (_filter), level=8)
 
-        if mode != 0:
-            override_search = mode
-        else:
-            override_search = False
-
-        config_base_dn = self.config_get('base_dn')
-        ldap_base_dn = self._kolab_domain_root_dn(self.domain)
-
-        if ldap_base_dn is not None and not ldap_base_dn == config_base_dn:
-            base_dn = ldap_base_dn
-        else:
-            base_dn = config_base_dn
-
         log.debug(_l("Synchronization is searching against base DN: %s") % (base_dn), level=8)
 
-        if callback is None:
-            callback = self._synchronize_callback
-
         try:
             self._search(
                 base_dn,
                 filterstr=_filter,
-                attrlist=[
-                    '*',
-                    self.config_get('unique_attribute'),
-                    conf.get('cyrus-sasl', 'result_attribute'),
-                    'modifytimestamp'
-                ],
+                attrlist=attrlist,
                 override_search=override_search,
                 callback=callback,
             )
@@ -1358,6 +1659,8 @@ class LDAP(Base):
             log.error("An error occurred: %r" % (errmsg))
             log.error(_l("%s") % (traceback.format_exc()))
 
+        self._complete_modifications()
+
     def user_quota(self, entry_id, folder):
         default_quota = self.config_get('default_quota')
         quota_attribute = self.config_get('quota_attribute')
@@ -1446,7 +1749,19 @@ class LDAP(Base):
         # If we have no LDAP, we have no previous state.
         if self.ldap is None:
             self.bind = None
-            self.connect()
+
+            # Use a connection bound as the service account before
+            if bind_dn is None:
+                uri = self.config_get('ldap_uri')
+                service_bind_dn = self.config_get('service_bind_dn')
+
+                self.ldap = connection_pool.lease(self, uri, service_bind_dn)
+
+                if self.ldap is not None:
+                    self.bind = {'dn': service_bind_dn, 'pw': self.config_get('service_bind_pw')}
+
+            if self.ldap is None:
+                self.connect()
 
         # If the bind_dn is None and the bind_pw is not... fail
         if bind_dn is None and bind_pw is not None:
@@ -1481,18 +1796,34 @@ class LDAP(Base):
                 level=8
             )
 
+            uri = self.config_get('ldap_uri')
+
+            # The connection is no longer bound as what it was leased as
+            connection_pool.forget(self.ldap)
+
+            self._server_down = False
+
             # TODO: Binding errors control
             try:
                 # Must be synchronous
                 self.ldap.simple_bind_s(bind_dn, bind_pw)
                 self.bind = {'dn': bind_dn, 'pw': bind_pw}
 
+                connection_pool.succeeded(uri)
+
+                if bind_dn == self.config_get('service_bind_dn'):
+                    connection_pool.register(self, uri, bind_dn, self.ldap)
+
                 return True
 
             except ldap.SERVER_DOWN as errmsg:
                 log.error(_l("LDAP server unavailable: %r") % (errmsg))
                 log.error(_l("%s") % (traceback.format_exc()))
 
+                connection_pool.failed(uri)
+
+                self._server_down = True
+
                 return False
 
             except ldap.NO_SUCH_OBJECT:
@@ -1520,17 +1851,26 @@ class LDAP(Base):
 
     def _bind_priv(self):
         if self.ldap_priv is None:
-            self.connect(True)
-
+            uri = self.config_get('ldap_uri')
             bind_dn = self.config_get('bind_dn')
             bind_pw = self.config_get('bind_pw')
 
+            self.ldap_priv = connection_pool.lease(self, uri, bind_dn)
+
+            if self.ldap_priv is not None:
+                return True
+
+            self.connect(True)
+
             try:
                 self.ldap_priv.simple_bind_s(bind_dn, bind_pw)
+                connection_pool.succeeded(uri)
+                connection_pool.register(self, uri, bind_dn, self.ldap_priv)
                 return True
             except ldap.SERVER_DOWN as errmsg:
                 log.error(_l("LDAP server unavailable: %r") % (errmsg))
                 log.error(_l("%s") % (traceback.format_exc()))
+                connection_pool.failed(uri)
                 return False
             except ldap.INVALID_CREDENTIALS:
                 log.error(
@@ -2332,12 +2672,36 @@ class LDAP(Base):
             )
 
     def _disconnect(self):
+        if self.ldap_priv is not None:
+            self._complete_modifications()
+
+        # Return the connections bound as the service or privileged account
+        # to the pool
+        for conn in [self.ldap, self.ldap_priv]:
+            if conn is not None:
+                connection_pool.release(conn)
+
         del self.ldap
         del self.ldap_priv
         self.ldap = None
         self.ldap_priv = None
         self.bind = None
 
+    def _release(self):
+        """
+            Release the connection after an authentication attempt concluded
+            with a verdict.
+
+            With keepalive, the connection is retained but the bind state is
+            reset, so that the next _bind() binds as the service account again.
+        """
+        self._concluded = True
+
+        if self.keepalive:
+            self.bind = None
+        else:
+            self._disconnect()
+
     def _domain_naming_context(self, domain):
         self._bind()
 
@@ -2414,8 +2778,12 @@ class LDAP(Base):
     def _entry_type(self, entry_id):
         """
             Return the type of object for an entry.
+
+            An entry (dictionary) is classified by the attributes it holds
+            where that is possible, and only otherwise by searching for it.
         """
-        self._bind()
+        if not self._entry_dict(entry_id):
+            self._bind()
 
         entry_dn = self.entry_dn(entry_id)
 
@@ -2433,6 +2801,17 @@ class LDAP(Base):
                 __filter = self.config_get('%s_filter' % (_type))
 
             if __filter is not None:
+                if self._entry_dict(entry_id):
+                    result = entry_filter.match(__filter, entry_id)
+
+                    if result is not None:
+                        if result:
+                            return _type
+
+                        continue
+
+                self._bind()
+
                 try:
                     result = self._regular_search(entry_dn, filterstr=__filter)
                 except Exception:
@@ -2743,31 +3122,46 @@ class LDAP(Base):
 
             log.debug(_l("Entry type: %s") % (entry['type']), level=8)
 
-            if change_dict['change_type'] is None:
-                # This entry was in the start result set
-                eval("self._change_none_%s(entry, change_dict)" % (entry['type']))
+            if isinstance(change_dict['change_type'], int):
+                change = psearch.CHANGE_TYPES_STR[change_dict['change_type']]
+                change = change.lower()
             else:
-                if isinstance(change_dict['change_type'], int):
-                    change = psearch.CHANGE_TYPES_STR[change_dict['change_type']]
-                    change = change.lower()
-                else:
-                    change = change_dict['change_type']
+                change = change_dict['change_type']
 
-                # See if we can find the cache entry - this way we can get to
-                # the value of a (former, on a deleted entry) result_attribute
-                result_attribute = conf.get('cyrus-sasl', 'result_attribute')
-                if result_attribute not in entry:
-                    cache_entry = cache.get_entry(self.domain, entry, update=False)
+            uri = self.config_get('ldap_uri')
+
+            if change in [None, 'add', 'modify']:
+                # Entries in the start result set have not necessarily changed.
+                entry_cache.invalidate(uri, kw['dn'], signal=change is not None)
+                entry_cache.set_attributes(uri, kw['dn'], ['*'], kw['entry'])
+            else:
+                # Entries deleted or renamed may be cached by their unique ID.
+                entry_cache.invalidate(uri)
 
-                    if hasattr(cache_entry, 'result_attribute') and change == 'delete':
-                        entry[result_attribute] = cache_entry.result_attribute
+            self._buffer_modifications(kw['dn'], kw['entry'])
 
-                eval(
-                    "self._change_%s_%s(entry, change_dict)" % (
-                        change,
-                        entry['type']
+            try:
+                if change_dict['change_type'] is None:
+                    # This entry was in the start result set
+                    eval("self._change_none_%s(entry, change_dict)" % (entry['type']))
+                else:
+                    # See if we can find the cache entry - this way we can get to
+                    # the value of a (former, on a deleted entry) result_attribute
+                    result_attribute = conf.get('cyrus-sasl', 'result_attribute')
+                    if result_attribute not in entry:
+                        cache_entry = cache.get_entry(self.domain, entry, update=False)
+
+                        if hasattr(cache_entry, 'result_attribute') and change == 'delete':
+                            entry[result_attribute] = cache_entry.result_attribute
+
+                    eval(
+                        "self._change_%s_%s(entry, change_dict)" % (
+                            change,
+                            entry['type']
+                        )
                     )
-                )
+            finally:
+                self._flush_modifications()
 
         # Typical for Paged Results Control
         elif 'entry' in kw and isinstance(kw['entry'], list):
@@ -2779,9 +3173,9 @@ class LDAP(Base):
                     continue
 
                 entry = {'dn': entry_dn}
-                entry_attrs = utils.normalize(entry_attrs)
-                for attr in entry_attrs:
-                    entry[attr.lower()] = entry_attrs[attr]
+                _entry_attrs = utils.normalize(entry_attrs)
+                for attr in _entry_attrs:
+                    entry[attr.lower()] = _entry_attrs[attr]
 
                 # Ignore nstombstone objects
                 if 'objectclass' in entry:
@@ -2798,7 +3192,19 @@ class LDAP(Base):
 
                 log.debug(_l("Entry type for dn: %s is: %s") % (entry['dn'], entry['type']), level=8)
 
-                eval("self._change_none_%s(entry, None)" % (entry['type']))
+                uri = self.config_get('ldap_uri')
+
+                entry_cache.invalidate(uri, entry_dn, signal=False)
+                entry_cache.set_attributes(uri, entry_dn, ['*'], entry_attrs)
+
+                # Let the writes for one entry go on while the next is being
+                # looked at.
+                self._buffer_modifications(entry_dn, entry_attrs)
+
+                try:
+                    eval("self._change_none_%s(entry, None)" % (entry['type']))
+                finally:
+                    self._flush_modifications(pipeline=True)
 
 #                result_attribute = conf.get('cyrus-sasl', 'result_attribute')
 #
@@ -2834,16 +3240,22 @@ class LDAP(Base):
         timeout=-1,
         callback=False,
         primary_domain=None,
-        secondary_domains=[]
+        secondary_domains=[],
+        changes_only=False,
+        started=None
     ):
 
+        # The search outlives this instance should it be abandoned, so the
+        # connection must not go back to the pool.
+        connection_pool.forget(self.ldap)
+
         psearch_server_controls = []
 
         psearch_server_controls.append(
             ldap.controls.psearch.PersistentSearchControl(
                 criticality=True,
                 changeTypes=['add', 'delete', 'modify', 'modDN'],
-                changesOnly=False,
+                changesOnly=changes_only,
                 returnECs=True
             )
         )
@@ -2858,6 +3270,9 @@ class LDAP(Base):
             serverctrls=psearch_server_controls
         )
 
+        if started is not None:
+            started()
+
         ecnc = psearch.EntryChangeNotificationControl
 
         while True:
@@ -2936,6 +3351,10 @@ class LDAP(Base):
 
         server_page_control = ldap.controls.libldap.SimplePagedResultsControl(size=page_size,cookie='')
 
+        # The search outlives this instance should it be abandoned, so the
+        # connection must not go back to the pool.
+        connection_pool.forget(self.ldap)
+
         _search = self.ldap.search_ext(
             base_dn,
             scope=scope,
@@ -3042,7 +3461,7 @@ class LDAP(Base):
             ldap_url.initializeUrl(),
             trace_level=2,
             trace_file=pykolab.logger.StderrToLogger(log),
-            callback=self._synchronize_callback
+            callback=callback or self._synchronize_callback
         )
 
         bind_dn = self.config_get('bind_dn')
@@ -3064,6 +3483,8 @@ class LDAP(Base):
                 pass
         except KeyboardInterrupt:
             pass
+        finally:
+            ldap_sync_conn.close_db()
 
     def _regular_search(
         self,
@@ -3103,6 +3524,83 @@ class LDAP(Base):
 
         return _results
 
+    def _load_supported_controls(self):
+        """
+            Determine the supported controls, in order of priority, from the
+            configuration or otherwise from the root DSE.
+        """
+        if len(self.ldap.supported_controls) > 0:
+            return
+
+        supported_controls = conf.get_list('ldap', 'supported_controls')
+
+        if supported_controls is not None and not len(supported_controls) < 1:
+            for control_num in [(int)(x) for x in supported_controls]:
+                self.ldap.supported_controls.append(
+                    SUPPORTED_LDAP_CONTROLS[control_num]['func']
+                )
+
+            return
+
+        for control_num in SUPPORTED_LDAP_CONTROLS:
+            log.debug(
+                _l("Checking for support for %s on %s") % (
+                    SUPPORTED_LDAP_CONTROLS[control_num]['desc'],
+                    self.domain
+                ),
+                level=8
+            )
+
+        _search = self.ldap.search_s(
+            '',
+            scope=ldap.SCOPE_BASE,
+            attrlist=['supportedControl']
+        )
+
+        for (_result, _supported_controls) in _search:
+            supported_controls = _supported_controls.values()[0]
+            for control_num in SUPPORTED_LDAP_CONTROLS:
+                if SUPPORTED_LDAP_CONTROLS[control_num]['oid'] in \
+                        supported_controls:
+
+                    log.debug(
+                        _l("Found support for %s") % (
+                            SUPPORTED_LDAP_CONTROLS[control_num]['desc'],
+                        ),
+                        level=8
+                    )
+
+                    self.ldap.supported_controls.append(
+                        SUPPORTED_LDAP_CONTROLS[control_num]['func']
+                    )
+
+    def _persistent_control(self):
+        """
+            Return the search function to follow changes with, preferring
+            syncrepl over persistent search, or None if neither is supported.
+        """
+        self._load_supported_controls()
+
+        for func in ['_sync_repl', '_persistent_search']:
+            if func in self.ldap.supported_controls:
+                return func
+
+        return None
+
+    def _batch_control(self):
+        """
+            Return the first supported search function that completes, rather
+            than follows changes, falling back to the simple paged results
+            control like 'kolab sync' does.
+        """
+        self._load_supported_controls()
+
+        for func in self.ldap.supported_controls:
+            if func not in ['_sync_repl', '_persistent_search']:
+                return func
+
+        return '_paged_search'
+
     def _search(
         self,
         base_dn,
@@ -3126,46 +3624,7 @@ class LDAP(Base):
         if timeout is None:
             timeout = float(self.config_get('ldap', 'timeout', default=10))
 
-        supported_controls = conf.get_list('ldap', 'supported_controls')
-
-        if supported_controls is not None and not len(supported_controls) < 1:
-            for control_num in [(int)(x) for x in supported_controls]:
-                self.ldap.supported_controls.append(
-                    SUPPORTED_LDAP_CONTROLS[control_num]['func']
-                )
-
-        if len(self.ldap.supported_controls) < 1:
-            for control_num in SUPPORTED_LDAP_CONTROLS:
-                log.debug(
-                    _l("Checking for support for %s on %s") % (
-                        SUPPORTED_LDAP_CONTROLS[control_num]['desc'],
-                        self.domain
-                    ),
-                    level=8
-                )
-
-            _search = self.ldap.search_s(
-                '',
-                scope=ldap.SCOPE_BASE,
-                attrlist=['supportedControl']
-            )
-
-            for (_result, _supported_controls) in _search:
-                supported_controls = _supported_controls.values()[0]
-                for control_num in SUPPORTED_LDAP_CONTROLS:
-                    if SUPPORTED_LDAP_CONTROLS[control_num]['oid'] in \
-                            supported_controls:
-
-                        log.debug(
-                            _l("Found support for %s") % (
-                                SUPPORTED_LDAP_CONTROLS[control_num]['desc'],
-                            ),
-                            level=8
-                        )
-
-                        self.ldap.supported_controls.append(
-                            SUPPORTED_LDAP_CONTROLS[control_num]['func']
-                        )
+        self._load_supported_controls()
 
         _results = []
 
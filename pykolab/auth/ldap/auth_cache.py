@@ -16,7 +16,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from contextlib import contextmanager
+import anydbm
+import atexit
 import datetime
+import fcntl
+import os
+import threading
+import time
 
 import sqlalchemy
 
@@ -30,10 +37,12 @@ from sqlalchemy import Text
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
 import pykolab
 
+from pykolab import utils
 from pykolab.constants import KOLAB_LIB_PATH
 
 # pylint: disable=invalid-name
@@ -44,6 +53,8 @@ metadata = MetaData()
 
 db = None
 
+backend = None
+
 try:
     unicode('')
 except NameError:
@@ -74,78 +85,238 @@ class Entry(DeclarativeBase):
             self.value = value
 
 #
-# Functions
+# Backends
 #
 
 
-def del_entry(key):
-    # pylint: disable=global-statement
-    global db
+class LRUBackend(object):
+    """
+        An in-process cache, optionally backed by a dbm database shared with
+        other processes.
 
-    db = init_db()
+        Writes to the dbm database are batched, and flushed at the latest
+        batch_interval seconds after the first one has been held back.
+        Expired entries are only removed as they are encountered.
+    """
 
-    try:
-        db.query(Entry).filter_by(key=key).delete()
-    except sqlalchemy.exc.OperationalError:
-        db = init_db(reinit=True)
-    except sqlalchemy.exc.InvalidRequest:
-        db = init_db(reinit=True)
-    finally:
-        db.query(Entry).filter_by(key=key).delete()
+    def __init__(self, path=None, size=10000, ttl=86400, batch_size=50, batch_interval=5):
+        self.cache = utils.LRUCache(size=size, ttl=ttl)
+        self.path = path
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
 
-    db.commit()
+        # Pending writes, key => (value, expires), or None for a deletion.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
 
+        # Flushes the pending writes held back for too long.
+        self.timer = None
 
-def get_entry(key):
-    # pylint: disable=global-statement
-    global db
+        if self.path is not None:
+            atexit.register(self.flush)
 
-    db = init_db()
+    def del_entry(self, key):
+        key = _encode(key)
 
-    try:
-        _entries = db.query(Entry).filter_by(key=key).all()
-    except sqlalchemy.exc.OperationalError:
-        db = init_db(reinit=True)
-    except sqlalchemy.exc.InvalidRequest:
-        db = init_db(reinit=True)
-    finally:
-        _entries = db.query(Entry).filter_by(key=key).all()
+        self.cache.delete(key)
 
-    if len(_entries) != 1:
-        return None
+        if self.path is not None:
+            self._queue(key, None)
 
-    log.debug("Entry found: %r" % (_entries[0].__dict__))
-    log.debug("Returning: %r" % (_entries[0].value))
+    def get_entry(self, key):
+        key = _encode(key)
 
-    return _entries[0].value.encode('utf-8', 'latin1')
+        value = self.cache.get(key)
 
+        if value is None and self.path is not None:
+            value = self._dbm_get(key)
 
-def set_entry(key, value):
-    db = init_db()
+            if value is not None:
+                self.cache.set(key, value)
 
-    try:
-        _entries = db.query(Entry).filter_by(key=key).all()
-    except sqlalchemy.exc.OperationalError:
-        db = init_db(reinit=True)
-    except sqlalchemy.exc.InvalidRequest:
-        db = init_db(reinit=True)
-    finally:
-        _entries = db.query(Entry).filter_by(key=key).all()
+        return value
 
-    if not _entries:
-        db.add(Entry(key, value))
-        db.commit()
+    def set_entry(self, key, value):
+        key = _encode(key)
+        value = _encode(value)
 
-    elif len(_entries) == 1:
-        if not isinstance(value, unicode):
-            value = unicode(value, 'utf-8')
+        # An unchanged value is set again all the same, so that it expires
+        # ttl seconds from now.
+        self.cache.set(key, value)
+
+        if self.path is not None:
+            self._queue(key, (value, int(time.time() + self.ttl)))
+
+    def flush(self):
+        """
+            Write the pending changes to the dbm database.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.last_flush = time.time()
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if not pending:
+            return
+
+        try:
+            with _locked(self.path, fcntl.LOCK_EX):
+                _db = anydbm.open(self.path, 'c')
 
-        if not _entries[0].value == value:
-            _entries[0].value = value
+                try:
+                    for key, item in pending.items():
+                        if item is None:
+                            if _db.has_key(key):
+                                del _db[key]
+                        else:
+                            (value, expires) = item
+                            _db[key] = "%d %s" % (expires, value)
+                finally:
+                    _db.close()
+
+        except Exception as errmsg:
+            log.error("Could not write to %s: %r" % (self.path, errmsg))
+
+    def _dbm_get(self, key):
+        with self.lock:
+            if key in self.pending:
+                item = self.pending[key]
+                return item[0] if item is not None else None
+
+        try:
+            with _locked(self.path, fcntl.LOCK_SH):
+                _db = anydbm.open(self.path, 'r')
+
+                try:
+                    item = _db.get(key)
+                finally:
+                    _db.close()
+
+        except Exception as errmsg:
+            log.debug("Could not read from %s: %r" % (self.path, errmsg), level=8)
+            return None
+
+        if item is None:
+            return None
+
+        (expires, value) = item.split(' ', 1)
+
+        if int(expires) < time.time():
+            self._queue(key, None)
+            return None
+
+        return value
+
+    def _queue(self, key, item):
+        with self.lock:
+            self.pending[key] = item
+
+            flush = len(self.pending) >= self.batch_size or \
+                self.last_flush + self.batch_interval < time.time()
+
+            if not flush and self.timer is None:
+                self.timer = threading.Timer(self.batch_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if flush:
+            self.flush()
+
+
+class SQLBackend(object):
+    """
+        A cache in a SQL database, shared by all processes using the same
+        database URI.
+    """
+
+    # pylint: disable=no-self-use
+    def del_entry(self, key):
+        # pylint: disable=global-statement
+        global db
+
+        db = init_db()
+
+        try:
+            db.query(Entry).filter_by(key=key).delete()
+        except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InvalidRequestError):
+            db = init_db(reinit=True)
+            db.query(Entry).filter_by(key=key).delete()
 
-        _entries[0].last_change = datetime.datetime.now()
         db.commit()
 
+    # pylint: disable=no-self-use
+    def get_entry(self, key):
+        # pylint: disable=global-statement
+        global db
+
+        db = init_db()
+
+        try:
+            _entries = db.query(Entry).filter_by(key=key).all()
+        except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InvalidRequestError):
+            db = init_db(reinit=True)
+            _entries = db.query(Entry).filter_by(key=key).all()
+
+        if len(_entries) != 1:
+            return None
+
+        log.debug("Entry found: %r" % (_entries[0].__dict__))
+        log.debug("Returning: %r" % (_entries[0].value))
+
+        return _entries[0].value.encode('utf-8', 'latin1')
+
+    # pylint: disable=no-self-use
+    def set_entry(self, key, value):
+        # pylint: disable=global-statement
+        global db
+
+        db = init_db()
+
+        try:
+            _entries = db.query(Entry).filter_by(key=key).all()
+        except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InvalidRequestError):
+            db = init_db(reinit=True)
+            _entries = db.query(Entry).filter_by(key=key).all()
+
+        if not _entries:
+            db.add(Entry(key, value))
+            db.commit()
+
+        elif len(_entries) == 1:
+            if not isinstance(value, unicode):
+                value = unicode(value, 'utf-8')
+
+            if not _entries[0].value == value:
+                _entries[0].value = value
+
+            _entries[0].last_change = datetime.datetime.now()
+            db.commit()
+
+    def flush(self):
+        pass
+
+#
+# Functions
+#
+
+
+def del_entry(key):
+    init_backend().del_entry(key)
+
+
+def get_entry(key):
+    return init_backend().get_entry(key)
+
+
+def set_entry(key, value):
+    init_backend().set_entry(key, value)
+
 
 def purge_entries(db):
     db.query(Entry).filter(
@@ -155,9 +326,45 @@ def purge_entries(db):
     db.commit()
 
 
+def init_backend():
+    """
+        Returns the cache backend selected through auth_cache_uri.
+
+        An empty or memory:// URI selects an in-process cache, dbm:///path
+        additionally shares the cache with other processes through the dbm
+        database at path. Any other URI is a SQLAlchemy database URI.
+    """
+    # pylint: disable=global-statement
+    global backend
+
+    if backend is not None:
+        return backend
+
+    uri = conf.get('ldap', 'auth_cache_uri')
+
+    size = int(conf.get('ldap', 'auth_cache_size'))
+    ttl = int(conf.get('ldap', 'auth_cache_ttl'))
+
+    if uri is None or uri == '' or uri.startswith('memory://'):
+        backend = LRUBackend(size=size, ttl=ttl)
+
+    elif uri.startswith('dbm://'):
+        path = uri[len('dbm://'):]
+
+        if path == '/' or path == '':
+            path = os.path.join(KOLAB_LIB_PATH, 'auth_cache')
+
+        backend = LRUBackend(path=path, size=size, ttl=ttl)
+
+    else:
+        backend = SQLBackend()
+
+    return backend
+
+
 def init_db(reinit=False):
     """
-        Returns a SQLAlchemy Session() instance.
+        Returns a SQLAlchemy Session() instance, local to the calling thread.
     """
     # pylint: disable=global-statement
     global db
@@ -171,7 +378,6 @@ def init_db(reinit=False):
         db_uri = 'sqlite:///%s/auth_cache.db' % (KOLAB_LIB_PATH)
 
         if reinit:
-            import os
             if os.path.isfile('%s/auth_cache.db' % (KOLAB_LIB_PATH)):
                 os.unlink('%s/auth_cache.db' % (KOLAB_LIB_PATH))
 
@@ -179,8 +385,30 @@ def init_db(reinit=False):
     engine = create_engine(db_uri, echo=echo)
     DeclarativeBase.metadata.create_all(engine)
 
-    Session = sessionmaker(bind=engine)
-    db = Session()
+    db = scoped_session(sessionmaker(bind=engine))
     purge_entries(db)
 
     return db
+
+
+@contextmanager
+def _locked(path, operation):
+    """
+        Hold a lock on the dbm database at path, with operation being one of
+        fcntl.LOCK_SH or fcntl.LOCK_EX.
+    """
+    lockfile = open("%s.lock" % (path), 'a')
+
+    try:
+        fcntl.flock(lockfile, operation)
+        yield
+    finally:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
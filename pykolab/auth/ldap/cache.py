@@ -39,6 +39,8 @@ import pykolab
 from pykolab.constants import KOLAB_LIB_PATH
 from pykolab.translate import _
 
+import verdict_cache
+
 # pylint: disable=invalid-name
 conf = pykolab.getConf()
 log = pykolab.getLogger('pykolab.cache')
@@ -94,6 +96,8 @@ def delete_entry(domain, entry):
         _db.delete(_entry)
         _db.commit()
 
+        verdict_cache.invalidate()
+
 
 def get_entry(domain, entry, update=True):
     result_attribute = conf.get_raw('cyrus-sasl', 'result_attribute')
@@ -133,6 +137,8 @@ def get_entry(domain, entry, update=True):
         _db.add(Entry(_uniqueid, entry[result_attribute], entry['modifytimestamp']))
 
         _db.commit()
+
+        verdict_cache.invalidate()
         _entry = _db.query(Entry).filter_by(uniqueid=_uniqueid).first()
     else:
         modifytimestamp_format = conf.get_raw(
@@ -150,6 +156,8 @@ def get_entry(domain, entry, update=True):
 
             _entry.last_change = last_change
             _db.commit()
+
+            verdict_cache.invalidate()
             _entry = _db.query(Entry).filter_by(uniqueid=_uniqueid).first()
 
         if result_attribute in entry:
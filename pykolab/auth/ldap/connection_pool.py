@@ -0,0 +1,255 @@
+# Copyright 2010-2016 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    A pool of the LDAP connections of a process, bound as the service or
+    the privileged account, and keyed on the LDAP URI and bind DN.
+
+    An LDAP instance leases a connection from the pool the first time it
+    binds, and returns it when it disconnects. A connection bound as any
+    other DN (such as for an authentication attempt) is not returned to the
+    pool, and neither is the connection of an instance garbage collected
+    without disconnecting, since operations may still be outstanding on it.
+
+    The pool holds up to [ldap] connection_pool_size idle connections per
+    URI and bind DN, and is disabled if that is 0. After a failure to reach
+    the LDAP server, new connections are held off with an exponential backoff.
+"""
+
+import os
+import threading
+import time
+import weakref
+
+import pykolab
+
+# pylint: disable=invalid-name
+conf = pykolab.getConf()
+log = pykolab.getLogger('pykolab.connection_pool')
+
+# Connections idle for longer than this many seconds are checked before they
+# are handed out again.
+check_interval = 60
+
+# The backoff after a failure to reach the LDAP server, doubling with every
+# consecutive failure up to the maximum.
+backoff_interval = 1
+backoff_max_interval = 30
+
+# Reentrant, for an owner may be garbage collected with the lock held.
+lock = threading.RLock()
+
+# The idle connections, by (uri, bind_dn), as lists of (connection, time
+# returned).
+idle = {}
+
+# The leased connections, by id(), as (weak reference to the owner, (uri,
+# bind_dn), connection).
+leases = {}
+
+# The consecutive failures to reach an LDAP URI, as (count, time until which
+# to hold off).
+failures = {}
+
+# The process the connections have been made in.
+pid = os.getpid()
+
+settings = None
+
+stats = {
+    'leased': 0,
+    'returned': 0,
+    'discarded': 0
+}
+
+
+def _settings():
+    # pylint: disable=global-statement
+    global settings
+
+    if settings is None:
+        settings = {
+            'size': int(conf.get('ldap', 'connection_pool_size'))
+        }
+
+    return settings
+
+
+def _check_pid():
+    """
+        Forget about the connections of the parent after a fork, for they are
+        shared with the parent. Must be called with the lock held.
+    """
+    # pylint: disable=global-statement
+    global pid
+
+    if not pid == os.getpid():
+        idle.clear()
+        leases.clear()
+        failures.clear()
+        pid = os.getpid()
+
+
+def _unbind(conn):
+    stats['discarded'] += 1
+
+    try:
+        conn.unbind_s()
+    # pylint: disable=broad-except
+    except Exception:
+        pass
+
+
+def enabled():
+    return _settings()['size'] > 0
+
+
+def lease(owner, uri, bind_dn):
+    """
+        Return an idle connection to uri bound as bind_dn, or None if there
+        is none. The connection is unbound when the owner (an LDAP instance)
+        is garbage collected, unless it is released or forgotten about
+        before.
+    """
+    if not enabled():
+        return None
+
+    key = (uri, bind_dn)
+
+    while True:
+        with lock:
+            _check_pid()
+
+            if not idle.get(key):
+                return None
+
+            (conn, returned) = idle[key].pop()
+
+        if returned + check_interval < time.time():
+            try:
+                conn.whoami_s()
+            # pylint: disable=broad-except
+            except Exception as errmsg:
+                log.debug("Discarding pooled LDAP connection: %r" % (errmsg), level=8)
+                _unbind(conn)
+                continue
+
+        register(owner, uri, bind_dn, conn)
+
+        return conn
+
+
+def register(owner, uri, bind_dn, conn):
+    """
+        Lease a connection the owner has bound as bind_dn itself.
+    """
+    if not enabled():
+        return
+
+    with lock:
+        _check_pid()
+
+        if id(conn) not in leases:
+            stats['leased'] += 1
+
+        leases[id(conn)] = (weakref.ref(owner, _collected), (uri, bind_dn), conn)
+
+
+def release(conn):
+    """
+        Return a leased connection to the pool.
+    """
+    with lock:
+        _check_pid()
+
+        _lease = leases.pop(id(conn), None)
+
+    if _lease is not None:
+        _return(_lease[1], conn)
+
+
+def forget(conn):
+    """
+        Do not return a leased connection to the pool, such as after it has
+        been bound as another DN, or has failed.
+    """
+    with lock:
+        leases.pop(id(conn), None)
+
+
+def _collected(ref):
+    with lock:
+        _check_pid()
+
+        _leases = [x for x in leases.values() if x[0] is ref]
+
+        for _lease in _leases:
+            del leases[id(_lease[2])]
+
+    for (_ref, key, conn) in _leases:
+        _unbind(conn)
+
+
+def _return(key, conn):
+    with lock:
+        _check_pid()
+
+        if key[0] not in failures and len(idle.get(key, [])) < _settings()['size']:
+            idle.setdefault(key, []).append((conn, time.time()))
+            stats['returned'] += 1
+            return
+
+    _unbind(conn)
+
+
+def failed(uri):
+    """
+        Note a failure to reach the LDAP server at uri, and discard the idle
+        connections to it.
+    """
+    now = time.time()
+
+    with lock:
+        _check_pid()
+
+        (count, until) = failures.get(uri, (0, now))
+        failures[uri] = (count + 1, now + min(backoff_interval * 2 ** count, backoff_max_interval))
+
+        discard = []
+
+        for key in [x for x in idle if x[0] == uri]:
+            discard.extend([x[0] for x in idle.pop(key)])
+
+    for conn in discard:
+        _unbind(conn)
+
+
+def succeeded(uri):
+    with lock:
+        failures.pop(uri, None)
+
+
+def backoff(uri):
+    """
+        Return the number of seconds to hold off connecting to uri.
+    """
+    with lock:
+        _check_pid()
+
+        if uri not in failures:
+            return 0
+
+        return max(0, failures[uri][1] - time.time())
@@ -0,0 +1,238 @@
+# Copyright 2010-2016 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    An in-memory cache of the DNs of entries by their unique ID, and of the
+    attributes of entries by their DN, keyed on the LDAP URI as well.
+
+    The attributes of an entry are cached as fetched, including which of the
+    attributes asked for by name the entry does not have. An entry fetched
+    with '*' has all its user attributes cached.
+
+    Entries expire after [ldap] entry_cache_ttl seconds, and the cache is
+    disabled if that is 0. An entry is dropped when it is written to, and
+    when the synchronization sees it change, in which case all processes
+    are signalled to flush their caches.
+"""
+
+import os
+import threading
+import time
+
+import pykolab
+
+from pykolab import utils
+from pykolab.constants import KOLAB_LIB_PATH
+
+# pylint: disable=invalid-name
+conf = pykolab.getConf()
+log = pykolab.getLogger('pykolab.entry_cache')
+
+stamp_file = os.path.join(KOLAB_LIB_PATH, 'entry_cache.stamp')
+
+lock = threading.Lock()
+
+# The DNs by (uri, lower-case unique ID).
+dns = utils.LRUCache()
+
+# The entries by (uri, lower-case DN), as (attributes, whether the entry
+# has been fetched with '*', time of expiry). The attributes are by their
+# lower-case name, with None for the ones the entry does not have.
+entries = utils.LRUCache()
+
+settings = None
+
+last_invalidation = None
+
+stats = {
+    'hits': 0,
+    'misses': 0
+}
+
+
+def _settings():
+    # pylint: disable=global-statement
+    global settings
+
+    if settings is None:
+        settings = {
+            'ttl': int(conf.get('ldap', 'entry_cache_ttl')),
+            'size': int(conf.get('ldap', 'entry_cache_size'))
+        }
+
+        dns.size = settings['size']
+        entries.size = settings['size']
+
+    return settings
+
+
+def _check_invalidation():
+    """
+        Flush the cache if another process has signalled a change since we
+        last looked. Must be called with the lock held.
+    """
+    # pylint: disable=global-statement
+    global last_invalidation
+
+    try:
+        mtime = os.stat(stamp_file).st_mtime
+    except OSError:
+        mtime = None
+
+    if not mtime == last_invalidation:
+        if last_invalidation is not None or mtime is not None:
+            log.debug("Invalidating all cached entries", level=8)
+
+        dns.clear()
+        entries.clear()
+        last_invalidation = mtime
+
+
+def enabled():
+    return _settings()['ttl'] > 0
+
+
+def get_dn(uri, entry_id):
+    """
+        Return the cached DN for the unique ID, or None.
+    """
+    if not enabled():
+        return None
+
+    with lock:
+        _check_invalidation()
+
+        return dns.get((uri, entry_id.lower()))
+
+
+def set_dn(uri, entry_id, entry_dn):
+    if not enabled():
+        return
+
+    with lock:
+        _check_invalidation()
+
+        dns.set((uri, entry_id.lower()), entry_dn, ttl=_settings()['ttl'])
+
+
+def get_attributes(uri, entry_dn, attributes):
+    """
+        Return the attributes of an entry as cached, or None if not all of
+        them are.
+    """
+    if not enabled():
+        return None
+
+    names = [x.lower() for x in attributes if not x.lower() == 'dn']
+
+    with lock:
+        _check_invalidation()
+
+        item = entries.get((uri, entry_dn.lower()))
+
+        if item is not None:
+            (attrs, complete, expires) = item
+
+            if '*' in names and not complete:
+                item = None
+            elif [x for x in names if not x == '*' and x not in attrs]:
+                item = None
+
+        if item is None:
+            stats['misses'] += 1
+            return None
+
+        stats['hits'] += 1
+
+    if '*' in names:
+        names = attrs.keys()
+
+    result = {}
+
+    for name in names:
+        if attrs.get(name) is not None:
+            result[name] = list(attrs[name])
+
+    return result
+
+
+def set_attributes(uri, entry_dn, attributes, entry_attrs):
+    """
+        Cache the attributes of an entry, as fetched by asking for the
+        attributes.
+    """
+    if not enabled():
+        return
+
+    names = [x.lower() for x in attributes if not x.lower() == 'dn']
+
+    with lock:
+        _check_invalidation()
+
+        key = (uri, entry_dn.lower())
+
+        item = entries.get(key)
+
+        if item is None:
+            attrs = {}
+            complete = False
+            expires = time.time() + _settings()['ttl']
+        else:
+            (attrs, complete, expires) = item
+
+        for name in names:
+            if not name == '*':
+                attrs[name] = None
+
+        for name, value in entry_attrs.items():
+            if not isinstance(value, list):
+                value = [value]
+
+            attrs[name.lower()] = list(value)
+
+        # Attributes added to a cached entry expire along with it.
+        entries.set(key, (attrs, complete or '*' in names, expires), ttl=expires - time.time())
+
+
+def invalidate(uri=None, entry_dn=None, signal=True):
+    """
+        Drop an entry from the cache, or all entries if entry_dn is None, and
+        with signal, have all other processes flush their caches.
+    """
+    # pylint: disable=global-statement
+    global last_invalidation
+
+    with lock:
+        _check_invalidation()
+
+        if entry_dn is None:
+            dns.clear()
+            entries.clear()
+        else:
+            entries.delete((uri, entry_dn.lower()))
+
+        if not signal:
+            return
+
+        try:
+            with open(stamp_file, 'a'):
+                os.utime(stamp_file, None)
+
+            # Our own signal does not need to flush our cache.
+            last_invalidation = os.stat(stamp_file).st_mtime
+
+        except (IOError, OSError) as errmsg:
+            log.error("Could not invalidate cached entries: %r" % (errmsg))
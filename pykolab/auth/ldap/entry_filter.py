@@ -0,0 +1,302 @@
+# Copyright 2010-2016 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    Evaluate LDAP search filters (RFC 4515) against the attributes of an
+    entry already at hand, rather than searching the LDAP server for it.
+
+    A filter is compiled once into a function that, given an entry as a
+    dictionary of (lower-case) attribute names and values, returns True or
+    False, or None if the filter cannot be evaluated locally. That is the
+    case for ordering, approximate and extensible matches, and for any
+    attribute the entry does not hold a value for, since the attribute may
+    not have been fetched.
+
+    Values are compared case-insensitively, which is what the matching rules
+    of the attributes the Kolab filters refer to (such as objectClass)
+    amount to.
+"""
+
+import threading
+
+import pykolab
+
+# pylint: disable=invalid-name
+log = pykolab.getLogger('pykolab.entry_filter')
+
+lock = threading.Lock()
+
+# The compiled filters by filter string.
+compiled = {}
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def compile_filter(filterstr):
+    """
+        Return the function evaluating filterstr for an entry. A filter that
+        cannot be parsed is never evaluated locally.
+    """
+    with lock:
+        if filterstr in compiled:
+            return compiled[filterstr]
+
+    try:
+        (matcher, pos) = _parse(filterstr.strip(), 0)
+
+        if pos < len(filterstr.strip()):
+            raise FilterSyntaxError(filterstr)
+
+    except FilterSyntaxError:
+        log.debug("Cannot evaluate LDAP filter %r locally" % (filterstr), level=8)
+        matcher = _unknown
+
+    with lock:
+        compiled[filterstr] = matcher
+
+    return matcher
+
+
+def match(filterstr, entry):
+    """
+        Return whether the entry matches filterstr, or None if that can only
+        be told by the LDAP server.
+    """
+    return compile_filter(filterstr)(entry)
+
+
+def _unknown(entry):
+    return None
+
+
+def _parse(filterstr, pos):
+    if not filterstr[pos:pos + 1] == '(':
+        # RFC 4515 requires the parentheses, python-ldap allows to omit them
+        # around a single item.
+        if pos == 0 and not filterstr.startswith('('):
+            return (_item(filterstr), len(filterstr))
+
+        raise FilterSyntaxError(filterstr)
+
+    pos += 1
+    operator = filterstr[pos:pos + 1]
+
+    if operator in ['&', '|']:
+        pos += 1
+        matchers = []
+
+        while filterstr[pos:pos + 1] == '(':
+            (matcher, pos) = _parse(filterstr, pos)
+            matchers.append(matcher)
+
+        if operator == '&':
+            matcher = _and(matchers)
+        else:
+            matcher = _or(matchers)
+
+    elif operator == '!':
+        (matcher, pos) = _parse(filterstr, pos + 1)
+        matcher = _not(matcher)
+
+    else:
+        end = filterstr.find(')', pos)
+
+        if end < 0:
+            raise FilterSyntaxError(filterstr)
+
+        matcher = _item(filterstr[pos:end])
+        pos = end
+
+    if not filterstr[pos:pos + 1] == ')':
+        raise FilterSyntaxError(filterstr)
+
+    return (matcher, pos + 1)
+
+
+def _and(matchers):
+    def matcher(entry):
+        result = True
+
+        for _matcher in matchers:
+            _result = _matcher(entry)
+
+            if _result is False:
+                return False
+
+            if _result is None:
+                result = None
+
+        return result
+
+    return matcher
+
+
+def _or(matchers):
+    def matcher(entry):
+        result = False
+
+        for _matcher in matchers:
+            _result = _matcher(entry)
+
+            if _result is True:
+                return True
+
+            if _result is None:
+                result = None
+
+        return result
+
+    return matcher
+
+
+def _not(_matcher):
+    def matcher(entry):
+        result = _matcher(entry)
+
+        if result is None:
+            return None
+
+        return not result
+
+    return matcher
+
+
+def _item(item):
+    if '=' not in item:
+        raise FilterSyntaxError(item)
+
+    (attribute, value) = item.split('=', 1)
+
+    # Ordering, approximate and extensible matches.
+    if attribute[-1:] in ['<', '>', '~'] or ':' in attribute:
+        return _unknown
+
+    attribute = attribute.strip().lower()
+
+    # Attribute options such as ;binary.
+    if ';' in attribute or not attribute:
+        return _unknown
+
+    if value == '*':
+        return _present(attribute)
+
+    if '*' in value:
+        return _substrings(attribute, [_unescape(x).lower() for x in value.split('*')])
+
+    return _equality(attribute, _unescape(value).lower())
+
+
+def _unescape(value):
+    if '\\' not in value:
+        return value
+
+    result = []
+    pos = 0
+
+    while pos < len(value):
+        if value[pos] == '\\':
+            try:
+                result.append(chr(int(value[pos + 1:pos + 3], 16)))
+            except ValueError:
+                raise FilterSyntaxError(value)
+
+            pos += 3
+        else:
+            result.append(value[pos])
+            pos += 1
+
+    return ''.join(result)
+
+
+def _values(entry, attribute):
+    """
+        Return the lower-case values of the attribute, or None if the entry
+        does not hold any.
+    """
+    values = entry.get(attribute)
+
+    if values is None:
+        return None
+
+    if not isinstance(values, list):
+        values = [values]
+
+    if not values:
+        return None
+
+    result = []
+
+    for value in values:
+        try:
+            result.append(value.lower())
+        except AttributeError:
+            result.append(str(value).lower())
+
+    return result
+
+
+def _present(attribute):
+    def matcher(entry):
+        if _values(entry, attribute) is None:
+            return None
+
+        return True
+
+    return matcher
+
+
+def _equality(attribute, value):
+    def matcher(entry):
+        values = _values(entry, attribute)
+
+        if values is None:
+            return None
+
+        return value in values
+
+    return matcher
+
+
+def _substrings(attribute, parts):
+    (initial, middle, final) = (parts[0], parts[1:-1], parts[-1])
+
+    def _match(value):
+        if not value.startswith(initial):
+            return False
+
+        pos = len(initial)
+
+        for part in middle:
+            pos = value.find(part, pos)
+
+            if pos < 0:
+                return False
+
+            pos += len(part)
+
+        return len(value) - len(final) >= pos and value.endswith(final)
+
+    def matcher(entry):
+        values = _values(entry, attribute)
+
+        if values is None:
+            return None
+
+        return any([_match(x) for x in values])
+
+    return matcher
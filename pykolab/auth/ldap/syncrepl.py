@@ -8,6 +8,7 @@ import ldapurl
 import pykolab
 
 from pykolab import utils
+from pykolab.translate import _
 
 log = pykolab.getLogger('pykolab.syncrepl')
 conf = pykolab.getConf()
@@ -28,10 +29,18 @@ class DNSync(ldap.ldapobject.LDAPObject,ldap.syncrepl.SyncreplConsumer):
     def syncrepl_set_cookie(self,cookie):
         self.__db['cookie'] = cookie
 
+        # Checkpoint the cookie, along with the entries it covers, so that a
+        # restart resumes from here rather than from scratch.
+        if hasattr(self.__db, 'sync'):
+            self.__db.sync()
+
     def syncrepl_get_cookie(self):
         if 'cookie' in self.__db:
             return self.__db['cookie']
 
+    def close_db(self):
+        self.__db.close()
+
     def syncrepl_delete(self, uuids):
         log.debug("syncrepl_delete uuids: %r" % (uuids), level=8)
 
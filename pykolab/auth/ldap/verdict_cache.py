@@ -0,0 +1,167 @@
+# Copyright 2010-2016 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    An in-memory cache of authentication verdicts, keyed on a salted hash of
+    the login, realm and password.
+
+    The cache is disabled unless [ldap] verdict_cache_ttl and/or
+    verdict_cache_negative_ttl are set to a number of seconds. The kolabd
+    synchronization invalidates all cached verdicts whenever it sees an entry
+    being added, modified or deleted.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import pykolab
+
+from pykolab.constants import KOLAB_LIB_PATH
+
+# pylint: disable=invalid-name
+conf = pykolab.getConf()
+log = pykolab.getLogger('pykolab.verdict_cache')
+
+stamp_file = os.path.join(KOLAB_LIB_PATH, 'verdict_cache.stamp')
+
+# The salt is local to the process, so that the hashes are meaningless
+# outside of it.
+salt = os.urandom(16)
+
+lock = threading.Lock()
+
+entries = OrderedDict()
+
+settings = None
+
+last_invalidation = None
+
+
+def _settings():
+    # pylint: disable=global-statement
+    global settings
+
+    if settings is None:
+        settings = {
+            'ttl': int(conf.get('ldap', 'verdict_cache_ttl')),
+            'negative_ttl': int(conf.get('ldap', 'verdict_cache_negative_ttl')),
+            'size': int(conf.get('ldap', 'verdict_cache_size'))
+        }
+
+    return settings
+
+
+def _key(login, realm):
+    return hashlib.sha256(
+        '\0'.join([salt, login[0], realm or '', login[1]])
+    ).hexdigest()
+
+
+def _check_invalidation():
+    """
+        Flush all verdicts if the synchronization has signalled a change
+        since we last looked.
+    """
+    # pylint: disable=global-statement
+    global last_invalidation
+
+    try:
+        mtime = os.stat(stamp_file).st_mtime
+    except OSError:
+        mtime = None
+
+    if not mtime == last_invalidation:
+        if last_invalidation is not None or mtime is not None:
+            log.debug("Invalidating all authentication verdicts", level=8)
+
+        entries.clear()
+        last_invalidation = mtime
+
+
+def enabled():
+    _s = _settings()
+    return _s['ttl'] > 0 or _s['negative_ttl'] > 0
+
+
+def get_verdict(login, realm):
+    """
+        Return the cached verdict (True or False) for the login credentials,
+        or None if no valid verdict is cached.
+    """
+    if not enabled():
+        return None
+
+    key = _key(login, realm)
+
+    with lock:
+        _check_invalidation()
+
+        if key not in entries:
+            return None
+
+        (verdict, expires) = entries.pop(key)
+
+        if expires < time.time():
+            return None
+
+        # Move the entry to the most recently used end.
+        entries[key] = (verdict, expires)
+
+    return verdict
+
+
+def set_verdict(login, realm, verdict):
+    """
+        Cache a verdict for the login credentials.
+    """
+    if not enabled():
+        return
+
+    _s = _settings()
+
+    if verdict:
+        ttl = _s['ttl']
+    else:
+        ttl = _s['negative_ttl']
+
+    if ttl <= 0:
+        return
+
+    key = _key(login, realm)
+
+    with lock:
+        _check_invalidation()
+
+        entries.pop(key, None)
+        entries[key] = (verdict, time.time() + ttl)
+
+        while len(entries) > _s['size']:
+            entries.popitem(last=False)
+
+
+def invalidate():
+    """
+        Signal all processes holding verdicts to flush them.
+    """
+    try:
+        with open(stamp_file, 'a'):
+            os.utime(stamp_file, None)
+    except (IOError, OSError) as errmsg:
+        log.error("Could not invalidate authentication verdicts: %r" % (errmsg))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010-2019 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+import commands
+
+import pykolab
+
+from pykolab.translate import _
+
+log = pykolab.getLogger('pykolab.cli')
+conf = pykolab.getConf()
+
+def __init__():
+    commands.register('list_wallace_spool', execute, description=description())
+
+def description():
+    return """List the messages in the Wallace spool, as indexed by the Wallace daemon."""
+
+def execute(*args, **kw):
+    """
+        List the messages in the Wallace spool, optionally for one module only.
+    """
+
+    try:
+        module = conf.cli_args.pop(0)
+    except IndexError:
+        module = None
+
+    index_file = conf.get('wallace', 'spool_index')
+
+    try:
+        with open(index_file, 'r') as f:
+            entries = json.loads(f.read())
+    except (IOError, ValueError) as errmsg:
+        log.error(_("Could not read the Wallace spool index %s: %s") % (index_file, errmsg))
+        sys.exit(1)
+
+    print(
+        _("Index written %s") % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.stat(index_file).st_mtime))
+        )
+    )
+
+    for entry in entries:
+        if module is not None and not entry['module'] == module:
+            continue
+
+        if entry['due'] is None:
+            due = '-'
+        else:
+            due = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['due']))
+
+        print(
+            "%-20s %-10s %-20s %s" % (
+                entry['module'] or '-',
+                entry['stage'] or '-',
+                due,
+                os.path.basename(entry['path'])
+            )
+        )
@@ -19,24 +19,42 @@
 
 import commands
 
-from distutils import version
 import multiprocessing
-
-import sys
+import os
+import threading
 import time
+import traceback
 
 import pykolab
 
 from pykolab import utils
 from pykolab.auth import Auth
+from pykolab.constants import KOLAB_LIB_PATH
 from pykolab.imap import IMAP
 from pykolab.translate import _
 
 log = pykolab.getLogger('pykolab.cli')
 conf = pykolab.getConf()
 
+# In the worker processes, the IMAP connection and the snapshot of existing
+# user mailboxes.
 imap = None
+mailboxes = None
+
+# In the main process, the pool of workers, the bound on the number of
+# entries queued for them, and the progress made.
 pool = None
+backlog = None
+backlog_size = None
+checkpoint = None
+completed = set()
+stats = {}
+
+# How many entries to queue per worker.
+queue_depth = 50
+
+# How often to report on the progress made, in number of entries.
+report_interval = 1000
 
 def __init__():
     commands.register('sync', execute, description="Synchronize Kolab Users with IMAP.")
@@ -69,7 +87,7 @@ def cli_options():
         )
 
 def execute(*args, **kw):
-    global imap, pool
+    global pool, backlog, backlog_size
 
     auth = Auth()
 
@@ -89,40 +107,211 @@ def execute(*args, **kw):
       domains = {}
       domains[conf.domain] = conf.domain
 
-    if version.StrictVersion(sys.version[:3]) >= version.StrictVersion("2.7"):
-        pool = multiprocessing.Pool(conf.threads, worker_process, (), 1)
-    else:
-        pool = multiprocessing.Pool(conf.threads, worker_process, ())
+    # The workers each hold on to their IMAP connection for the entire run,
+    # while the LDAP search streams the entries to them page by page. Only
+    # so many entries are queued, so that the search does not run away from
+    # the workers.
+    pool = multiprocessing.Pool(conf.threads, worker_process)
+
+    backlog_size = conf.threads * queue_depth
+    backlog = threading.BoundedSemaphore(backlog_size)
 
     for primary_domain in list(set(domains.values())):
         log.debug(_("Running for domain %s") % (primary_domain), level=8)
         auth = Auth(primary_domain)
         auth.connect(primary_domain)
-        start_time = time.time()
+
+        checkpoint_open(primary_domain, resync=conf.resync)
+
+        stats_reset()
         auth.synchronize(mode='_paged_search', callback=queue_add)
+
+        # Wait for the workers to finish the entries queued.
+        for _x in range(backlog_size):
+            backlog.acquire()
+
+        for _x in range(backlog_size):
+            backlog.release()
+
         end_time = time.time()
 
         log.info(_("Synchronizing users for %s took %d seconds")
-                % (primary_domain, (end_time-start_time))
+                % (primary_domain, (end_time-stats['start']))
+            )
+
+        log.info(
+                _("Synchronized %d entries (%.1f entries/s), skipped %d, failed %d") % (
+                        stats['synchronized'],
+                        rate(stats['synchronized'], end_time),
+                        stats['skipped'],
+                        stats['failed']
+                    )
+            )
+
+        checkpoint_close(primary_domain, complete=(stats['failed'] == 0))
+
+    pool.close()
+    pool.join()
+
+def checkpoint_file(primary_domain):
+    return os.path.join(KOLAB_LIB_PATH, 'sync_%s.checkpoint' % (primary_domain))
+
+def checkpoint_open(primary_domain, resync=False):
+    """
+        Open the checkpoint for the domain, listing the DNs of the entries
+        synchronized in a previous run that did not complete. These entries
+        are skipped, unless resync is set, in which case the checkpoint is
+        started over.
+    """
+    global checkpoint, completed
+
+    filename = checkpoint_file(primary_domain)
+
+    completed = set()
+
+    if resync and os.path.isfile(filename):
+        os.unlink(filename)
+
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            completed = set([x.strip() for x in f if x.strip()])
+
+        log.info(
+                _("Resuming the synchronization of %s, skipping %d entries") % (
+                        primary_domain,
+                        len(completed)
+                    )
             )
 
-    while not pool._taskqueue.empty():
-        time.sleep(1)
+    try:
+        checkpoint = open(filename, 'a')
+    except IOError as errmsg:
+        log.warning(_("Could not open checkpoint %s: %r") % (filename, errmsg))
+        checkpoint = None
+
+def stats_reset():
+    """
+        Start counting the progress made over again, for the next domain.
+    """
+    global stats
+
+    stats = {
+            'start': time.time(),
+            'synchronized': 0,
+            'skipped': 0,
+            'failed': 0
+        }
+
+def rate(count, now=None):
+    """
+        The number of entries per second since the progress was last reset.
+    """
+    if now is None:
+        now = time.time()
+
+    return float(count) / max(now - stats['start'], 1)
+
+def checkpoint_close(primary_domain, complete=False):
+    global checkpoint
+
+    if checkpoint is not None:
+        checkpoint.close()
+        checkpoint = None
+
+    if complete and os.path.isfile(checkpoint_file(primary_domain)):
+        os.unlink(checkpoint_file(primary_domain))
 
 def queue_add(*args, **kw):
-    global pool
     for dn, entry in kw['entry']:
+        # This is a referral
+        if dn is None:
+            continue
+
+        if dn in completed:
+            stats['skipped'] += 1
+            continue
+
         entry['dn'] = dn
-        r = pool.apply_async(_synchronize, (), dict(**entry))
-        r.wait()
+        backlog.acquire()
+        pool.apply_async(_synchronize, (), dict(**entry), callback=_synchronized)
+
+def _synchronized(dn):
+    """
+        Called back in the main process as a worker finishes an entry.
+    """
+    if dn is None:
+        stats['failed'] += 1
+    else:
+        stats['synchronized'] += 1
+
+        if checkpoint is not None:
+            checkpoint.write('%s\n' % (dn))
+            checkpoint.flush()
+
+    backlog.release()
+
+    done = stats['synchronized'] + stats['failed']
+
+    if done % report_interval == 0:
+        log.info(
+                _("Synchronized %d entries (%.1f entries/s)") % (
+                        done,
+                        rate(done)
+                    )
+            )
 
 def worker_process(*args, **kw):
-    pass
+    """
+        Connect the worker process to IMAP, and take a snapshot of the user
+        mailboxes that exist, so that not every entry needs a LIST.
+    """
+    global imap, mailboxes
+
+    imap = IMAP()
+    imap.connect()
+
+    mailboxes = set(
+            [x.lower() for x in imap.list_folders('user%s%%' % (imap.get_separator()))]
+        )
+
+    log.debug(
+            _("Worker process %s found %d user mailboxes") % (
+                    multiprocessing.current_process().name,
+                    len(mailboxes)
+                ),
+            level=8
+        )
 
 def _synchronize(*args, **kw):
-    log.info(_("Worker process %s handling %s") % (multiprocessing.current_process().name, kw['dn']))
+    """
+        Synchronize an entry in a worker process. Returns the DN of the entry,
+        or None if it failed.
+    """
+    try:
+        _synchronize_entry(kw)
+    except Exception:
+        log.error(
+                _("Worker process %s failed to handle %s: %s") % (
+                        multiprocessing.current_process().name,
+                        kw['dn'],
+                        traceback.format_exc()
+                    )
+            )
+
+        return None
 
-    entry = utils.normalize(kw)
+    return kw['dn']
+
+def _synchronize_entry(entry):
+    log.debug(
+            _("Worker process %s handling %s") % (
+                    multiprocessing.current_process().name,
+                    entry['dn']
+                ),
+            level=8
+        )
+
+    entry = utils.normalize(entry)
 
     mailbox_attribute = conf.get('cyrus-sasl', 'result_attribute')
     if mailbox_attribute == None:
@@ -135,16 +324,21 @@ def _synchronize(*args, **kw):
     if not 'kolabinetorgperson' in entry['objectclass']:
         return
 
-    imap = IMAP()
-    imap.connect()
+    folder = 'user%s%s' % (imap.get_separator(), entry[mailbox_attribute].lower())
 
+    if folder in mailboxes:
+        return
+
+    # The mailbox may have been created since the snapshot was taken.
     if not imap.user_mailbox_exists(entry[mailbox_attribute]):
         if 'mailhost' in entry:
             server = entry['mailhost']
         else:
             server = None
 
-        imap.user_mailbox_create(entry[mailbox_attribute], server=server)
+        # The connection is reused for users in other domains.
+        imap.domain = None
 
-    imap.disconnect()
+        imap.user_mailbox_create(entry[mailbox_attribute], server=server)
 
+    mailboxes.add(folder)
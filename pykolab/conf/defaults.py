@@ -26,6 +26,15 @@ class Defaults(object):
 
         self.imap_virtual_domains = 'userid'
 
+        # The number of seconds a snapshot of the mailbox directory is used to
+        # tell whether mailboxes exist and what server they are on, or 0 to
+        # look up each mailbox as needed.
+        self.imap_mailbox_index_ttl = 0
+
+        # The number of seconds to wait, at most, for new folders to appear in
+        # a Cyrus IMAP Murder.
+        self.imap_settle_timeout = 60
+
         # An integer or float to indicate the interval at which the Cyrus IMAP
         # library should try to retrieve annotations
         self.cyrus_annotations_retry_interval = 1
@@ -42,4 +51,23 @@ class Defaults(object):
         self.ldap_timeout = 10
         self.ldap_unique_attribute = 'nsuniqueid'
 
+        # The maximum number of entries in, and the number of seconds entries
+        # remain valid in the authentication cache.
+        self.ldap_auth_cache_size = 10000
+        self.ldap_auth_cache_ttl = 86400
+
+        # Seconds to cache successful and failed authentication verdicts for,
+        # and the maximum number of verdicts to cache. Disabled when 0.
+        self.ldap_verdict_cache_ttl = 0
+        self.ldap_verdict_cache_negative_ttl = 0
+        self.ldap_verdict_cache_size = 10000
+        self.ldap_connection_pool_size = 4
+        self.ldap_modify_pipeline_depth = 0
+        self.ldap_entry_cache_ttl = 60
+        self.ldap_entry_cache_size = 10000
+
         self.wallace_resource_calendar_expire_days = 100
+
+        # Where the Wallace daemon writes out the index of its spool.
+        self.wallace_spool_index = '/var/run/wallaced/spool.index'
+        self.wallace_invitationpolicy_lock_timeout = 10
@@ -18,7 +18,9 @@
 #
 
 
+import itertools
 import logging
+import os
 import re
 import time
 import socket
@@ -30,9 +32,102 @@ import pykolab
 from pykolab import utils
 from pykolab.translate import _
 
+from mailbox_index import MailboxIndex
+
 log = pykolab.getLogger('pykolab.imap')
 conf = pykolab.getConf()
 
+# The number of seconds to wait in between attempts while waiting for a Cyrus
+# IMAP Murder to settle, doubling with every attempt up to the maximum.
+settle_interval = 0.1
+settle_max_interval = 2
+
+# The number of seconds to go without progress before reconnecting, while
+# waiting for a Cyrus IMAP Murder to settle.
+settle_reconnect_interval = 15
+
+
+def settle_backoff(timeout=None):
+    """
+        Yield the number of seconds to sleep in between attempts, with an
+        exponential backoff, until the timeout (the [imap] settle_timeout by
+        default) has passed.
+    """
+    if timeout is None:
+        timeout = (float)(conf.get('imap', 'settle_timeout'))
+
+    deadline = time.time() + timeout
+    delay = settle_interval
+
+    while True:
+        remaining = deadline - time.time()
+
+        if remaining <= 0:
+            return
+
+        yield min(delay, remaining)
+
+        delay = min(delay * 2, settle_max_interval)
+
+
+def uid_set(uids):
+    """
+        Compress a list of UIDs into an IMAP sequence set of ranges, such as
+        '1:3,5'.
+    """
+    ranges = []
+
+    for uid in sorted(set([int(x) for x in uids])):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ','.join([
+        '%d' % (x[0]) if x[0] == x[1] else '%d:%d' % (x[0], x[1]) for x in ranges
+    ])
+
+
+def parse_appenduid(data):
+    """
+        Return the UID of the message appended, from the APPENDUID response
+        code (RFC 4315) in the response data to an APPEND, or None if the
+        server did not say.
+    """
+    for item in data or []:
+        match = re.search(r"\[APPENDUID \d+ (\d+)\]", str(item))
+
+        if match is not None:
+            return match.group(1)
+
+    return None
+
+
+def parse_fetch_response(data):
+    """
+        Return the (uid, literal) pairs in the response to a UID FETCH of a
+        single body section.
+    """
+    result = []
+
+    for i, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+
+        match = re.search(r"\WUID (\d+)", item[0])
+
+        # The UID may come after the literal, too.
+        if match is None and i + 1 < len(data) and isinstance(data[i + 1], basestring):
+            match = re.search(r"\WUID (\d+)", ' ' + data[i + 1])
+
+        if match is None:
+            log.error(_("No UID found in IMAP response: %r") % (item[0]))
+            continue
+
+        result.append((match.group(1), item[1]))
+
+    return result
+
 
 class IMAP(object):
     def __init__(self):
@@ -42,6 +137,19 @@ class IMAP(object):
         # Place holder for the current IMAP connection
         self.imap = None
 
+        # The snapshot of the mailbox directory, if used
+        self._mailbox_index = None
+        self.mailbox_index_ttl = (int)(conf.get('imap', 'mailbox_index_ttl') or 0)
+
+        # How long waiting for folders to appear has taken, in total
+        self.settle_stats = {
+            'waits': 0,
+            'folders': 0,
+            'rounds': 0,
+            'seconds': 0.0,
+            'timeouts': 0
+        }
+
     def cleanup_acls(self, aci_subject):
         log.info(
             _("Cleaning up ACL entries for %s across all folders") % (
@@ -255,6 +363,7 @@ class IMAP(object):
                 )
 
     def create_folder(self, folder_path, server=None, partition=None):
+        folder_name = folder_path
         folder_path = self.folder_utf7(folder_path)
 
         if server is not None:
@@ -262,6 +371,10 @@ class IMAP(object):
 
             try:
                 self._imap[server].cm(folder_path, partition=partition)
+
+                if self._mailbox_index is not None:
+                    self._mailbox_index.add(folder_name, server)
+
                 return True
             except Exception:
                 log.error(_("Could not create folder %r on server %r") % (folder_path, server))
@@ -269,6 +382,10 @@ class IMAP(object):
         else:
             try:
                 self.imap.cm(folder_path, partition=partition)
+
+                if self._mailbox_index is not None:
+                    self._mailbox_index.add(folder_name)
+
                 return True
             except Exception:
                 log.error(_("Could not create folder %r") % (folder_path))
@@ -288,6 +405,50 @@ class IMAP(object):
     def append(self, folder, message):
         return self.imap.m.append(self.folder_utf7(folder), None, None, message)
 
+    def fetch_messages(self, uids, part=None, batch_size=100):
+        """
+            Fetch the messages with the given UIDs from the selected folder,
+            batch_size messages per round trip, and yield (uid, data) in the
+            order of the UIDs given.
+
+            The messages are fetched whole, or only the body section part
+            (such as '2' for the second MIME part), without setting the
+            \\Seen flag.
+        """
+        if part is None:
+            section = 'BODY.PEEK[]'
+        else:
+            section = 'BODY.PEEK[%s]' % (part)
+
+        uids = [str(x) for x in uids]
+
+        for i in range(0, len(uids), batch_size):
+            batch = uids[i:i + batch_size]
+
+            typ, data = self.imap.m.uid('FETCH', uid_set(batch), '(UID %s)' % (section))
+
+            if not typ == 'OK':
+                log.error(_("Could not fetch messages %s: %r") % (uid_set(batch), data))
+                continue
+
+            messages = dict(parse_fetch_response(data))
+
+            for uid in batch:
+                if uid in messages:
+                    yield (uid, messages[uid])
+
+    def message_deleted(self, uid):
+        """
+            Return whether the message with the given UID in the selected
+            folder has been flagged \\Deleted, or is gone altogether.
+        """
+        typ, data = self.imap.m.uid('FETCH', str(uid), '(FLAGS)')
+
+        if not typ == 'OK' or not data or data[0] is None:
+            return True
+
+        return '\\Deleted' in str(data[0])
+
     def folder_utf7(self, folder):
         from pykolab import imap_utf7
         return imap_utf7.encode(folder)
@@ -329,6 +490,58 @@ class IMAP(object):
         else:
             return False
 
+    def mailbox_index(self):
+        """
+            Return the snapshot of the mailbox directory, taking a new one if
+            it has expired, or None if no snapshot is to be used.
+        """
+        if not self.mailbox_index_ttl:
+            return None
+
+        if self._mailbox_index is None:
+            self._mailbox_index = MailboxIndex(
+                separator=self.get_separator(),
+                ttl=self.mailbox_index_ttl
+            )
+
+        if self._mailbox_index.expired():
+            start_time = time.time()
+
+            self._mailbox_index.load(self.list_folder_servers())
+
+            log.debug(
+                _("Listed %d mailboxes in %.2f seconds") % (
+                    len(self._mailbox_index),
+                    time.time() - start_time
+                ),
+                level=8
+            )
+
+        return self._mailbox_index
+
+    def list_folder_servers(self):
+        """
+            List all folders, with the server each is on. In a Cyrus IMAP
+            Murder, the servers are obtained with a single GETANNOTATION.
+        """
+        self.connect()
+
+        folders = dict([(x, None) for x in self.list_folders('*')])
+
+        if self.imap_murder():
+            if hasattr(self.imap, 'find_mailfolder_servers'):
+                for folder, server in self.imap.find_mailfolder_servers('*').items():
+                    folder = self.folder_utf8(folder)
+
+                    if folder in folders:
+                        folders[folder] = server
+
+        elif hasattr(self.imap, 'server'):
+            for folder in folders:
+                folders[folder] = self.imap.server
+
+        return folders
+
     def namespaces(self):
         """
             Obtain the namespaces.
@@ -482,6 +695,9 @@ class IMAP(object):
 
         self.imap._rename(old, new)
 
+        if self._mailbox_index is not None:
+            self._mailbox_index.rename(old, new)
+
     def shared_folder_set_type(self, folder_path, folder_type):
         folder_name = 'shared%s%s' % (self.get_separator(), folder_path)
 
@@ -630,16 +846,34 @@ class IMAP(object):
         else:
             server = None
 
+        def reconnect():
+            # Log in on behalf of the user again, so that the folder names
+            # relative to the user still match.
+            self.disconnect()
+            self.connect(login=False, server=server)
+            self.login_plain(admin_login, admin_password, user)
+
         success = False
         last_log = time.time()
+        attempts = settle_backoff()
         while not success:
             try:
-                self.disconnect()
-                self.connect(login=False, server=server)
-                self.login_plain(admin_login, admin_password, user)
+                reconnect()
                 (personal, other, shared) = self.namespaces()
                 success = True
             except Exception as errmsg:
+                delay = next(attempts, None)
+
+                if delay is None:
+                    log.error(
+                        _("Could not log in as %s to create additional folders: %r") % (
+                            user,
+                            errmsg
+                        )
+                    )
+
+                    return
+
                 if time.time() - last_log > 5 and self.imap_murder():
                     log.debug(_("Waiting for the Cyrus murder to settle... %r") % (errmsg))
                     last_log = time.time()
@@ -648,7 +882,11 @@ class IMAP(object):
                     import traceback
                     traceback.print_exc()
 
-                time.sleep(0.5)
+                time.sleep(delay)
+
+        # Create all folders first, and then wait for all of them to appear
+        # at once.
+        created = []
 
         for additional_folder in additional_folders:
             _add_folder = {}
@@ -660,27 +898,51 @@ class IMAP(object):
                 folder_name = "%s%s" % (personal, folder_name)
 
 
-            success = self._create_folder_waiting(folder_name)
+            success = self._create_folder_retrying(folder_name, reconnect=reconnect)
 
             if not success:
                 log.warning(_("Failed to create folder: %s") % (folder_name))
                 continue
 
-            if "annotations" in additional_folders[additional_folder]:
-                for annotation in additional_folders[additional_folder]["annotations"]:
-                    self.set_metadata(
-                            folder_name,
-                            "%s" % (annotation),
-                            "%s" % (additional_folders[additional_folder]["annotations"][annotation])
-                        )
+            created.append((additional_folder, folder_name))
 
-            if "acls" in additional_folders[additional_folder]:
-                for acl in additional_folders[additional_folder]["acls"]:
-                    self.set_acl(
-                            folder_name,
-                            "%s" % (acl),
-                            "%s" % (additional_folders[additional_folder]["acls"][acl])
-                        )
+        missing = []
+
+        if created and self.imap_murder():
+            missing = self.wait_for_folders(
+                    [x[1] for x in created],
+                    reconnect=reconnect
+                )
+
+        for additional_folder, folder_name in created:
+            # Folders that have not appeared in time yet are still set up,
+            # as far as the murder allows.
+            try:
+                if "annotations" in additional_folders[additional_folder]:
+                    for annotation in additional_folders[additional_folder]["annotations"]:
+                        self.set_metadata(
+                                folder_name,
+                                "%s" % (annotation),
+                                "%s" % (additional_folders[additional_folder]["annotations"][annotation])
+                            )
+
+                if "acls" in additional_folders[additional_folder]:
+                    for acl in additional_folders[additional_folder]["acls"]:
+                        self.set_acl(
+                                folder_name,
+                                "%s" % (acl),
+                                "%s" % (additional_folders[additional_folder]["acls"][acl])
+                            )
+            except Exception as errmsg:
+                if not folder_name in missing:
+                    raise
+
+                log.error(
+                    _("Could not set the annotations and ACLs on folder %s, which needs to be repaired manually: %r") % (
+                        folder_name,
+                        errmsg
+                    )
+                )
 
         if len(user.split('@')) > 1:
             localpart = user.split('@')[0]
@@ -774,39 +1036,37 @@ class IMAP(object):
         """
             Create a folder and wait to make sure it exists
         """
+        created = self._create_folder_retrying(folder_name, server)
+
+        # In a Cyrus IMAP Murder topology, wait for the murder to have settled
+        if created and self.imap_murder():
+            try:
+                self.wait_for_folders([folder_name])
+            except:
+                if conf.debuglevel > 8:
+                    import traceback
+                    traceback.print_exc()
+
+        return created
 
+    def _create_folder_retrying(self, folder_name, server=None, max_tries=10, reconnect=None):
+        """
+            Create a folder, reconnecting (with the reconnect callable, if
+            any) and trying again with a backoff if that fails.
+        """
         created = False
 
         try:
-            max_tries = 10
-            while not created and max_tries > 0:
-                created = self.create_folder(folder_name, server)
-                if not created:
-                    self.disconnect()
-                    max_tries -= 1
-                    time.sleep(1)
-                    self.connect()
+            created = self.create_folder(folder_name, server)
 
-            # In a Cyrus IMAP Murder topology, wait for the murder to have settled
-            if created and self.imap_murder():
-                success = False
-                last_log = time.time()
-                reconnect_counter = 0
-                while not success:
-                    success = self.has_folder(folder_name)
-                    if not success:
-                        if time.time() - last_log > 5:
-                            reconnect_counter += 1
-                            log.info(_("Waiting for the Cyrus IMAP Murder to settle..."))
-                            if reconnect_counter == 6:
-                                log.warning(_("Waited for 15 seconds, going to reconnect"))
-                                reconnect_counter = 0
-                                self.disconnect()
-                                self.connect()
-
-                            last_log = time.time()
-
-                        time.sleep(0.5)
+            for delay in itertools.islice(settle_backoff(), max_tries - 1):
+                if created:
+                    break
+
+                time.sleep(delay)
+                self._reconnect(reconnect)
+
+                created = self.create_folder(folder_name, server)
         except:
             if conf.debuglevel > 8:
                 import traceback
@@ -814,6 +1074,101 @@ class IMAP(object):
 
         return created
 
+    def _reconnect(self, reconnect=None):
+        """
+            Reconnect, with the reconnect callable if any, or as the
+            administrator otherwise.
+        """
+        if reconnect is not None:
+            reconnect()
+        else:
+            self.disconnect()
+            self.connect()
+
+    def wait_for_folders(self, folders, timeout=None, reconnect=None):
+        """
+            Wait for the folders to appear, as a Cyrus IMAP Murder settles,
+            with a single LIST for all of them in each round. Returns the
+            folders that have not appeared before the timeout.
+
+            The connection is re-established with the reconnect callable,
+            if any, so that folder names relative to a user still match.
+        """
+        pending = set(folders)
+
+        if not pending:
+            return []
+
+        # One pattern matching all folders
+        if len(pending) == 1:
+            pattern = list(pending)[0]
+        else:
+            pattern = '%s*' % (os.path.commonprefix(list(pending)))
+
+        start_time = time.time()
+        last_progress = start_time
+        rounds = 0
+
+        attempts = settle_backoff(timeout)
+
+        while True:
+            rounds += 1
+
+            listed = set([self.folder_utf8(x) for x in self.imap.lm(self.folder_utf7(pattern))])
+
+            if listed & pending:
+                pending -= listed
+                last_progress = time.time()
+
+            if not pending:
+                break
+
+            delay = next(attempts, None)
+
+            if delay is None:
+                break
+
+            if time.time() - last_progress > settle_reconnect_interval:
+                log.warning(
+                    _("Waited for %d seconds, going to reconnect") % (
+                        settle_reconnect_interval
+                    )
+                )
+
+                self._reconnect(reconnect)
+                last_progress = time.time()
+
+            time.sleep(delay)
+
+        waited = time.time() - start_time
+
+        self.settle_stats['waits'] += 1
+        self.settle_stats['folders'] += len(folders)
+        self.settle_stats['rounds'] += rounds
+        self.settle_stats['seconds'] += waited
+
+        if pending:
+            self.settle_stats['timeouts'] += 1
+
+            log.warning(
+                _("Gave up waiting for the Cyrus IMAP Murder to settle after %.2f seconds, missing: %s") % (
+                    waited,
+                    ', '.join(sorted(pending))
+                )
+            )
+
+        else:
+            log.debug(
+                _("Waited %.2f seconds in %d round(s) for %d folder(s) to appear") % (
+                    waited,
+                    rounds,
+                    len(folders)
+                ),
+                level=8
+            )
+
+        return sorted(pending)
+
     def user_mailbox_delete(self, mailbox_base_name):
         """
             Delete a user mailbox.
@@ -855,20 +1210,38 @@ class IMAP(object):
             log.info(_("Renaming INBOX from %s to %s") % (old_name, new_name))
             try:
                 self.imap.rename(old_name, new_name, partition)
+
+                if self._mailbox_index is not None:
+                    self._mailbox_index.rename(old_name, new_name)
             except:
                 log.error(_("Could not rename INBOX folder %s to %s") % (old_name, new_name))
         else:
             log.warning(_("Moving INBOX folder %s won't succeed as target folder %s already exists") % (old_name, new_name))
 
     def user_mailbox_server(self, mailbox):
-        server = self.imap.find_mailfolder_server(mailbox.lower()).lower()
+        index = self.mailbox_index()
+
+        if index is not None and index.server(mailbox.lower()) is not None:
+            server = index.server(mailbox.lower()).lower()
+        else:
+            server = self.imap.find_mailfolder_server(mailbox.lower()).lower()
+
         log.debug(_("Server for mailbox %r is %r") % (mailbox, server), level=8)
         return server
 
-    def has_folder(self, folder):
+    def has_folder(self, folder, cached=True):
         """
             Check if the environment has a folder named folder.
+
+            Uses the snapshot of the mailbox directory, if any, unless not
+            cached.
         """
+        if cached and '*' not in folder and '%' not in folder:
+            index = self.mailbox_index()
+
+            if index is not None:
+                return folder in index
+
         folders = self.imap.lm(self.folder_utf7(folder))
         log.debug(_("Looking for folder '%s', we found folders: %r") % (folder, [self.folder_utf8(x) for x in folders]), level=8)
         # Greater then one, this folder may have subfolders.
@@ -1179,6 +1552,9 @@ class IMAP(object):
 
         self.imap.dm(self.folder_utf7(mailfolder_path))
 
+        if self._mailbox_index is not None:
+            self._mailbox_index.remove(mailfolder_path)
+
     def get_quota(self, mailfolder_path):
         try:
             return self.lq(self.folder_utf7(mailfolder_path))
@@ -29,6 +29,7 @@ import pykolab
 
 from pykolab import constants
 from pykolab.imap import IMAP
+from pykolab.imap import settle_backoff
 from pykolab.translate import _
 
 log = pykolab.getLogger('pykolab.imap')
@@ -235,8 +236,8 @@ class Cyrus(cyruslib.CYRUS):
             if not self.mbox[mailfolder] == self.server:
                 return self.mbox[mailfolder]
 
-        max_tries = 20
         num_try = 0
+        attempts = settle_backoff()
 
         ann_path = "/vendor/cmu/cyrus-imapd/server"
         s_ann_path = "/shared%s" % (ann_path)
@@ -252,7 +253,9 @@ class Cyrus(cyruslib.CYRUS):
                 if s_ann_path in annotations[mailfolder]:
                     break
 
-            if max_tries <= num_try:
+            delay = next(attempts, None)
+
+            if delay is None:
                 log.error(
                         _("Could not get the annotations after %s tries.") % (
                                 num_try
@@ -274,7 +277,7 @@ class Cyrus(cyruslib.CYRUS):
                         )
                 )
 
-            time.sleep(1)
+            time.sleep(delay)
 
         server = annotations[mailfolder][s_ann_path]
         self.mbox[mailfolder] = server
@@ -289,6 +292,26 @@ class Cyrus(cyruslib.CYRUS):
 
         return server
 
+    def find_mailfolder_servers(self, pattern='*'):
+        """
+            Find the backend servers of all mail folders matching the pattern
+            at once, rather than one by one.
+        """
+        ann_path = "/vendor/cmu/cyrus-imapd/server"
+        s_ann_path = "/shared%s" % (ann_path)
+
+        annotations = self._getannotation('"%s"' % (pattern), ann_path)
+
+        servers = {}
+
+        for mailfolder in annotations:
+            if s_ann_path in annotations[mailfolder]:
+                servers[mailfolder] = annotations[mailfolder][s_ann_path]
+
+        self.mbox.update(servers)
+
+        return servers
+
     def folder_utf7(self, folder):
         from pykolab import imap_utf7
         return imap_utf7.encode(folder)
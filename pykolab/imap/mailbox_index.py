@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010-2019 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    A snapshot of the mailbox directory, as listed in one go, with the
+    backend server each mailbox lives on.
+
+    The mailboxes are held in a tree by their domain and hierarchy, so that
+    renaming or deleting a mailbox can take its sub-folders along.
+"""
+
+import time
+
+import pykolab
+
+# pylint: disable=invalid-name
+log = pykolab.getLogger('pykolab.imap')
+conf = pykolab.getConf()
+
+
+class MailboxIndex(object):
+    """
+        The mailboxes that exist, with the server they are on (or None if not
+        known), valid for ttl seconds after the snapshot has been loaded.
+
+        Each node in the tree is a dictionary of the child nodes by name,
+        below a node for the domain (if any) the folder is in, such as
+        'example.org' for 'user/john.doe/Calendar@example.org'. A node that
+        is a mailbox has the key None for its server.
+    """
+
+    def __init__(self, separator='/', ttl=300):
+        self.separator = separator
+        self.ttl = ttl
+        self.tree = {}
+        self.loaded = None
+
+    def __contains__(self, folder):
+        node = self._node(self._parts(folder))
+        return node is not None and None in node
+
+    def __len__(self):
+        return len(self.list())
+
+    def expired(self, now=None):
+        if self.loaded is None:
+            return True
+
+        if now is None:
+            now = time.time()
+
+        return now >= self.loaded + self.ttl
+
+    def load(self, folders, now=None):
+        """
+            Replace the snapshot with the folders, a dictionary of the folder
+            names and their server.
+        """
+        self.tree = {}
+
+        for folder, server in folders.items():
+            self.add(folder, server)
+
+        if now is None:
+            now = time.time()
+
+        self.loaded = now
+
+    def add(self, folder, server=None):
+        node = self.tree
+
+        for part in self._parts(folder):
+            node = node.setdefault(part, {})
+
+        node[None] = server
+
+    def remove(self, folder):
+        """
+            Remove a folder along with its sub-folders.
+        """
+        parts = self._parts(folder)
+        parent = self._node(parts[:-1])
+
+        if parent is not None:
+            parent.pop(parts[-1], None)
+
+    def rename(self, old, new):
+        """
+            Move a folder along with its sub-folders.
+        """
+        node = self._node(self._parts(old))
+
+        if node is None:
+            return
+
+        self.remove(old)
+
+        parts = self._parts(new)
+        parent = self.tree
+
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+
+        parent[parts[-1]] = node
+
+    def server(self, folder):
+        """
+            Return the server the folder is on, or None if not known.
+        """
+        node = self._node(self._parts(folder))
+
+        if node is None:
+            return None
+
+        return node.get(None)
+
+    def list(self, prefix=None):
+        """
+            Return the names of the folders below (and including) prefix.
+        """
+        if prefix is None:
+            parts = []
+        else:
+            parts = self._parts(prefix)
+
+        node = self._node(parts)
+
+        if node is None:
+            return []
+
+        result = []
+        stack = [(parts, node)]
+
+        while stack:
+            (parts, node) = stack.pop()
+
+            if None in node and len(parts) > 1:
+                result.append(self._name(parts))
+
+            for part, child in node.items():
+                if part is not None:
+                    stack.append((parts + [part], child))
+
+        return sorted(result)
+
+    def _parts(self, folder):
+        if '@' in folder:
+            (folder, domain) = folder.rsplit('@', 1)
+        else:
+            domain = ''
+
+        return [domain] + folder.split(self.separator)
+
+    def _name(self, parts):
+        if parts[0]:
+            return '%s@%s' % (self.separator.join(parts[1:]), parts[0])
+
+        return self.separator.join(parts[1:])
+
+    def _node(self, parts):
+        node = self.tree
+
+        for part in parts:
+            node = node.get(part)
+
+            if node is None:
+                return None
+
+        return node
@@ -1,8 +1,11 @@
+import calendar
+import datetime
 import re
 import traceback
 
 import icalendar
 import kolabformat
+import pytz
 
 import pykolab
 from pykolab.translate import _
@@ -186,95 +189,240 @@ def check_event_conflict(kolab_event, itip_event):
     if _is_transparent(itip_event['xml']):
         return conflict
 
-    _es = to_dt(kolab_event.get_start())
-    # use iCal style end date: next day for all-day events
-    _ee = to_dt(kolab_event.get_ical_dtend())
-
-    _is = to_dt(itip_event['start'])
-    _ie = to_dt(itip_event['end'])
-
-    # Escape looping through anything if neither of the events is recurring.
-    if not itip_event['xml'].is_recurring() and not kolab_event.is_recurring():
-        return check_date_conflict(_es, _ee, _is, _ie)
-
-    loop = 0
-
-    done = False
-
-    # naive loops to check for collisions in (recurring) events
-    # TODO: compare recurrence rules directly (e.g. matching time slot or weekday or monthday)
-    while not conflict and not done:
-        loop += 1
-
-        # Scroll forward the kolab event recurrence until we're in the prime
-        # spot. We choose to start with the Kolab event because that is likely
-        # the older one.
-        if _ee < _is:
-            while _ee < _is and _es is not None and kolab_event.is_recurring():
-                log.debug(
-                    "Attempt to move forward kolab event recurrence from {} closer to {}".format(
-                        _ee,
-                        _is
-                    ),
-                    level=8
-                )
-
-                __es = to_dt(kolab_event.get_next_occurence(_es))
-
-                if __es is not None and not __es == _es:
-                    _es = __es
-                    _ee = to_dt(kolab_event.get_occurence_end_date(_es))
-                else:
-                    done = True
-                    break
-
-        # Scroll forward the itip event recurrence until we're in the
-        # prime spot, this time with the iTip event.
-        elif _ie < _es:
-            while _ie < _es and _is is not None and itip_event['xml'].is_recurring():
-                log.debug(
-                    "Attempt to move forward itip event recurrence from {} closer to {}".format(
-                        _ie,
-                        _es
-                    ),
-                    level=8
-                )
-
-                __is = to_dt(itip_event['xml'].get_next_occurence(_is))
-
-                if __is is not None and not _is == __is:
-                    _is = __is
-                    _ie = to_dt(itip_event['xml'].get_occurence_end_date(_is))
-                else:
-                    done = True
-                    break
-
-        # Now that we have some events somewhere in the same neighborhood...
-        conflict = check_date_conflict(_es, _ee, _is, _ie)
-        log.debug(
-            "* Comparing itip at %s/%s with kolab at %s/%s: conflict - %r (occurence - %d)" % (
-                _is, _ie, _es, _ee, conflict, loop
-            ),
-            level=8
-        )
+    # The occurrences of the itip event are expanded once, and reused for
+    # every kolab event it is checked against.
+    if not itip_event.get('_occurrences', (None,))[0] is itip_event['xml']:
+        itip_event['_occurrences'] = (itip_event['xml'], event_intervals(itip_event['xml']))
 
-        if not conflict:
-            if kolab_event.is_recurring() and itip_event['xml'].is_recurring():
-                if not kolab_event.has_exceptions() and not itip_event['xml'].has_exceptions():
-                    log.debug("No conflict, both recurring, but neither with exceptions", level=8)
-                    done = True
-                    break
+    itip_intervals = itip_event['_occurrences'][1]
 
-            _is = to_dt(itip_event['xml'].get_next_occurence(_is))
+    if not itip_intervals:
+        return conflict
 
-            if _is is not None:
-                _ie = to_dt(itip_event['xml'].get_occurence_end_date(_is))
-            else:
-                done = True
+    # Only the occurrences of the kolab event while the itip event recurs
+    # are of interest.
+    kolab_intervals = event_intervals(
+        kolab_event,
+        itip_intervals[0][0],
+        max([end for (start, end) in itip_intervals])
+    )
+
+    conflict = intervals_conflict(kolab_intervals, itip_intervals)
+
+    log.debug(
+        "* Comparing %d occurrence(s) of itip %s with %d of kolab %s: conflict - %r" % (
+            len(itip_intervals),
+            itip_event['uid'],
+            len(kolab_intervals),
+            kolab_event.uid,
+            conflict
+        ),
+        level=8
+    )
 
     return conflict
 
 
+def check_event_conflicts(kolab_events, itip_event, first=False):
+    """
+        Return the kolab events that conflict with the given itip event, or
+        only the first one with first. The kolab events may be any iterable,
+        that is only consumed until the first conflict with first.
+    """
+    conflicts = []
+
+    for kolab_event in kolab_events:
+        if check_event_conflict(kolab_event, itip_event):
+            conflicts.append(kolab_event)
+
+            if first:
+                break
+
+    return conflicts
+
+
+def event_span(event):
+    """
+        Return the (start, end) UNIX timestamps spanning all occurrences of
+        the event, with None for an end that is open.
+    """
+    try:
+        start = to_dt(event.get_start())
+        end = to_dt(event.get_ical_dtend())
+
+        if event.is_recurring():
+            last = event.get_last_occurrence()
+
+            if last is None:
+                end = None
+            else:
+                last_end = event.get_occurence_end_date(last)
+
+                if last_end is None:
+                    last_end = to_dt(last) + (end - start)
+
+                end = max(end, to_dt(last_end))
+
+        # Exceptions may have been moved outside of the recurrence.
+        for exception in event.get_exceptions():
+            start = min(start, to_dt(exception.get_start()))
+
+            if end is not None:
+                end = max(end, to_dt(exception.get_ical_dtend()))
+
+    # pylint: disable=broad-except
+    except Exception as errmsg:
+        log.debug(_("Could not determine the span of event %r: %r") % (event.uid, errmsg), level=8)
+        return (None, None)
+
+    return (_timestamp(start), _timestamp(end) if end is not None else None)
+
+
+def event_intervals(event, window_start=None, window_end=None):
+    """
+        Return the sorted (start, end) UNIX timestamps of the occurrences of
+        the event that overlap with the window, with None for an open end.
+
+        Occurrences that have an exception are replaced by the exception,
+        and transparent or cancelled exceptions are left out.
+    """
+    intervals = {}
+
+    for (start, end) in _occurrences(event, window_start, window_end):
+        intervals[start] = (start, end)
+
+    exceptions = []
+
+    for exception in event.get_exceptions():
+        recurrence_id = exception.get_recurrence_id()
+
+        if recurrence_id is not None:
+            intervals.pop(_timestamp(to_dt(recurrence_id)), None)
+
+        if _is_transparent(exception):
+            continue
+
+        start = _timestamp(to_dt(exception.get_start()))
+        end = _timestamp(to_dt(exception.get_ical_dtend()))
+
+        if _in_window(start, end, window_start, window_end):
+            exceptions.append((start, end))
+
+    return sorted(intervals.values() + exceptions)
+
+
+def intervals_conflict(a, b):
+    """
+        Determine whether any of the sorted (start, end) intervals in a
+        conflicts with any in b, in a single sweep over both.
+    """
+    a = _merge_intervals(a)
+    b = _merge_intervals(b)
+
+    i = 0
+    j = 0
+
+    while i < len(a) and j < len(b):
+        if _conflict(a[i][0], a[i][1], b[j][0], b[j][1]):
+            return True
+
+        # Move on from the interval that ends first, as it can not conflict
+        # with anything further along the other.
+        if a[i][1] <= b[j][1]:
+            i += 1
+        else:
+            j += 1
+
+    return False
+
+
+def _conflict(_es, _ee, _is, _ie):
+    # Same as check_date_conflict()
+    if _es == _is:
+        return True
+
+    if _es < _is:
+        return _ee > _is
+
+    return _es < _ie
+
+
+def _in_window(start, end, window_start, window_end):
+    if window_end is not None and start >= window_end:
+        return False
+
+    if window_start is not None and end < window_start:
+        return False
+
+    return True
+
+
+def _merge_intervals(intervals):
+    # Occurrences moved by exceptions may overlap with each other, which the
+    # sweep in intervals_conflict() does not allow for.
+    result = []
+
+    for (start, end) in intervals:
+        if result and start < result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], end))
+        else:
+            result.append((start, end))
+
+    return result
+
+
+def _occurrences(event, window_start=None, window_end=None):
+    """
+        Yield the (start, end) UNIX timestamps of the occurrences of the
+        master event that overlap with the window.
+    """
+    start = to_dt(event.get_start())
+    # use iCal style end date: next day for all-day events
+    end = to_dt(event.get_ical_dtend())
+
+    if start is None or end is None:
+        return
+
+    duration = end - start
+
+    if not event.is_recurring():
+        if _in_window(_timestamp(start), _timestamp(end), window_start, window_end):
+            yield (_timestamp(start), _timestamp(end))
+
+        return
+
+    # Skip ahead to the window, rather than walk the recurrence from the
+    # start of the series.
+    if window_start is not None and _timestamp(end) < window_start:
+        after = datetime.datetime.fromtimestamp(window_start, pytz.utc) - duration
+
+        if not isinstance(event.get_start(), datetime.datetime):
+            after = after.date()
+
+        start = to_dt(event.get_next_occurence(after))
+
+    while start is not None:
+        _start = _timestamp(start)
+        _end = _timestamp(start + duration)
+
+        if window_end is not None and _start >= window_end:
+            break
+
+        if _in_window(_start, _end, window_start, window_end):
+            yield (_start, _end)
+
+        _next = to_dt(event.get_next_occurence(start))
+
+        if _next is None or _next <= start:
+            break
+
+        start = _next
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
 def _is_transparent(event):
     return event.get_transparency() or event.get_status() == kolabformat.StatusCancelled
 
@@ -17,6 +17,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import ast
+import re
+
 import pykolab
 
 from pykolab import utils
@@ -110,15 +113,12 @@ class KolabRecipientpolicy(object):
 
             user_attrs['preferredlanguage'] = default_locale
 
-        try:
-            exec("alternative_mail_routines = %s" % kw['secondary_mail'])
-        except Exception:
-            log.error(_("Could not parse the alternative mail routines"))
+        alternative_mail_routines = compile_policy(kw['secondary_mail'])
 
-        alternative_mail = []
+        if alternative_mail_routines is None:
+            return []
 
-        log.debug(_("Alternative mail routines: %r") % (alternative_mail_routines), level=8)
-        _domains = [ kw['primary_domain'] ] + kw['secondary_domains']
+        log.debug(_("Alternative mail routines: %r") % (kw['secondary_mail']), level=8)
 
         for attr in [ 'givenname', 'sn', 'surname' ]:
             try:
@@ -130,34 +130,223 @@ class KolabRecipientpolicy(object):
                     traceback.print_exc()
                 return []
 
-        for number in alternative_mail_routines:
-            for routine in alternative_mail_routines[number]:
+        key = (
+                kw['secondary_mail'],
+                kw['primary_domain'],
+                tuple(kw['secondary_domains']),
+                tuple([(x, repr(user_attrs.get(x))) for x in alternative_mail_routines['attributes']])
+            )
+
+        alternative_mail = secondary_mail_cache.get(key)
+
+        if alternative_mail is not None:
+            return list(alternative_mail)
+
+        alternative_mail = []
+
+        for routine in alternative_mail_routines['routines']:
+            try:
+                retval = routine(user_attrs)
+
+                log.debug(_("Appending additional mail address: %s") % (retval), level=8)
+                alternative_mail.append(retval)
+
+            except Exception as errmsg:
+                log.error(_("Policy for secondary email address failed: %r") % (errmsg))
+                if conf.debuglevel > 8:
+                    import traceback
+                    traceback.print_exc()
+                return []
+
+            for _domain in kw['secondary_domains']:
+                user_attrs['domain'] = _domain
                 try:
-                    exec("retval = '%s'.%s" % (routine,alternative_mail_routines[number][routine] % user_attrs))
+                    retval = routine(user_attrs)
 
                     log.debug(_("Appending additional mail address: %s") % (retval), level=8)
                     alternative_mail.append(retval)
 
-                except Exception as errmsg:
-                    log.error(_("Policy for secondary email address failed: %r") % (errmsg))
-                    if conf.debuglevel > 8:
-                        import traceback
-                        traceback.print_exc()
-                    return []
-
-                for _domain in kw['secondary_domains']:
-                    user_attrs['domain'] = _domain
-                    try:
-                        exec("retval = '%s'.%s" % (routine,alternative_mail_routines[number][routine] % user_attrs))
-
-                        log.debug(_("Appending additional mail address: %s") % (retval), level=8)
-                        alternative_mail.append(retval)
+                except KeyError:
+                    log.warning(_("Attribute substitution for 'alternative_mail' failed in Recipient Policy"))
 
-                    except KeyError:
-                        log.warning(_("Attribute substitution for 'alternative_mail' failed in Recipient Policy"))
+            user_attrs['domain'] = kw['primary_domain']
 
         alternative_mail = utils.normalize(alternative_mail)
 
         alternative_mail = list(set(alternative_mail))
 
-        return alternative_mail
+        secondary_mail_cache.set(key, alternative_mail)
+
+        return list(alternative_mail)
+
+    def set_secondary_mails(self, *args, **kw):
+        """
+            Like set_secondary_mail, for a list of entries rather than one
+            entry, compiling the policy only once.
+
+            Return a list of lists of secondary mail addresses, one for each
+            entry
+        """
+
+        entries = kw.pop('entries')
+
+        result = []
+
+        for entry in entries:
+            kw['entry'] = entry
+            result.append(self.set_secondary_mail(*args, **kw))
+
+        return result
+
+# The methods of the strings that routines may call.
+string_methods = [
+        'capitalize',
+        'center',
+        'format',
+        'join',
+        'ljust',
+        'lower',
+        'lstrip',
+        'replace',
+        'rjust',
+        'rsplit',
+        'rstrip',
+        'split',
+        'strip',
+        'swapcase',
+        'title',
+        'upper',
+        'zfill'
+    ]
+
+# The compiled policies, by the policy as configured.
+compiled_policies = {}
+
+# The secondary mail addresses composed before, by the policy, the domains
+# and the attribute values the policy uses.
+secondary_mail_cache = utils.LRUCache(size=10000)
+
+def compile_policy(policy):
+    """
+        Compile a policy for secondary mail addresses, such as:
+
+            {
+                0: {
+                        "{0}.{1}@{2}": "format('%(givenname)s'[0:1].capitalize(), '%(surname)s', '%(domain)s')"
+                    },
+                1: {
+                        "{0}@{1}": "format('%(uid)s', '%(domain)s')"
+                    }
+            }
+
+        into functions that return an address for the user attributes, each
+        calling the method chain on the template. The policy is not executed
+        as Python, only string literals, indexes, slices and string methods
+        are allowed.
+
+        Returns a dictionary with the routines in order, and the names of
+        the user attributes the routines substitute, or None if the policy
+        is not valid.
+    """
+
+    if policy in compiled_policies:
+        return compiled_policies[policy]
+
+    compiled = None
+
+    try:
+        routines = ast.literal_eval(policy.strip())
+
+        compiled = {
+                'routines': [],
+                'attributes': set()
+            }
+
+        for number in sorted(routines):
+            for template in routines[number]:
+                expression = ast.parse(
+                        '__template__.%s' % (routines[number][template]),
+                        mode='eval'
+                    )
+
+                compiled['routines'].append(
+                        _compile_node(expression.body, template, compiled['attributes'])
+                    )
+
+        compiled['attributes'] = sorted(compiled['attributes'])
+
+    except Exception as errmsg:
+        log.error(_("Could not parse the alternative mail routines: %r") % (errmsg))
+        compiled = None
+
+    compiled_policies[policy] = compiled
+
+    return compiled
+
+def _compile_node(node, template, attributes):
+    """
+        Return a function evaluating the expression node for the user
+        attributes.
+    """
+
+    if isinstance(node, ast.Name) and node.id == '__template__':
+        return lambda user_attrs: template
+
+    if isinstance(node, ast.Str):
+        value = node.s
+        attributes.update(re.findall(r'%\((\w+)\)', value))
+        return lambda user_attrs: value % user_attrs
+
+    if isinstance(node, ast.Num):
+        number = node.n
+        return lambda user_attrs: number
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        operand = _compile_node(node.operand, template, attributes)
+        return lambda user_attrs: -operand(user_attrs)
+
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = _compile_node(node.left, template, attributes)
+        right = _compile_node(node.right, template, attributes)
+        return lambda user_attrs: left(user_attrs) + right(user_attrs)
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        elts = [_compile_node(x, template, attributes) for x in node.elts]
+        return lambda user_attrs: [x(user_attrs) for x in elts]
+
+    if isinstance(node, ast.Subscript):
+        value = _compile_node(node.value, template, attributes)
+
+        if isinstance(node.slice, ast.Index):
+            index = _compile_node(node.slice.value, template, attributes)
+            return lambda user_attrs: value(user_attrs)[index(user_attrs)]
+
+        if isinstance(node.slice, ast.Slice):
+            bounds = []
+
+            for bound in [node.slice.lower, node.slice.upper, node.slice.step]:
+                if bound is None:
+                    bounds.append(lambda user_attrs: None)
+                else:
+                    bounds.append(_compile_node(bound, template, attributes))
+
+            return lambda user_attrs: value(user_attrs)[
+                    slice(*[x(user_attrs) for x in bounds])
+                ]
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        if node.func.attr not in string_methods:
+            raise ValueError("Method %r is not allowed" % (node.func.attr))
+
+        if node.keywords or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+            raise ValueError("Only positional arguments are allowed")
+
+        method = node.func.attr
+        value = _compile_node(node.func.value, template, attributes)
+        arguments = [_compile_node(x, template, attributes) for x in node.args]
+
+        return lambda user_attrs: getattr(value(user_attrs), method)(
+                *[x(user_attrs) for x in arguments]
+            )
+
+    raise ValueError("Expression %r is not allowed" % (ast.dump(node)))
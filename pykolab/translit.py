@@ -17,16 +17,63 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import unicodedata
+
 import pykolab
 from pykolab.translate import _
 
 log = pykolab.getLogger('pykolab.translit')
 
+# The transliteration to use by locale, or by language for all locales of the
+# language.
 locale_translit_map = {
+        'de': 'german',
         'ru_RU': 'cyrillic'
     }
 
+# Characters that have no decomposition to ASCII, transliterated the same way
+# for all locales, as iconv does.
+generic_translit_map = {
+        u'Æ': 'AE',
+        u'æ': 'ae',
+        u'Ð': 'D',
+        u'ð': 'd',
+        u'Đ': 'D',
+        u'đ': 'd',
+        u'Ħ': 'H',
+        u'ħ': 'h',
+        u'ı': 'i',
+        u'Ł': 'L',
+        u'ł': 'l',
+        u'Ø': 'O',
+        u'ø': 'o',
+        u'Œ': 'OE',
+        u'œ': 'oe',
+        u'ß': 'ss',
+        u'Þ': 'TH',
+        u'þ': 'th',
+        u'Ŧ': 'T',
+        u'ŧ': 't',
+        u'‘': "'",
+        u'’': "'",
+        u'‚': ',',
+        u'“': '"',
+        u'”': '"',
+        u'„': '"',
+        u'–': '-',
+        u'—': '-',
+        u'€': 'EUR',
+    }
+
 translit_map = {
+        'german': {
+                u'Ä': 'Ae',
+                u'ä': 'ae',
+                u'Ö': 'Oe',
+                u'ö': 'oe',
+                u'Ü': 'Ue',
+                u'ü': 'ue',
+            },
         'cyrillic': {
                 u'А': 'A',
                 u'а': 'a',
@@ -97,6 +144,78 @@ translit_map = {
             }
     }
 
+# The ASCII for the characters transliterated before, by transliteration.
+_ascii_cache = {}
+
+def translit_name(lang):
+    """
+        Return the name of the transliteration for a locale, such as 'ru_RU'
+        or 'de_AT.UTF-8', or None.
+    """
+    if lang is None:
+        return None
+
+    lang = lang.split('.')[0].split('@')[0]
+
+    if lang in locale_translit_map:
+        return locale_translit_map[lang]
+
+    if lang.split('_')[0] in locale_translit_map:
+        return locale_translit_map[lang.split('_')[0]]
+
+    return None
+
+def to_ascii(_input, lang):
+    """
+        Transliterate _input to ASCII for the locale lang, with the
+        transliteration for the locale (if any), or the decomposition of
+        each character.
+
+        Characters that can not be transliterated are retained, in which
+        case the result is a unicode string.
+    """
+    if not isinstance(_input, unicode):
+        _input = _input.decode('utf-8')
+
+    _translit_name = translit_name(lang)
+    _map = translit_map.get(_translit_name, {})
+    _cache = _ascii_cache.setdefault(_translit_name, {})
+
+    _output = []
+
+    for char in _input:
+        if char < u'\x80':
+            _output.append(char)
+            continue
+
+        if char not in _cache:
+            if char in _map:
+                _cache[char] = _map[char]
+            elif char in generic_translit_map:
+                _cache[char] = generic_translit_map[char]
+            elif unicodedata.combining(char):
+                _cache[char] = ''
+            else:
+                _ascii = [x for x in unicodedata.normalize('NFKD', char) if x < u'\x80']
+
+                if _ascii:
+                    _cache[char] = ''.join(_ascii)
+                else:
+                    _cache[char] = None
+
+        if _cache[char] is None:
+            _output.append(char)
+        else:
+            _output.append(_cache[char])
+
+    _output = u''.join(_output)
+
+    try:
+        return _output.encode('ascii')
+    except UnicodeEncodeError:
+        log.warning(_("Could not transliterate %r using locale %s") % (_input, lang))
+        return _output
+
 def transliterate(_input, lang, _output_expected=None):
     if lang in locale_translit_map:
         _translit_name = locale_translit_map[lang]
@@ -20,6 +20,7 @@
 from __future__ import print_function
 
 import base64
+from collections import OrderedDict
 import getpass
 import grp
 import os
@@ -27,6 +28,8 @@ import pwd
 from six import string_types
 import struct
 import sys
+import threading
+import time
 
 import pykolab
 from pykolab import constants
@@ -546,46 +549,22 @@ def standard_root_dn(domain):
 
 
 def translate(mystring, locale_name='en_US'):
-    import locale
-    import subprocess
-
-    log.debug(_l("Transliterating string %r with locale %r") % (mystring, locale_name), level=8)
-
-    if len(locale.normalize(locale_name).split('.')) > 1:
-        (locale_name, locale_charset) = locale.normalize(locale_name).split('.')
-    else:
-        locale_charset = 'utf-8'
-
-    try:
-        log.debug(_l("Attempting to set locale"), level=8)
-        locale.setlocale(locale.LC_ALL, (locale_name, locale_charset))
-        log.debug(_l("Success setting locale"), level=8)
-    except Exception:
-        log.debug(_l("Failure to set locale"), level=8)
-
-    command = ['/usr/bin/iconv', '-f', 'UTF-8', '-t', 'ASCII//TRANSLIT', '-s']
+    """
+        Transliterate mystring to ASCII for the locale, such as for use in an
+        email address.
+    """
+    key = (mystring, locale_name)
 
-    log.debug(_l("Executing '%s | %s'") % (r"%s" % (mystring), ' '.join(command)), level=8)
+    result = translate_cache.get(key)
 
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stdin=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        env={'LANG': locale.normalize(locale_name)}
-    )
+    if result is None:
+        from pykolab import translit
 
-    try:
-        print(r"%s" % (mystring), file=process.stdin)
-    except UnicodeEncodeError:
-        pass
+        log.debug(_l("Transliterating string %r with locale %r") % (mystring, locale_name), level=8)
 
-    result = process.communicate()[0].strip()
+        result = translit.to_ascii(mystring, locale_name).strip()
 
-    if '?' in result or (result == '' and not mystring == ''):
-        log.warning(_l("Could not translate %s using locale %s") % (mystring, locale_name))
-        from pykolab import translit
-        result = translit.transliterate(mystring, locale_name)
+        translate_cache.set(key, result)
 
     return result
 
@@ -633,3 +612,66 @@ def is_service(services):
                 _other_services.append(service)
 
     return (_service, _other_services)
+
+
+class LRUCache(object):
+    """
+        A thread-safe mapping bounded in size, that discards the least
+        recently used items first. Items expire ttl seconds after they have
+        been set, and are removed lazily when they are next accessed.
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+
+            (value, expires) = self.items.pop(key)
+
+            if expires is not None and expires < time.time():
+                return default
+
+            # Move the item to the most recently used end.
+            self.items[key] = (value, expires)
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, expires)
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+# The strings transliterated before, by (string, locale).
+translate_cache = LRUCache(size=10000)
@@ -1,3 +1,4 @@
+import bisect
 import datetime
 import icalendar
 import kolabformat
@@ -23,6 +24,9 @@ from collections import OrderedDict
 
 log = pykolab.getLogger('pykolab.xml_event')
 
+# the number of occurrences of a recurring event to hold on to
+max_cached_occurrences = 1000
+
 
 def event_from_ical(ical, string=None):
     return Event(from_ical=ical, from_string=string)
@@ -169,6 +173,7 @@ class Event(object):
             raise InvalidEventDateError(_("Rdate needs datetime.date or datetime.datetime instance, got %r") % (type(_datetime)))
 
         self.event.addRecurrenceDate(xmlutils.to_cdatetime(_datetime, True))
+        self._reset_occurrences()
 
     def add_exception_date(self, _datetime):
         valid_datetime = False
@@ -186,6 +191,7 @@ class Event(object):
             raise InvalidEventDateError(_("Exdate needs datetime.date or datetime.datetime instance, got %r") % (type(_datetime)))
 
         self.event.addExceptionDate(xmlutils.to_cdatetime(_datetime, True))
+        self._reset_occurrences()
 
     def add_exception(self, exception):
         recurrence_id = exception.get_recurrence_id()
@@ -214,6 +220,7 @@ class Event(object):
             self._exceptions.append(exception)
 
         self.event.setExceptions(vexceptions)
+        self._reset_occurrences()
 
     def del_exception(self, exception):
         recurrence_id = exception.get_recurrence_id()
@@ -230,6 +237,7 @@ class Event(object):
 
         if updated:
             self.event.setExceptions(vexceptions)
+            self._reset_occurrences()
 
 
     def as_string_itip(self, method="REQUEST"):
@@ -853,6 +861,7 @@ class Event(object):
             raise InvalidEventDateError(_("Event end needs datetime.date or datetime.datetime instance, got %r") % (type(_datetime)))
 
         self.event.setEnd(xmlutils.to_cdatetime(_datetime, True))
+        self._reset_occurrences()
 
     def set_exception_dates(self, _datetimes):
         for _datetime in _datetimes:
@@ -1042,10 +1051,7 @@ class Event(object):
 
     def set_recurrence(self, recurrence):
         self.event.setRecurrenceRule(recurrence)
-
-        # reset eventcal instance
-        if hasattr(self, 'eventcal'):
-            del self.eventcal
+        self._reset_occurrences()
 
     def set_start(self, _datetime):
         valid_datetime = False
@@ -1063,6 +1069,7 @@ class Event(object):
             raise InvalidEventDateError(_("Event start needs datetime.date or datetime.datetime instance, got %r") % (type(_datetime)))
 
         self.event.setStart(xmlutils.to_cdatetime(_datetime, True))
+        self._reset_occurrences()
 
     def set_status(self, status):
         if status in self.status_map:
@@ -1365,6 +1372,14 @@ class Event(object):
 
         return msg
 
+    def _reset_occurrences(self):
+        """
+            Forget about the occurrences, after the recurrence has changed.
+        """
+        for attr in ['eventcal', '_last_occurrence', '_recurrence_end_date', '_occurrence_keys']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
     def is_recurring(self):
         return self.event.recurrenceRule().isValid() or len(self.get_recurrence_dates()) > 0
 
@@ -1372,7 +1387,57 @@ class Event(object):
         from kolab.calendaring import EventCal
         return EventCal(self.event)
 
+    def iter_occurrences(self):
+        """
+            Yield the start of each occurrence of the event in turn, up to
+            the last occurrence or a reasonable end for infinite recurrence.
+        """
+        start = self.get_start()
+
+        while start is not None:
+            yield start
+            start = self.get_next_occurence(start)
+
     def get_next_occurence(self, _datetime):
+        """
+            Return the start of the first occurrence after _datetime.
+
+            The occurrences from the start of the event onwards are held on
+            to as they are expanded, so that walking through the occurrences
+            of a recurring event again does not need to ask libkolab.
+        """
+        if not hasattr(self, '_occurrence_keys'):
+            start = self.get_start()
+            self._occurrence_keys = [xmlutils.to_dt(start)] if start is not None else []
+            self._occurrences = [start] if start is not None else []
+            self._occurrences_complete = False
+
+        keys = self._occurrence_keys
+
+        if not keys or xmlutils.to_dt(_datetime) < keys[0]:
+            return self._next_occurrence(_datetime)
+
+        i = bisect.bisect_right(keys, xmlutils.to_dt(_datetime))
+
+        if i < len(keys):
+            return self._occurrences[i]
+
+        if self._occurrences_complete:
+            return None
+
+        next_datetime = self._next_occurrence(_datetime)
+
+        # extend the occurrences held on to when walking past the last one
+        if xmlutils.to_dt(_datetime) == keys[-1]:
+            if next_datetime is None:
+                self._occurrences_complete = True
+            elif len(keys) < max_cached_occurrences and xmlutils.to_dt(next_datetime) > keys[-1]:
+                keys.append(xmlutils.to_dt(next_datetime))
+                self._occurrences.append(next_datetime)
+
+        return next_datetime
+
+    def _next_occurrence(self, _datetime):
         if not hasattr(self, 'eventcal'):
             self.eventcal = self.to_event_cal()
 
@@ -1400,11 +1465,14 @@ class Event(object):
         return xmlutils.from_cdatetime(end_cdatetime, True) if end_cdatetime is not None else None
 
     def get_last_occurrence(self, force=False):
-        if not hasattr(self, 'eventcal'):
-            self.eventcal = self.to_event_cal()
+        if not hasattr(self, '_last_occurrence'):
+            if not hasattr(self, 'eventcal'):
+                self.eventcal = self.to_event_cal()
+
+            last = self.eventcal.getLastOccurrence()
+            self._last_occurrence = xmlutils.from_cdatetime(last, True) if last is not None else None
 
-        last = self.eventcal.getLastOccurrence()
-        last_datetime = xmlutils.from_cdatetime(last, True) if last is not None else None
+        last_datetime = self._last_occurrence
 
         # we're forced to return some date
         if last_datetime is None and force:
@@ -1415,40 +1483,48 @@ class Event(object):
     def get_next_instance(self, datetime):
         next_start = self.get_next_occurence(datetime)
         if next_start:
-            instance = Event(from_string=str(self))
-            instance.set_start(next_start)
-            instance.event.setRecurrenceID(xmlutils.to_cdatetime(next_start), False)
-            next_end = self.get_occurence_end_date(next_start)
-            if next_end:
-                instance.set_end(next_end)
-
-            # unset recurrence rule and exceptions
-            instance.set_recurrence(kolabformat.RecurrenceRule())
-            instance.event.setExceptions(kolabformat.vectorevent())
-            instance.event.setExceptionDates(kolabformat.vectordatetime())
-            instance._exceptions = []
-            instance._isexception = False
-
-            # unset attachments list (only stored in main event)
-            instance.event.setAttachments(kolabformat.vectorattachment())
-
-            # copy data from matching exception
-            # (give precedence to single occurrence exceptions over thisandfuture)
-            for exception in self._exceptions:
-                recurrence_id = exception.get_recurrence_id()
-                if recurrence_id == next_start and (not exception.thisandfuture or not instance._isexception):
-                    instance = exception
-                    instance._isexception = True
-                    if not exception.thisandfuture:
-                        break
-                elif exception.thisandfuture and next_start > recurrence_id:
-                    # TODO: merge exception properties over this instance + adjust start/end with the according offset
-                    pass
-
-            return instance
+            return self._get_instance(next_start)
 
         return None
 
+    def _get_instance(self, next_start):
+        # copy the event without a round trip through its XML
+        instance = Event()
+        instance.event = kolabformat.Event(self.event)
+        instance.uid = self.uid
+        instance._load_attendees()
+
+        instance.set_start(next_start)
+        instance.event.setRecurrenceID(xmlutils.to_cdatetime(next_start), False)
+        next_end = self.get_occurence_end_date(next_start)
+        if next_end:
+            instance.set_end(next_end)
+
+        # unset recurrence rule and exceptions
+        instance.set_recurrence(kolabformat.RecurrenceRule())
+        instance.event.setExceptions(kolabformat.vectorevent())
+        instance.event.setExceptionDates(kolabformat.vectordatetime())
+        instance._exceptions = []
+        instance._isexception = False
+
+        # unset attachments list (only stored in main event)
+        instance.event.setAttachments(kolabformat.vectorattachment())
+
+        # copy data from matching exception
+        # (give precedence to single occurrence exceptions over thisandfuture)
+        for exception in self._exceptions:
+            recurrence_id = exception.get_recurrence_id()
+            if recurrence_id == next_start and (not exception.thisandfuture or not instance._isexception):
+                instance = exception
+                instance._isexception = True
+                if not exception.thisandfuture:
+                    break
+            elif exception.thisandfuture and next_start > recurrence_id:
+                # TODO: merge exception properties over this instance + adjust start/end with the according offset
+                pass
+
+        return instance
+
     def get_instance(self, _datetime):
         # If no timezone information is given, use the one from event start
         if isinstance(_datetime, datetime.datetime) and _datetime.tzinfo == None:
@@ -1457,13 +1533,13 @@ class Event(object):
                 _datetime = _datetime.replace(tzinfo=_start.tzinfo)
 
         if self.is_recurring():
-            instance = self.get_next_instance(_datetime - datetime.timedelta(days=1))
-            while instance:
-                recurrence_id = instance.get_recurrence_id()
-                if type(recurrence_id) == type(_datetime) and recurrence_id <= _datetime:
-                    if xmlutils.dates_equal(recurrence_id, _datetime):
-                        return instance
-                    instance = self.get_next_instance(instance.get_start())
+            # find the occurrence first, and only then make an instance of it
+            next_start = self.get_next_occurence(_datetime - datetime.timedelta(days=1))
+            while next_start:
+                if type(next_start) == type(_datetime) and next_start <= _datetime:
+                    if xmlutils.dates_equal(next_start, _datetime):
+                        return self._get_instance(next_start)
+                    next_start = self.get_next_occurence(next_start)
                 else:
                     break
 
@@ -1484,6 +1560,12 @@ class Event(object):
         """
             Determine a reasonable end date for infinitely recurring events
         """
+        if not hasattr(self, '_recurrence_end_date'):
+            self._recurrence_end_date = self._get_recurrence_end()
+
+        return self._recurrence_end_date
+
+    def _get_recurrence_end(self):
         rrule = self.event.recurrenceRule()
         if rrule.isValid() and rrule.count() < 0 and not rrule.end().isValid():
             now = datetime.datetime.now()
@@ -29,11 +29,14 @@ from __future__ import print_function
 from optparse import OptionParser
 from ConfigParser import SafeConfigParser
 
+import errno
 import grp
 import os
 import pwd
+import Queue
 import shutil
 import sys
+import threading
 import time
 import traceback
 
@@ -98,6 +101,24 @@ class SASLAuthDaemon(object):
                 metavar = "GROUPNAME"
             )
 
+        daemon_group.add_option(
+                "--threads",
+                dest    = "max_threads",
+                action  = "store",
+                default = 4,
+                type    = int,
+                help    = _("Number of threads to handle requests with.")
+            )
+
+        daemon_group.add_option(
+                "--backlog",
+                dest    = "listen_backlog",
+                action  = "store",
+                default = 128,
+                type    = int,
+                help    = _("Maximum number of pending connections on the socket.")
+            )
+
         conf.finalize_conf()
 
         try:
@@ -112,6 +133,15 @@ class SASLAuthDaemon(object):
 
         self.thread_count = 0
 
+        # Accepted client sockets pending authentication by a worker thread.
+        self.queue = Queue.Queue()
+
+        # Reentrant, for the SIGUSR1 handler may interrupt the main thread
+        # with the lock held.
+        self.stats_lock = threading.RLock()
+        self.in_flight = 0
+        self.handled = 0
+
     def run(self):
         """
             Run the SASL authentication daemon.
@@ -190,12 +220,13 @@ class SASLAuthDaemon(object):
         """
             Create the actual listener socket, and handle the authentication.
 
-            The actual authentication handling is passed on to the appropriate
-            backend authentication classes through the more generic Auth().
+            Accepted connections are queued for a pool of worker threads, each
+            of which holds on to one authentication backend connection per
+            realm. The actual authentication handling is passed on to the
+            appropriate backend authentication classes through the more generic
+            Auth().
         """
-        import binascii
         import socket
-        import struct
 
         s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
@@ -209,7 +240,16 @@ class SASLAuthDaemon(object):
         s.bind(conf.socketfile)
         os.chmod(conf.socketfile, 0o777)
 
-        s.listen(5)
+        s.listen(conf.listen_backlog)
+
+        for num in range(max(1, conf.max_threads)):
+            worker = threading.Thread(
+                    target=self.worker_thread,
+                    name="Worker-%d" % (num + 1)
+                )
+
+            worker.daemon = True
+            worker.start()
 
         while 1:
             max_tries = 20
@@ -221,6 +261,11 @@ class SASLAuthDaemon(object):
                     (clientsocket, address) = s.accept()
                     bound = True
                 except Exception as errmsg:
+                    # Interrupted by a signal, such as SIGUSR1
+                    if isinstance(errmsg, socket.error) and errmsg.errno == errno.EINTR:
+                        cur_tries -= 1
+                        continue
+
                     log.error(
                             _("kolab-saslauthd could not accept " +
                               "connections on socket: %r") % (errmsg)
@@ -232,6 +277,49 @@ class SASLAuthDaemon(object):
 
                     time.sleep(1)
 
+            self.queue.put(clientsocket)
+
+            if conf.debuglevel > 8:
+                log.debug(
+                        _("Queued request, %(queued)d queued, %(in_flight)d in flight") % (
+                                self.get_stats()
+                            ),
+                        level=9
+                    )
+
+    def worker_thread(self):
+        """
+            Handle queued client connections, re-using the connection to the
+            authentication backend for a realm across requests.
+        """
+        # The realms are supplied by the clients, so only the connections
+        # for the ones used most recently are kept.
+        auths = utils.LRUCache(size=100)
+
+        while 1:
+            clientsocket = self.queue.get()
+
+            with self.stats_lock:
+                self.in_flight += 1
+
+            try:
+                self.handle_request(clientsocket, auths)
+            except Exception as errmsg:
+                log.error(_("Unhandled error in authentication request: %r") % (errmsg))
+                log.error(traceback.format_exc())
+            finally:
+                with self.stats_lock:
+                    self.in_flight -= 1
+                    self.handled += 1
+
+    def handle_request(self, clientsocket, auths):
+        """
+            Read the login from the client socket, authenticate it and send
+            back the verdict.
+        """
+        import struct
+
+        try:
             received = clientsocket.recv(4096)
 
             login = []
@@ -255,7 +343,12 @@ class SASLAuthDaemon(object):
             else:
                 realm = conf.get('kolab', 'primary_domain')
 
-            auth = Auth(domain=realm)
+            auth = auths.get(realm)
+
+            if auth is None:
+                auth = Auth(domain=realm, keepalive=True)
+                auths.set(realm, auth)
+
             auth.connect()
 
             success = False
@@ -264,6 +357,8 @@ class SASLAuthDaemon(object):
                 success = auth.authenticate(login)
             except:
                 success = False
+                # Start from a fresh connection for the next request.
+                auth.disconnect()
 
             if success:
                 # #1170: Catch broken pipe error (incomplete authentication request)
@@ -278,8 +373,27 @@ class SASLAuthDaemon(object):
                 except:
                     pass
 
+        finally:
             clientsocket.close()
-            auth.disconnect()
+
+    def get_stats(self):
+        """
+            Return the number of requests currently being handled, waiting
+            in the queue and handled in total.
+        """
+        with self.stats_lock:
+            return {
+                    'in_flight': self.in_flight,
+                    'queued': self.queue.qsize(),
+                    'handled': self.handled
+                }
+
+    def log_stats(self, *args, **kw):
+        log.info(
+                _("Requests in flight: %(in_flight)d, queued: %(queued)d, handled: %(handled)d") % (
+                        self.get_stats()
+                    )
+            )
 
     def reload_config(self, *args, **kw):
         pass
@@ -293,6 +407,7 @@ class SASLAuthDaemon(object):
         import signal
         signal.signal(signal.SIGHUP, self.reload_config)
         signal.signal(signal.SIGTERM, self.remove_pid)
+        signal.signal(signal.SIGUSR1, self.log_stats)
 
     def write_pid(self):
         pid = os.getpid()
@@ -687,6 +687,38 @@ END:VEVENT
         self.assertEqual(next_date.year, 2015)
         self.assertEqual(next_date.month, 5)
 
+    def test_020_iter_occurrences(self):
+        rrule = kolabformat.RecurrenceRule()
+        rrule.setFrequency(kolabformat.RecurrenceRule.Weekly)
+        rrule.setCount(5)
+
+        self.event = Event()
+        self.event.set_summary('weekly')
+        self.event.set_recurrence(rrule)
+
+        _start = datetime.datetime(2014, 5, 1, 11, 30, 00, tzinfo=pytz.utc)
+        self.event.set_start(_start)
+        self.event.set_end(_start + datetime.timedelta(hours=1))
+
+        occurrences = list(self.event.iter_occurrences())
+        self.assertEqual(len(occurrences), 5)
+        self.assertEqual(occurrences[0], _start)
+        self.assertEqual(occurrences[4], _start + datetime.timedelta(weeks=4))
+
+        # the occurrences are walked through again from what has been expanded
+        self.assertEqual(list(self.event.iter_occurrences()), occurrences)
+        self.assertEqual(self.event.get_next_occurence(_start + datetime.timedelta(days=8)), occurrences[2])
+
+        instance = self.event.get_instance(occurrences[3])
+        self.assertEqual(instance.get_start(), occurrences[3])
+        self.assertEqual(instance.get_summary(), 'weekly')
+        self.assertFalse(instance.is_recurring())
+
+        # moving the event forgets about the previous occurrences
+        self.event.set_start(_start + datetime.timedelta(days=1))
+        self.event.set_end(_start + datetime.timedelta(days=1, hours=1))
+        self.assertEqual(list(self.event.iter_occurrences())[1], occurrences[1] + datetime.timedelta(days=1))
+
     def test_021_calendaring_no_recurrence(self):
         _start = datetime.datetime(2014, 2, 1, 14, 30, 00, tzinfo=pytz.timezone("Europe/London"))
         self.event = Event()
@@ -100,7 +100,34 @@ class TestTransliteration(unittest.TestCase):
         self.assertEqual('Yuliya', utils.translate(givenname, preferredlanguage))
         self.assertEqual('Yolkina', utils.translate(surname, preferredlanguage))
 
-    def test_009_raw_decode(self):
+    def test_009_de_DE(self):
+        from pykolab import utils
+
+        self.assertEqual('Juergen', utils.translate('Jürgen', 'de_DE'))
+        self.assertEqual('Juergen', utils.translate('Jürgen', 'de_AT.UTF-8'))
+        self.assertEqual('Jurgen', utils.translate('Jürgen', 'en_US'))
+        self.assertEqual('Strasse', utils.translate(u'Straße', 'de_DE'))
+
+    def test_010_decomposition(self):
+        from pykolab import utils
+
+        self.assertEqual('Soren Kierkegaard', utils.translate(u'Søren Kierkegaard', 'da_DK'))
+        self.assertEqual('Lech Walesa', utils.translate(u'Lech Wałęsa', 'pl_PL'))
+        self.assertEqual('Noel', utils.translate(u'Noe\u0308l', 'fr_FR'))
+
+    def test_011_untranslatable(self):
+        from pykolab import utils
+
+        self.assertEqual(u'李 Wei', utils.translate(u'李 Wei', 'en_US'))
+
+    def test_012_cache(self):
+        from pykolab import utils
+
+        utils.translate(u'Ёлкина', 'ru_RU')
+
+        self.assertEqual(utils.translate_cache.get((u'Ёлкина', 'ru_RU')), 'Yolkina')
+
+    def test_013_raw_decode(self):
         raw_str = r"Николай"
         self.assertEqual('Николай', raw_str.decode("string_escape"))
 
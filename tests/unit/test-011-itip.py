@@ -408,6 +408,21 @@ class TestITip(unittest.TestCase):
         bend = datetime.datetime(2014, 7, 14, 14, 0, 0)
         self.assertTrue(itip.check_date_conflict(astart, aend, bstart, bend))
 
+    def test_002_intervals_conflict(self):
+        self.assertTrue(itip.intervals_conflict([(0, 10)], [(5, 15)]))
+        self.assertFalse(itip.intervals_conflict([(0, 10)], [(10, 15)]))
+        self.assertTrue(itip.intervals_conflict([(5, 5)], [(5, 15)]))
+
+        daily = [(x * 86400, x * 86400 + 3600) for x in range(365)]
+        weekly = [(x * 7 * 86400 + 7200, x * 7 * 86400 + 10800) for x in range(52)]
+        self.assertFalse(itip.intervals_conflict(daily, weekly))
+
+        weekly.append((200 * 86400 + 1800, 200 * 86400 + 2000))
+        self.assertTrue(itip.intervals_conflict(daily, sorted(weekly)))
+
+        # Overlapping intervals, as with moved occurrences
+        self.assertTrue(itip.intervals_conflict([(0, 30), (10, 11)], [(25, 26)]))
+
     def test_002_check_event_conflict(self):
         itip_event = itip.events_from_message(message_from_string(itip_non_multipart))[0]
 
@@ -177,3 +177,291 @@ class TestWallaceInvitationpolicy(unittest.TestCase):
         self.assertEqual(len(self.smtplog), 1)
         self.assertIn("Subject: =?utf-8?", self.smtplog[0][2])
         self.assertIn("The event 'with =C3=A4=C3=B6=C3=BC' at", self.smtplog[0][2])
+
+    def test_007_user_sessions(self):
+        class MockIMAP(object):
+            logins = 0
+
+            def __init__(self):
+                self.imap = self
+                self.m = self
+
+            def connect(self, login=True):
+                pass
+
+            def login_plain(self, admin_login, admin_password, login):
+                MockIMAP.logins += 1
+
+            def noop(self):
+                pass
+
+            def disconnect(self):
+                pass
+
+        _IMAP = MIP.IMAP
+        MIP.IMAP = MockIMAP
+
+        try:
+            user = {'mail': 'jane.doe@example.org'}
+
+            self.assertTrue(MIP.imap_proxy_auth(user))
+            self.assertTrue(MIP.imap_proxy_auth(user))
+            self.assertEqual(MockIMAP.logins, 1)
+
+            # idle sessions are dropped
+            MIP.imap_sessions['jane.doe@example.org']['used'] -= MIP.session_idle + 1
+            self.assertTrue(MIP.imap_proxy_auth(user))
+            self.assertEqual(MockIMAP.logins, 2)
+            self.assertEqual(len(MIP.imap_sessions), 1)
+
+        finally:
+            MIP.IMAP = _IMAP
+            MIP.imap_sessions.clear()
+
+    def _mock_user_imap(self, mailboxes):
+        """
+            An IMAP class with a session per user, each holding the user's
+            mailboxes, by login and folder, as (UIDVALIDITY, {UID: event UID}).
+        """
+        class MockEvent(object):
+            def __init__(self, uid):
+                self.uid = uid
+
+        class MockIMAP(object):
+            def __init__(self):
+                self.imap = self
+                self.m = self
+                self.login = None
+                self.selected = None
+
+            def connect(self, login=True):
+                pass
+
+            def login_plain(self, admin_login, admin_password, login):
+                self.login = login
+
+            def noop(self):
+                pass
+
+            def disconnect(self):
+                pass
+
+            def folder_utf7(self, folder):
+                return folder
+
+            def select(self, folder):
+                self.selected = mailboxes[self.login].get(folder)
+
+                if self.selected is None:
+                    return ('NO', [None])
+
+                return ('OK', [str(len(self.selected[1]))])
+
+            def response(self, name):
+                return (name, [self.selected[0]])
+
+            def uid(self, command, *args):
+                return ('OK', [' '.join(sorted(self.selected[1]))])
+
+            def fetch_messages(self, uids):
+                return [(x, self.selected[1][x]) for x in uids]
+
+            def message_deleted(self, uid):
+                return uid not in self.selected[1]
+
+        self.patch(MIP, 'IMAP', MockIMAP)
+        self.patch(MIP, 'message_from_string', lambda data: data)
+        self.patch(MIP, 'event_from_message', MockEvent)
+        self.patch(MIP, 'event_span', lambda event: (None, None))
+        self.patch(MIP, 'list_user_folders', lambda user_rec, _type: ['Calendar'])
+
+    def test_008_calendar_index_per_user(self):
+        import shutil
+        import tempfile
+
+        from wallace import calendar_index
+
+        # Both users' calendars have the same UIDVALIDITY
+        self._mock_user_imap({
+            'jane.doe@example.org': {'Calendar': ('1', {'1': 'jane-event'})},
+            'john.doe@example.org': {'Calendar': ('1', {'1': 'john-event'})}
+        })
+
+        self.patch(calendar_index, 'index_path', tempfile.mkdtemp())
+
+        jane = {'mail': 'jane.doe@example.org'}
+        john = {'mail': 'john.doe@example.org'}
+
+        try:
+            MIP.imap_proxy_auth(jane)
+            self.assertEqual(MIP.read_calendar_index('Calendar', jane)[0].find('jane-event'), ['1'])
+
+            MIP.imap_proxy_auth(john)
+
+            (index, events) = MIP.read_calendar_index('Calendar', john)
+            self.assertEqual(index.find('jane-event'), [])
+            self.assertEqual(index.find('john-event'), ['1'])
+
+        finally:
+            shutil.rmtree(calendar_index.index_path)
+            MIP.imap_sessions.clear()
+            MIP.calendar_indexes.clear()
+
+    def test_009_object_location_per_user(self):
+        self._mock_user_imap({
+            'jane.doe@example.org': {'Calendar': ('1', {'7': 'jane-event'})},
+            'john.doe@example.org': {}
+        })
+
+        jane = {'mail': 'jane.doe@example.org'}
+        john = {'mail': 'john.doe@example.org'}
+
+        try:
+            MIP.object_locations.set((jane['mail'], 'jane-event'), ('Calendar', '7'))
+
+            # The last session used is John's
+            MIP.imap_proxy_auth(jane)
+            MIP.imap_proxy_auth(john)
+
+            messages = MIP.find_object_messages('jane-event', 'event', jane)
+
+            self.assertEqual(next(messages), ('Calendar', ['7']))
+            self.assertEqual(MIP.imap.login, jane['mail'])
+
+            # The message has been replaced since.
+            MIP.object_locations.set((jane['mail'], 'jane-task'), ('Calendar', '6'))
+
+            messages = MIP.find_object_messages('jane-task', 'task', jane)
+
+            self.assertEqual(next(messages), ('Calendar', ['7']))
+            self.assertEqual(MIP.object_locations.get((jane['mail'], 'jane-task')), None)
+
+        finally:
+            MIP.imap_sessions.clear()
+            MIP.object_locations.clear()
+
+    def _mock_lock_timeout(self, spool):
+        """
+            Have the processing of an iTip REQUEST to jane.doe@example.org
+            time out waiting for a write lock, after acquiring another one.
+            Returns the path to the message in the spool.
+        """
+        from wallace import locks
+
+        class MockIMAP(object):
+            def connect(self, login=True):
+                pass
+
+            def disconnect(self):
+                pass
+
+        def process_itip_request(itip_event, policy, recipient_email, sender_email, receiving_user):
+            MIP.set_write_lock('held', False)
+            raise locks.LockTimeout('contended', 0)
+
+        filepath = os.path.join(spool, 'tmpmsg')
+
+        with open(filepath, 'w') as f:
+            f.write("X-Kolab-From: john.doe@example.org\r\nX-Kolab-To: jane.doe@example.org\r\n" + itip_multipart)
+
+        self.patch(MIP, 'mybasepath', spool)
+        self.patch(MIP, 'lock_manager', None)
+        self.patch(MIP, 'IMAP', MockIMAP)
+        self.patch(pykolab.auth.Auth, "extract_recipient_addresses", lambda self, entry: [entry['mail']])
+        self.patch(MIP, 'objects_from_message', lambda message, objnames, methods: [
+            {'uid': 'event', 'type': 'event', 'method': 'REQUEST', 'attendees': ['mailto:jane.doe@example.org']}
+        ])
+        self.patch(MIP, 'get_matching_invitation_policies', lambda receiving_user, sender_email, type_condition: [MIP.ACT_MANUAL])
+        self.patch(MIP, 'process_itip_request', process_itip_request)
+
+        return filepath
+
+    def test_010_lock_timeout_releases_locks(self):
+        import shutil
+        import tempfile
+
+        spool = tempfile.mkdtemp()
+        filepath = self._mock_lock_timeout(spool)
+
+        try:
+            self.assertEqual(MIP.execute(filepath), None)
+
+            # The message is left to be picked up again, without the locks.
+            self.assertTrue(os.path.exists(os.path.join(spool, 'incoming', 'tmpmsg')))
+            self.assertEqual(MIP.lock_manager.held, {})
+
+        finally:
+            shutil.rmtree(spool)
+            MIP.user_dn_from_email_address.cache.clear()
+
+    def test_011_lock_timeout_twice(self):
+        import shutil
+        import tempfile
+
+        import wallace
+
+        from wallace import modules
+
+        spool = tempfile.mkdtemp()
+        filepath = self._mock_lock_timeout(spool)
+
+        accepted = []
+
+        self.patch(modules, 'modules', {'invitationpolicy': {'function': MIP.execute}})
+        self.patch(wallace, 'cb_action_ACCEPT', lambda module, filepath: accepted.append(filepath))
+
+        try:
+            wallace.pickup_message(filepath, ['invitationpolicy'])
+
+            # Picked up again from the incoming stage, with the lock still
+            # contended.
+            filepath = os.path.join(spool, 'incoming', 'tmpmsg')
+            wallace.pickup_message(filepath, ['resources', 'invitationpolicy'], module='invitationpolicy')
+
+            self.assertEqual(accepted, [])
+            self.assertTrue(os.path.exists(filepath))
+
+        finally:
+            shutil.rmtree(spool)
+            MIP.user_dn_from_email_address.cache.clear()
+
+    def test_012_admin_imap_disconnected(self):
+        import shutil
+        import tempfile
+
+        spool = tempfile.mkdtemp()
+        filepath = self._mock_lock_timeout(spool)
+
+        class MockIMAP(object):
+            connected = []
+
+            def connect(self, login=True):
+                MockIMAP.connected.append(self)
+
+            def disconnect(self):
+                MockIMAP.connected.remove(self)
+
+        session = {'imap': MockIMAP(), 'used': time.time()}
+        session['imap'].connect()
+
+        def process_itip_request(itip_event, policy, recipient_email, sender_email, receiving_user):
+            # switch to the session of the user, as imap_proxy_auth() does
+            MIP.imap = session['imap']
+            return MIP.MESSAGE_PROCESSED
+
+        self.patch(MIP, 'IMAP', MockIMAP)
+        self.patch(MIP, 'process_itip_request', process_itip_request)
+
+        MIP.imap_sessions['jane.doe@example.org'] = session
+
+        try:
+            self.assertEqual(MIP.execute(filepath), None)
+
+            # The connection as the administrator is closed, the session of
+            # the user is kept.
+            self.assertEqual(MockIMAP.connected, [session['imap']])
+
+        finally:
+            shutil.rmtree(spool)
+            MIP.imap_sessions.clear()
+            MIP.user_dn_from_email_address.cache.clear()
@@ -4,6 +4,7 @@ import unittest
 
 import datetime
 import os
+import time
 
 from pykolab.auth.ldap import auth_cache
 import pykolab
@@ -63,6 +64,7 @@ Session = sessionmaker(bind=engine)
 db = Session()
 
 auth_cache.db = db
+auth_cache.backend = auth_cache.SQLBackend()
 
 
 class TestAuthCache(unittest.TestCase):
@@ -157,3 +159,96 @@ class TestAuthCache(unittest.TestCase):
 
         result = auth_cache.get_entry('v' + 'e'*512 + 'rylongkey')
         self.assertEqual(result, 'v' + 'e'*512 + 'rylongvalue2')
+
+
+class TestAuthCacheLRU(unittest.TestCase):
+    def test_001_memory_insert_update(self):
+        backend = auth_cache.LRUBackend(size=2)
+
+        backend.set_entry('somekey', 'ou=People,dc=example,dc=org')
+        self.assertEqual(backend.get_entry('somekey'), 'ou=People,dc=example,dc=org')
+
+        backend.set_entry('somekey', u'ou=Geschäftsbereich,ou=People,dc=example,dc=org')
+        self.assertEqual(
+            backend.get_entry('somekey'),
+            'ou=Gesch\xc3\xa4ftsbereich,ou=People,dc=example,dc=org'
+        )
+
+        backend.del_entry('somekey')
+        self.assertEqual(backend.get_entry('somekey'), None)
+
+    def test_002_memory_size(self):
+        backend = auth_cache.LRUBackend(size=2)
+
+        backend.set_entry('key1', 'value1')
+        backend.set_entry('key2', 'value2')
+        backend.get_entry('key1')
+        backend.set_entry('key3', 'value3')
+
+        self.assertEqual(backend.get_entry('key1'), 'value1')
+        self.assertEqual(backend.get_entry('key2'), None)
+        self.assertEqual(backend.get_entry('key3'), 'value3')
+
+    def test_003_memory_ttl(self):
+        backend = auth_cache.LRUBackend(ttl=-1)
+
+        backend.set_entry('somekey', 'somevalue')
+        self.assertEqual(backend.get_entry('somekey'), None)
+
+    def test_004_dbm_shared(self):
+        path = '/tmp/%s-auth_cache' % (os.getpid())
+
+        writer = auth_cache.LRUBackend(path=path, batch_size=2)
+        reader = auth_cache.LRUBackend(path=path)
+
+        writer.set_entry('key1', 'value1')
+
+        # Writes are batched.
+        self.assertEqual(reader.get_entry('key1'), None)
+
+        writer.set_entry('key2', 'value2')
+
+        self.assertEqual(reader.get_entry('key1'), 'value1')
+        self.assertEqual(reader.get_entry('key2'), 'value2')
+
+        writer.del_entry('key1')
+        writer.flush()
+
+        reader.cache.clear()
+        self.assertEqual(reader.get_entry('key1'), None)
+        self.assertEqual(reader.get_entry('key2'), 'value2')
+
+    def test_005_dbm_flush_timer(self):
+        path = '/tmp/%s-auth_cache-timer' % (os.getpid())
+
+        writer = auth_cache.LRUBackend(path=path, batch_interval=0.1)
+        reader = auth_cache.LRUBackend(path=path)
+
+        writer.set_entry('key1', 'value1')
+
+        # Written out without a further write to trigger the flush.
+        time.sleep(0.3)
+
+        self.assertEqual(writer.pending, {})
+        self.assertEqual(writer.timer, None)
+        self.assertEqual(reader.get_entry('key1'), 'value1')
+
+    def test_006_refresh_expiry(self):
+        path = '/tmp/%s-auth_cache-refresh' % (os.getpid())
+
+        backend = auth_cache.LRUBackend(path=path, ttl=60)
+
+        backend.set_entry('key1', 'value1')
+        backend.flush()
+
+        backend.ttl = 3600
+        backend.set_entry('key1', 'value1')
+
+        self.assertEqual(backend.pending['key1'][0], 'value1')
+        self.assertTrue(backend.pending['key1'][1] > time.time() + 60)
+
+        backend.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import os
+import time
+
+import ldap
+
+from pykolab.auth.ldap import LDAP
+from pykolab.auth.ldap import verdict_cache
+import pykolab
+conf = pykolab.getConf()
+conf.finalize_conf()
+
+verdict_cache.stamp_file = '/tmp/%s.stamp' % (os.getpid())
+verdict_cache.settings = {'ttl': 300, 'negative_ttl': 30, 'size': 3}
+
+user_dn = 'uid=john,ou=People,dc=example,dc=org'
+
+
+class MockConnection(object):
+    def __init__(self, user_bind_error=None):
+        self.user_bind_error = user_bind_error
+
+    def simple_bind_s(self, bind_dn, bind_pw):
+        if bind_dn == user_dn and self.user_bind_error is not None:
+            raise self.user_bind_error()
+
+    def search_ext(self, *args, **kw):
+        return 1
+
+    def result3(self, msgid):
+        return (ldap.RES_SEARCH_RESULT, [(user_dn, {})], msgid, [])
+
+
+class TestVerdictCache(unittest.TestCase):
+    def setUp(self):
+        verdict_cache.entries.clear()
+
+    def test_001_positive_verdict(self):
+        verdict_cache.set_verdict(['john', 'secret', 'imap'], 'example.org', True)
+
+        self.assertTrue(verdict_cache.get_verdict(['john', 'secret', 'imap'], 'example.org'))
+        self.assertEqual(verdict_cache.get_verdict(['john', 'wrong', 'imap'], 'example.org'), None)
+        self.assertEqual(verdict_cache.get_verdict(['john', 'secret', 'imap'], 'example.com'), None)
+
+    def test_002_negative_verdict(self):
+        verdict_cache.set_verdict(['john', 'wrong', 'imap'], 'example.org', False)
+
+        self.assertEqual(verdict_cache.get_verdict(['john', 'wrong', 'imap'], 'example.org'), False)
+
+    def test_003_no_plain_credentials(self):
+        verdict_cache.set_verdict(['john', 'secret', 'imap'], 'example.org', True)
+
+        for key in verdict_cache.entries:
+            self.assertFalse('john' in key)
+            self.assertFalse('secret' in key)
+
+    def test_004_expiry(self):
+        verdict_cache.settings['negative_ttl'] = 1
+        verdict_cache.set_verdict(['john', 'wrong', 'imap'], 'example.org', False)
+        verdict_cache.settings['negative_ttl'] = 30
+
+        time.sleep(1.1)
+
+        self.assertEqual(verdict_cache.get_verdict(['john', 'wrong', 'imap'], 'example.org'), None)
+
+    def test_005_lru_size(self):
+        for user in ['a', 'b', 'c']:
+            verdict_cache.set_verdict([user, 'secret', 'imap'], 'example.org', True)
+
+        # Use 'a', so that 'b' is the least recently used.
+        verdict_cache.get_verdict(['a', 'secret', 'imap'], 'example.org')
+        verdict_cache.set_verdict(['d', 'secret', 'imap'], 'example.org', True)
+
+        self.assertEqual(len(verdict_cache.entries), 3)
+        self.assertTrue(verdict_cache.get_verdict(['a', 'secret', 'imap'], 'example.org'))
+        self.assertEqual(verdict_cache.get_verdict(['b', 'secret', 'imap'], 'example.org'), None)
+
+    def test_006_invalidate(self):
+        verdict_cache.set_verdict(['john', 'secret', 'imap'], 'example.org', True)
+
+        time.sleep(0.01)
+        verdict_cache.invalidate()
+
+        self.assertEqual(verdict_cache.get_verdict(['john', 'secret', 'imap'], 'example.org'), None)
+
+    def _authenticate(self, user_bind_error=None):
+        auth = LDAP('example.org')
+        auth.ldap = MockConnection(user_bind_error)
+        auth._kolab_domain_root_dn = lambda domain: None
+        auth.config_get_list = lambda key: ['uid']
+
+        return auth.authenticate(['john', 'secret', 'imap', 'example.org'], 'example.org')
+
+    def test_007_server_down(self):
+        self.assertFalse(self._authenticate(ldap.SERVER_DOWN))
+        self.assertEqual(len(verdict_cache.entries), 0)
+
+    def test_008_invalid_credentials(self):
+        self.assertFalse(self._authenticate(ldap.INVALID_CREDENTIALS))
+        self.assertEqual(verdict_cache.get_verdict(['john', 'secret', 'imap', 'example.org'], 'example.org'), False)
+
+    def test_009_success(self):
+        self.assertTrue(self._authenticate())
+        self.assertTrue(verdict_cache.get_verdict(['john', 'secret', 'imap', 'example.org'], 'example.org'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import pykolab
+
+from wallace import spool
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+
+class TestWallaceSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.pickup_path = spool.pickup_path
+        spool.pickup_path = tempfile.mkdtemp() + '/'
+
+        for stage in ['incoming', 'HOLD', 'locks']:
+            os.makedirs(os.path.join(spool.pickup_path, 'resources', stage))
+
+    def tearDown(self):
+        shutil.rmtree(spool.pickup_path)
+        spool.pickup_path = self.pickup_path
+
+    def _write(self, relpath, age=0):
+        filepath = os.path.join(spool.pickup_path, relpath)
+
+        with open(filepath, 'w') as f:
+            f.write('test')
+
+        mtime = time.time() - age
+        os.utime(filepath, (mtime, mtime))
+
+        return filepath
+
+    def test_001_parse_path(self):
+        self.assertEqual(spool.parse_path(spool.pickup_path + 'tmpabc'), (None, None))
+        self.assertEqual(
+            spool.parse_path(spool.pickup_path + 'resources/incoming/tmpabc'),
+            ('resources', 'incoming')
+        )
+        self.assertEqual(spool.parse_path(spool.pickup_path + 'resources/locks/tmpabc'), None)
+        self.assertEqual(spool.parse_path('/tmp/elsewhere'), None)
+
+    def test_002_scan(self):
+        new = self._write('tmpnew')
+        old = self._write('resources/incoming/tmpold', age=300)
+        held = self._write('resources/HOLD/tmpheld', age=300)
+        self._write('resources/locks/tmplock', age=300)
+
+        watcher = spool.SpoolWatcher(None)
+        watcher.scan()
+
+        self.assertEqual(len(watcher.index), 3)
+        self.assertEqual(watcher.index.entries[held]['due'], None)
+
+        due = watcher.index.pop_due()
+        self.assertEqual(due, [(old, 'resources', 'incoming')])
+
+        self.assertTrue(watcher.index.next_due() > time.time())
+        self.assertTrue(new in watcher.index)
+
+    def test_003_fire_reschedules(self):
+        stays = self._write('resources/incoming/tmpstays', age=300)
+        goes = self._write('resources/incoming/tmpgoes', age=300)
+
+        picked_up = []
+
+        def callback(filepath, module, stage):
+            picked_up.append(filepath)
+
+            if filepath == goes:
+                os.unlink(filepath)
+
+        watcher = spool.SpoolWatcher(callback)
+        watcher.scan()
+        watcher.fire()
+
+        self.assertEqual(sorted(picked_up), sorted([stays, goes]))
+        self.assertFalse(goes in watcher.index)
+        self.assertTrue(watcher.index.entries[stays]['due'] > time.time() + spool.retry_interval - 5)
+
+        # Nothing is due anymore.
+        watcher.fire()
+        self.assertEqual(len(picked_up), 2)
+
+    def test_004_defer_backoff(self):
+        os.makedirs(os.path.join(spool.pickup_path, 'DEFER'))
+        deferred = self._write('DEFER/tmpdeferred', age=300)
+
+        picked_up = []
+
+        watcher = spool.SpoolWatcher(lambda *args: picked_up.append(args))
+        watcher.scan()
+        watcher.fire()
+
+        self.assertEqual(picked_up, [(deferred, 'DEFER', None)])
+
+        entry = watcher.index.entries[deferred]
+        self.assertEqual(entry['attempts'], 1)
+        self.assertTrue(entry['due'] > time.time() + spool.backoff(1) - 5)
+        self.assertEqual(spool.backoff(0), spool.defer_interval)
+        self.assertEqual(spool.backoff(100), spool.defer_max_interval)
+
+    def test_005_write_index(self):
+        self._write('resources/incoming/tmpmsg', age=300)
+
+        index_file = os.path.join(spool.pickup_path, 'spool.index')
+
+        watcher = spool.SpoolWatcher(None, index_file=index_file)
+        watcher.scan()
+        watcher.write_index(force=True)
+
+        entries = spool.read_index(index_file)
+
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['module'], 'resources')
+        self.assertEqual(entries[0]['stage'], 'incoming')
+
+    def test_006_scan_once(self):
+        events = []
+
+        class MockWatchManager(object):
+            def add_watch(self, *args, **kw):
+                events.append('watch')
+
+        class MockNotifier(object):
+            def __init__(self, watch_manager, handler):
+                pass
+
+            def check_events(self, timeout=None):
+                watcher.finished.set()
+                return False
+
+            def stop(self):
+                pass
+
+        class MockPyinotify(object):
+            IN_CLOSE_WRITE = IN_MOVED_TO = IN_MOVED_FROM = IN_DELETE = IN_DELETE_SELF = IN_CREATE = 0
+            WatchManager = MockWatchManager
+            Notifier = MockNotifier
+
+        watcher = spool.SpoolWatcher(None)
+        watcher.scan = lambda: events.append('scan')
+
+        _pyinotify = spool.pyinotify
+        _handler = getattr(spool, 'SpoolEventHandler', None)
+        spool.pyinotify = MockPyinotify
+        spool.SpoolEventHandler = lambda watcher=None: None
+
+        try:
+            watcher.run()
+        finally:
+            spool.pyinotify = _pyinotify
+            spool.SpoolEventHandler = _handler
+
+        self.assertEqual(events, ['watch', 'scan'])
+
+        # Without pyinotify, the spool is scanned once before polling.
+        events[:] = []
+
+        watcher.finished.set()
+        spool.pyinotify = None
+
+        try:
+            watcher.run()
+        finally:
+            spool.pyinotify = _pyinotify
+
+        self.assertEqual(events, ['scan'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import smtplib
+import tempfile
+import unittest
+
+import pykolab
+
+from wallace import modules
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+message_text = """X-Kolab-From: john@example.org
+X-Kolab-To: jane@example.org
+From: john@example.org
+To: jane@example.org
+Subject: test
+Message-ID: <test@example.org>
+
+Hello
+"""
+
+
+class MockSMTP(object):
+    connections = 0
+
+    def __init__(self, *args, **kw):
+        self.sent = []
+
+    def set_debuglevel(self, level):
+        pass
+
+    def connect(self, host, port):
+        MockSMTP.connections += 1
+
+    def rset(self):
+        pass
+
+    def sendmail(self, sender, recipients, msg):
+        if 'fail' in sender:
+            raise smtplib.SMTPDataError(451, 'try again later')
+
+        self.sent.append(msg)
+        return {}
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestWallaceModules(unittest.TestCase):
+
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.spool, 'tmpmsg')
+
+        with open(self.filepath, 'w') as f:
+            f.write(message_text)
+
+        self.sent = []
+        self._sendmail = modules._sendmail
+        modules._sendmail = self._mock_sendmail
+
+    def tearDown(self):
+        modules._sendmail = self._sendmail
+        modules.smtp_connection = None
+        modules.release_messages()
+        shutil.rmtree(self.spool)
+
+    def _mock_sendmail(self, sender, recipients, msg):
+        self.sent.append((sender, recipients, msg))
+        return True
+
+    def test_001_parse_once(self):
+        message = modules.message_from_spool(self.filepath)
+
+        # Moving the message to another stage keeps the parsed message.
+        os.mkdir(os.path.join(self.spool, 'incoming'))
+        new_filepath = os.path.join(self.spool, 'incoming', 'tmpmsg')
+        os.rename(self.filepath, new_filepath)
+
+        self.assertTrue(modules.message_from_spool(new_filepath) is message)
+        self.assertTrue(modules.message_from_spool(new_filepath, True) is message)
+
+    def test_002_parse_changed(self):
+        message = modules.message_from_spool(self.filepath, True)
+
+        # The full message is parsed if only the headers were.
+        self.assertFalse(modules.message_from_spool(self.filepath) is message)
+
+        message = modules.message_from_spool(self.filepath)
+
+        with open(self.filepath, 'w') as f:
+            f.write(message_text.replace('Hello', 'Hello again'))
+
+        self.assertFalse(modules.message_from_spool(self.filepath) is message)
+
+    def test_003_accept_modified_message(self):
+        message = modules.message_from_spool(self.filepath)
+        message.add_header('X-Wallace-Footer', 'YES')
+
+        modules.cb_action_ACCEPT('footer', self.filepath, message=message)
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertTrue('X-Wallace-Footer: YES' in self.sent[0][2])
+        self.assertFalse('X-Kolab-To' in self.sent[0][2])
+        self.assertFalse(os.path.exists(self.filepath))
+
+        # The message itself keeps its headers.
+        self.assertEqual(message['X-Kolab-To'], 'jane@example.org')
+
+    def test_004_persistent_connection(self):
+        modules._sendmail = self._sendmail
+        _smtp = smtplib.SMTP
+        smtplib.SMTP = MockSMTP
+
+        try:
+            MockSMTP.connections = 0
+
+            self.assertTrue(modules._sendmail('john@example.org', ['jane@example.org'], 'one'))
+            self.assertTrue(modules._sendmail('john@example.org', ['jane@example.org'], 'two'))
+
+            self.assertEqual(MockSMTP.connections, 1)
+            self.assertEqual(modules.smtp_connection.sent, ['one', 'two'])
+
+            # A failure on a reused connection is retried once on a new one.
+            self.assertFalse(modules._sendmail('fail@example.org', ['jane@example.org'], 'three'))
+            self.assertEqual(MockSMTP.connections, 2)
+            self.assertEqual(modules.smtp_connection, None)
+
+        finally:
+            smtplib.SMTP = _smtp
+
+    def test_005_defer_reinjection(self):
+        defer_path = modules.defer_path
+        modules.defer_path = os.path.join(self.spool, 'DEFER')
+        modules._sendmail = lambda *args: False
+
+        try:
+            message = modules.message_from_spool(self.filepath)
+            message.add_header('X-Wallace-Footer', 'YES')
+
+            modules.cb_action_ACCEPT('footer', self.filepath, message=message)
+
+            deferred = os.path.join(modules.defer_path, 'tmpmsg')
+
+            self.assertFalse(os.path.exists(self.filepath))
+            self.assertTrue('X-Wallace-Footer: YES' in open(deferred).read())
+
+        finally:
+            modules.defer_path = defer_path
+
+    def test_006_defer_notification(self):
+        defer_path = modules.defer_path
+        modules.defer_path = os.path.join(self.spool, 'DEFER')
+        modules._sendmail = lambda *args: False
+
+        try:
+            self.assertFalse(
+                modules._sendmail_or_defer('resource@example.org', 'jane@example.org', 'Subject: booked\r\n\r\nHello')
+            )
+
+            deferred = [os.path.join(modules.defer_path, x) for x in os.listdir(modules.defer_path)]
+            self.assertEqual(len(deferred), 1)
+
+            # Re-injected from the DEFER queue like any other message.
+            modules._sendmail = self._mock_sendmail
+            modules.reinject_deferred(deferred[0])
+
+            self.assertEqual(self.sent[0][0], ['resource@example.org'])
+            self.assertEqual(self.sent[0][1], ['jane@example.org'])
+            self.assertTrue('Subject: booked' in self.sent[0][2])
+            self.assertFalse('X-Kolab-To' in self.sent[0][2])
+            self.assertFalse(os.path.exists(deferred[0]))
+
+        finally:
+            modules.defer_path = defer_path
+
+    def test_007_defer_rejection(self):
+        defer_path = modules.defer_path
+        modules.defer_path = os.path.join(self.spool, 'DEFER')
+        modules._sendmail = lambda *args: False
+
+        try:
+            modules.cb_action_REJECT('resources', self.filepath)
+
+            deferred = [os.path.join(modules.defer_path, x) for x in os.listdir(modules.defer_path)]
+
+            self.assertFalse(os.path.exists(self.filepath))
+            self.assertEqual(len(deferred), 1)
+            self.assertTrue('X-Kolab-To: john@example.org' in open(deferred[0]).read())
+
+        finally:
+            modules.defer_path = defer_path
+
+
+if __name__ == '__main__':
+    unittest.main()
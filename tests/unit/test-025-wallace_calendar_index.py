@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+
+import pykolab
+
+from wallace import calendar_index
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+entries = {
+    '1': {'uid': 'one', 'start': 1000, 'end': 2000},
+    '2': {'uid': 'two', 'start': 3000, 'end': 4000},
+    '3': {'uid': 'three', 'start': 500, 'end': None},
+    '4': {'uid': None, 'start': None, 'end': None}
+}
+
+
+class TestWallaceCalendarIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index_path = calendar_index.index_path
+        calendar_index.index_path = tempfile.mkdtemp()
+
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(calendar_index.index_path)
+        calendar_index.index_path = self.index_path
+
+    def _fetch(self, uids):
+        self.fetched.extend(uids)
+        return dict([(uid, entries[uid]) for uid in uids])
+
+    def test_001_overlaps(self):
+        self.assertTrue(calendar_index.overlaps(entries['1'], 1500, 2500))
+        self.assertTrue(calendar_index.overlaps(entries['1'], 0, 1000))
+        self.assertFalse(calendar_index.overlaps(entries['1'], 2001, 2500))
+        self.assertFalse(calendar_index.overlaps(entries['2'], 0, 2999))
+        self.assertTrue(calendar_index.overlaps(entries['2'], 0, None))
+        self.assertTrue(calendar_index.overlaps(entries['3'], 100000, 200000))
+
+    def test_002_candidates(self):
+        index = calendar_index.CalendarIndex(u'shared/Resources/Room 101@example.org')
+        index.update('1', ['1', '2', '3', '4'], self._fetch)
+
+        self.assertEqual(index.candidates('new', 1500, 1600), ['1', '3'])
+        self.assertEqual(index.candidates('two', 1500, 1600), ['1', '2', '3'])
+        self.assertEqual(index.candidates('new', 100, 200), [])
+
+        self.assertEqual(index.find('two'), ['2'])
+        self.assertEqual(index.find('new'), [])
+
+    def test_003_incremental_update(self):
+        index = calendar_index.CalendarIndex('shared/Resources/Room 101@example.org')
+        index.update('1', ['1', '2'], self._fetch)
+        self.assertEqual(self.fetched, ['1', '2'])
+
+        # Another process picks up the index from disk.
+        index = calendar_index.CalendarIndex('shared/Resources/Room 101@example.org')
+        index.update('1', ['2', '3'], self._fetch)
+        self.assertEqual(self.fetched, ['1', '2', '3'])
+        self.assertEqual(sorted(index.entries.keys()), ['2', '3'])
+
+        # A new UIDVALIDITY invalidates the index.
+        index.update('2', ['2', '3'], self._fetch)
+        self.assertEqual(self.fetched, ['1', '2', '3', '2', '3'])
+
+    def test_004_owners(self):
+        # Two users' folders of the same name, with the same UIDVALIDITY
+        jane = calendar_index.CalendarIndex('Calendar', owner='jane.doe@example.org')
+        jane.update('1', ['1', '2'], self._fetch)
+
+        john = calendar_index.CalendarIndex('Calendar', owner='john.doe@example.org')
+        self.assertNotEqual(jane.filepath, john.filepath)
+
+        john.update('1', ['1', '2'], lambda uids: dict([(x, entries['3']) for x in uids]))
+
+        self.assertEqual(john.find('one'), [])
+        self.assertEqual(john.find('three'), ['1', '2'])
+
+        jane = calendar_index.CalendarIndex('Calendar', owner='jane.doe@example.org')
+        jane.update('1', ['1', '2'], self._fetch)
+
+        self.assertEqual(jane.find('one'), ['1'])
+        self.assertEqual(self.fetched, ['1', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
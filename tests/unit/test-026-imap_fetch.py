@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import pykolab
+
+from pykolab import imap
+from pykolab.imap import IMAP
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+
+class MockIMAP4(object):
+    def __init__(self):
+        self.commands = []
+
+    def uid(self, command, uids, items):
+        self.commands.append((command, uids, items))
+
+        data = []
+
+        for uid in uids.split(','):
+            if ':' in uid:
+                (first, last) = uid.split(':')
+            else:
+                first = last = uid
+
+            for _uid in range(int(first), int(last) + 1):
+                # Answer with the UID before and after the literal in turn.
+                if _uid % 2:
+                    data.append(('%d (UID %d BODY[] {4}' % (_uid, _uid), 'm%03d' % (_uid)))
+                    data.append(')')
+                else:
+                    data.append(('%d (BODY[] {4}' % (_uid), 'm%03d' % (_uid)))
+                    data.append(' UID %d)' % (_uid))
+
+        return ('OK', data)
+
+
+class MockCyrus(object):
+    def __init__(self):
+        self.m = MockIMAP4()
+
+
+class TestIMAPFetch(unittest.TestCase):
+
+    def test_001_uid_set(self):
+        self.assertEqual(imap.uid_set(['1', '2', '3', '5', '7', '8']), '1:3,5,7:8')
+        self.assertEqual(imap.uid_set(['9', '3', '2']), '2:3,9')
+
+    def test_002_parse_fetch_response(self):
+        data = [
+            ('1 (UID 10 BODY[] {4}', 'm010'),
+            ')',
+            ('2 (BODY[] {4}', 'm011'),
+            ' UID 11)'
+        ]
+
+        self.assertEqual(imap.parse_fetch_response(data), [('10', 'm010'), ('11', 'm011')])
+
+    def test_003_fetch_messages(self):
+        _imap = IMAP()
+        _imap.imap = MockCyrus()
+
+        uids = [str(x) for x in reversed(range(1, 251))]
+
+        result = list(_imap.fetch_messages(uids))
+
+        self.assertEqual([x[0] for x in result], uids)
+        self.assertEqual(result[0], ('250', 'm250'))
+
+        commands = _imap.imap.m.commands
+        self.assertEqual(len(commands), 3)
+        self.assertEqual(commands[0], ('FETCH', '151:250', '(UID BODY.PEEK[])'))
+
+    def test_004_fetch_part(self):
+        _imap = IMAP()
+        _imap.imap = MockCyrus()
+
+        list(_imap.fetch_messages(['1'], part='2'))
+
+        self.assertEqual(_imap.imap.m.commands[0], ('FETCH', '1', '(UID BODY.PEEK[2])'))
+
+    def test_005_parse_appenduid(self):
+        self.assertEqual(imap.parse_appenduid(['[APPENDUID 1234 56] Completed']), '56')
+        self.assertEqual(imap.parse_appenduid(['Completed']), None)
+        self.assertEqual(imap.parse_appenduid(None), None)
+
+    def test_006_message_deleted(self):
+        _imap = IMAP()
+        _imap.imap = MockCyrus()
+
+        flags = {
+            '1': ['1 (UID 1 FLAGS (\\Seen))'],
+            '2': ['2 (UID 2 FLAGS (\\Seen \\Deleted))'],
+            '3': [None]
+        }
+
+        _imap.imap.m.uid = lambda command, uid, items: ('OK', flags[uid])
+
+        self.assertFalse(_imap.message_deleted('1'))
+        self.assertTrue(_imap.message_deleted('2'))
+        self.assertTrue(_imap.message_deleted('3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import pykolab
+
+from pykolab.imap.mailbox_index import MailboxIndex
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+folders = {
+    'user/john.doe@example.org': 'imap1.example.org',
+    'user/john.doe/Calendar@example.org': 'imap1.example.org',
+    'user/jane.doe@example.org': 'imap2.example.org',
+    'shared/Resources/Room 101@example.org': None
+}
+
+
+class TestIMAPMailboxIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MailboxIndex(separator='/', ttl=300)
+        self.index.load(folders, now=1000)
+
+    def test_001_lookup(self):
+        self.assertTrue('user/john.doe@example.org' in self.index)
+        self.assertTrue('shared/Resources/Room 101@example.org' in self.index)
+        self.assertFalse('user/joe.doe@example.org' in self.index)
+        self.assertFalse('user' in self.index)
+        self.assertFalse('shared/Resources' in self.index)
+
+        self.assertEqual(self.index.server('user/jane.doe@example.org'), 'imap2.example.org')
+        self.assertEqual(self.index.server('shared/Resources/Room 101@example.org'), None)
+        self.assertEqual(self.index.server('user/joe.doe@example.org'), None)
+
+    def test_002_expired(self):
+        self.assertFalse(self.index.expired(now=1299))
+        self.assertTrue(self.index.expired(now=1300))
+        self.assertTrue(MailboxIndex().expired())
+
+    def test_003_add_remove(self):
+        self.index.add('user/joe.doe@example.org', 'imap1.example.org')
+        self.assertTrue('user/joe.doe@example.org' in self.index)
+
+        self.index.remove('user/john.doe@example.org')
+        self.assertFalse('user/john.doe@example.org' in self.index)
+        self.assertFalse('user/john.doe/Calendar@example.org' in self.index)
+        self.assertTrue('user/jane.doe@example.org' in self.index)
+        self.assertEqual(len(self.index), 3)
+
+    def test_004_rename(self):
+        self.index.rename('user/john.doe@example.org', 'user/johnny.doe@example.org')
+
+        self.assertEqual(
+            self.index.list('user/johnny.doe@example.org'),
+            ['user/johnny.doe/Calendar@example.org', 'user/johnny.doe@example.org']
+        )
+
+        self.assertEqual(
+            self.index.server('user/johnny.doe/Calendar@example.org'),
+            'imap1.example.org'
+        )
+
+        self.assertEqual(self.index.list('user/john.doe@example.org'), [])
+        self.assertEqual(len(self.index.list('user@example.org')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import time
+import unittest
+
+import pykolab
+
+from pykolab import imap
+from pykolab.imap import IMAP
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+
+class MockCyrus(object):
+    murder = True
+
+    def __init__(self, folders):
+        # The folders, by the round in which they appear
+        self.folders = folders
+        self.patterns = []
+
+    def lm(self, pattern):
+        self.patterns.append(pattern)
+        return [x for x, _round in self.folders.items() if _round < len(self.patterns)]
+
+
+class MockUserIMAP(IMAP):
+    """
+        Records how it logs in and sets up the additional folders for a user,
+        with the folders that never appear in the murder.
+    """
+    def __init__(self, missing=[]):
+        IMAP.__init__(self)
+        self.imap = MockCyrus({})
+        self.domain = None
+        self.missing = missing
+        self.logins = []
+        self.metadata = []
+        self.acls = []
+
+    def connect(self, uri=None, server=None, domain=None, login=True):
+        if login:
+            self.logins.append(('admin', None))
+
+    def disconnect(self, server=None):
+        pass
+
+    def login_plain(self, admin_login, admin_password, user):
+        self.logins.append((admin_login, user))
+
+    def namespaces(self):
+        return ('', 'user/', ['shared/'])
+
+    def user_mailbox_server(self, mailbox):
+        return 'imap.example.org'
+
+    def get_separator(self):
+        return '/'
+
+    def create_folder(self, folder_path, server=None, partition=None):
+        return True
+
+    def wait_for_folders(self, folders, timeout=None, reconnect=None):
+        reconnect()
+        return [x for x in folders if x in self.missing]
+
+    def set_metadata(self, folder, metadata_path, metadata_value, shared=True):
+        if folder in self.missing:
+            raise Exception("Mailbox does not exist")
+
+        self.metadata.append(folder)
+
+    def set_acl(self, folder, identifier, acl):
+        self.acls.append(folder)
+
+    def lm(self, pattern='*'):
+        return []
+
+    def logout(self):
+        pass
+
+
+class TestIMAPSettle(unittest.TestCase):
+
+    def test_001_settle_backoff(self):
+        delays = list(itertools.islice(imap.settle_backoff(timeout=30), 6))
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8, 1.6, 2])
+
+        # The delays do not run past the timeout.
+        start = time.time()
+
+        for delay in imap.settle_backoff(timeout=0.5):
+            time.sleep(delay)
+
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_002_wait_for_folders(self):
+        _imap = IMAP()
+        _imap.imap = MockCyrus({
+            'user/john.doe/Calendar@example.org': 0,
+            'user/john.doe/Contacts@example.org': 2,
+            'user/john.doe/Tasks@example.org': 1
+        })
+
+        missing = _imap.wait_for_folders(_imap.imap.folders.keys(), timeout=5)
+
+        self.assertEqual(missing, [])
+        self.assertEqual(_imap.imap.patterns, ['user/john.doe/*'] * 3)
+        self.assertEqual(_imap.settle_stats['rounds'], 3)
+        self.assertEqual(_imap.settle_stats['folders'], 3)
+
+    def test_003_wait_timeout(self):
+        _imap = IMAP()
+        _imap.imap = MockCyrus({
+            'user/john.doe@example.org': 0,
+            'user/jane.doe@example.org': 100
+        })
+
+        missing = _imap.wait_for_folders(_imap.imap.folders.keys(), timeout=0.5)
+
+        self.assertEqual(missing, ['user/jane.doe@example.org'])
+        self.assertEqual(_imap.settle_stats['timeouts'], 1)
+        self.assertTrue(_imap.settle_stats['seconds'] < 1)
+
+    def test_004_wait_reconnect(self):
+        _imap = IMAP()
+        _imap.imap = MockCyrus({'Calendar': 3})
+
+        reconnects = []
+
+        def reconnect():
+            reconnects.append(True)
+
+        settle_reconnect_interval = imap.settle_reconnect_interval
+        imap.settle_reconnect_interval = 0
+
+        try:
+            missing = _imap.wait_for_folders(['Calendar'], timeout=5, reconnect=reconnect)
+        finally:
+            imap.settle_reconnect_interval = settle_reconnect_interval
+
+        self.assertEqual(missing, [])
+        self.assertTrue(len(reconnects) > 0)
+
+        # The connection used to wait with is still there.
+        self.assertEqual(len(_imap.imap.patterns), 4)
+
+    def test_005_additional_folders_missing(self):
+        _imap = MockUserIMAP(missing=['Contacts'])
+
+        _imap.user_mailbox_create_additional_folders(
+            'john.doe@example.org',
+            {
+                'Calendar': {
+                    'annotations': {'/private/vendor/kolab/folder-type': 'event.default'},
+                    'acls': {'jane.doe@example.org': 'lrs'}
+                },
+                'Contacts': {
+                    'annotations': {'/private/vendor/kolab/folder-type': 'contact.default'},
+                    'acls': {'jane.doe@example.org': 'lrs'}
+                }
+            }
+        )
+
+        # Waiting for the folders reconnects on behalf of the user, not as
+        # the administrator.
+        admin_login = conf.get(conf.get('kolab', 'imap_backend'), 'admin_login')
+
+        self.assertEqual(
+            _imap.logins[:2],
+            [(admin_login, 'john.doe@example.org')] * 2
+        )
+
+        # A folder that has appeared is set up, and a folder that has not
+        # appeared in time does not stop the others from being set up.
+        self.assertEqual(_imap.metadata, ['Calendar'])
+        self.assertEqual(_imap.acls, ['Calendar'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pykolab
+
+from wallace import locks
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+
+class TestWallaceLocks(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_001_acquire_release(self):
+        one = locks.LockManager(self.path)
+        two = locks.LockManager(self.path)
+
+        self.assertTrue(one.acquire('key'))
+        self.assertTrue(one.acquire('key'))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'key.lock')))
+
+        # The lock is held through another file descriptor.
+        self.assertFalse(two.acquire('key', 0))
+        self.assertFalse(two.acquire('key', 0.05))
+        self.assertEqual(two.stats['contended'], 2)
+        self.assertEqual(two.stats['timeouts'], 2)
+
+        one.release('key')
+        self.assertFalse(os.path.isfile(os.path.join(self.path, 'key.lock')))
+
+        self.assertTrue(two.acquire('key', 0))
+        self.assertEqual(two.stats['acquired'], 1)
+
+    def test_002_release_all(self):
+        one = locks.LockManager(self.path)
+        two = locks.LockManager(self.path)
+
+        one.acquire('a')
+        one.acquire('b')
+        one.release_all()
+
+        self.assertEqual(one.held, {})
+        self.assertTrue(two.acquire('a', 0))
+        self.assertTrue(two.acquire('b', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,30 @@
 
 import unittest
 
+import pykolab
+
+from pykolab.plugins import recipientpolicy
 from pykolab.plugins.recipientpolicy import KolabRecipientpolicy
 
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
 policy = KolabRecipientpolicy()
 
+secondary_mail = """{
+        0: {
+                "{0}.{1}@{2}": "format('%(givenname)s'[0:1].capitalize(), '%(surname)s', '%(domain)s')"
+            },
+        1: {
+                "{0}@{1}": "format('%(uid)s', '%(domain)s')"
+            },
+        2: {
+                "{0}@{1}": "format('%(givenname)s.%(surname)s', '%(domain)s')"
+        }
+    }"""
+
 
 class TestRecipientPolicy(unittest.TestCase):
     def test_001_primary_mail(self):
@@ -26,5 +46,66 @@ class TestRecipientPolicy(unittest.TestCase):
 
         self.assertEqual('gn.sn@example.org', mail)
 
+    def test_002_secondary_mail(self):
+        entry = {
+            'id': '1',
+            'uid': 'doe',
+            'givenname': 'John',
+            'sn': "O'Doe",
+            'preferredlanguage': 'en_US'
+        }
+
+        mail = policy.set_secondary_mail(
+            secondary_mail=secondary_mail,
+            entry=entry,
+            primary_domain='example.org',
+            secondary_domains=['example.com']
+        )
+
+        self.assertEqual(
+            sorted(mail),
+            [
+                "doe@example.com",
+                "doe@example.org",
+                "j.o'doe@example.com",
+                "j.o'doe@example.org",
+                "john.o'doe@example.com",
+                "john.o'doe@example.org"
+            ]
+        )
+
+    def test_003_compiled_once(self):
+        compiled = recipientpolicy.compile_policy(secondary_mail)
+
+        self.assertTrue(compiled is recipientpolicy.compile_policy(secondary_mail))
+        self.assertEqual(compiled['attributes'], ['domain', 'givenname', 'surname', 'uid'])
+
+    def test_004_not_allowed(self):
+        for routine in [
+                "format(__import__('os').getpid())",
+                "format('%(uid)s').__class__",
+                "format(open('/etc/passwd').read())"
+            ]:
+
+            self.assertEqual(
+                recipientpolicy.compile_policy('{0: {"{0}": "%s"}}' % (routine)),
+                None
+            )
+
+    def test_005_bulk(self):
+        entries = [
+            {'id': '1', 'uid': 'a', 'givenname': 'Anne', 'sn': 'Smith'},
+            {'id': '2', 'uid': 'b', 'givenname': 'Bob', 'sn': 'Jones'}
+        ]
+
+        mails = policy.set_secondary_mails(
+            secondary_mail='{0: {"{0}@{1}": "format(\'%(uid)s\', \'%(domain)s\')"}}',
+            entries=entries,
+            primary_domain='example.org',
+            secondary_domains=[]
+        )
+
+        self.assertEqual(mails, [['a@example.org'], ['b@example.org']])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import unittest
+
+import pykolab
+
+from pykolab.auth.ldap import connection_pool
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+uri = 'ldap://localhost'
+bind_dn = 'uid=kolab-service,ou=Special Users,dc=example,dc=org'
+
+
+class MockConnection(object):
+    def __init__(self):
+        self.unbound = False
+
+    def whoami_s(self):
+        return 'dn:' + bind_dn
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class Owner(object):
+    pass
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        connection_pool.settings = {'size': 2}
+
+    def tearDown(self):
+        connection_pool.settings = None
+        connection_pool.idle.clear()
+        connection_pool.leases.clear()
+        connection_pool.failures.clear()
+
+    def test_001_release_and_lease(self):
+        owner = Owner()
+        conn = MockConnection()
+
+        self.assertEqual(connection_pool.lease(owner, uri, bind_dn), None)
+
+        connection_pool.register(owner, uri, bind_dn, conn)
+        connection_pool.release(conn)
+
+        self.assertTrue(connection_pool.lease(Owner(), uri, bind_dn) is conn)
+        self.assertEqual(connection_pool.lease(Owner(), uri, 'cn=Directory Manager'), None)
+
+    def test_002_garbage_collected_owner(self):
+        owner = Owner()
+        conn = MockConnection()
+
+        connection_pool.register(owner, uri, bind_dn, conn)
+
+        del owner
+        gc.collect()
+
+        # Operations may still be outstanding on the connection.
+        self.assertTrue(conn.unbound)
+        self.assertEqual(connection_pool.lease(Owner(), uri, bind_dn), None)
+
+    def test_003_forget(self):
+        owner = Owner()
+        conn = MockConnection()
+
+        connection_pool.register(owner, uri, bind_dn, conn)
+        connection_pool.forget(conn)
+        connection_pool.release(conn)
+
+        self.assertEqual(connection_pool.lease(owner, uri, bind_dn), None)
+
+    def test_004_pool_size(self):
+        owner = Owner()
+        conns = [MockConnection() for x in range(3)]
+
+        for conn in conns:
+            connection_pool.register(owner, uri, bind_dn, conn)
+            connection_pool.release(conn)
+
+        self.assertEqual(len(connection_pool.idle[(uri, bind_dn)]), 2)
+        self.assertTrue(conns[2].unbound)
+
+    def test_005_backoff(self):
+        owner = Owner()
+        conn = MockConnection()
+
+        connection_pool.register(owner, uri, bind_dn, conn)
+        connection_pool.release(conn)
+
+        connection_pool.failed(uri)
+
+        self.assertTrue(conn.unbound)
+        self.assertTrue(connection_pool.backoff(uri) > 0)
+
+        connection_pool.succeeded(uri)
+        self.assertEqual(connection_pool.backoff(uri), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
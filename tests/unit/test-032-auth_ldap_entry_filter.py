@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pykolab.auth.ldap import entry_filter
+
+user_filter = '(objectclass=kolabinetorgperson)'
+group_filter = '(|(objectclass=groupofuniquenames)(objectclass=groupofurls))'
+sharedfolder_filter = '(objectclass=kolabsharedfolder)'
+
+user = {
+    'dn': 'uid=doe,ou=People,dc=example,dc=org',
+    'objectclass': ['top', 'inetorgperson', 'kolabinetorgperson'],
+    'mail': 'john.doe@example.org',
+    'uid': 'doe'
+}
+
+group = {
+    'dn': 'cn=sales,ou=Groups,dc=example,dc=org',
+    'objectclass': ['top', 'groupOfUniqueNames', 'kolabGroupOfUniqueNames']
+}
+
+
+class TestEntryFilter(unittest.TestCase):
+
+    def test_001_equality(self):
+        self.assertTrue(entry_filter.match(user_filter, user))
+        self.assertFalse(entry_filter.match(user_filter, group))
+        self.assertFalse(entry_filter.match(sharedfolder_filter, user))
+        self.assertTrue(entry_filter.match('(objectClass=KolabInetOrgPerson)', user))
+        self.assertTrue(entry_filter.match('(mail=John.Doe@example.org)', user))
+
+    def test_002_boolean(self):
+        self.assertTrue(entry_filter.match(group_filter, group))
+        self.assertFalse(entry_filter.match(group_filter, user))
+        self.assertTrue(entry_filter.match('(&%s(uid=doe))' % (user_filter), user))
+        self.assertFalse(entry_filter.match('(&%s(uid=smith))' % (user_filter), user))
+        self.assertTrue(entry_filter.match('(!%s)' % (group_filter), user))
+
+    def test_003_presence_substrings(self):
+        self.assertTrue(entry_filter.match('(mail=*)', user))
+        self.assertTrue(entry_filter.match('(mail=john*)', user))
+        self.assertTrue(entry_filter.match('(mail=*@example.org)', user))
+        self.assertTrue(entry_filter.match('(mail=j*doe*org)', user))
+        self.assertFalse(entry_filter.match('(mail=*@example.com)', user))
+        self.assertFalse(entry_filter.match('(mail=john.doe*example.org*.org)', user))
+
+    def test_004_escapes(self):
+        entry = {'cn': ['a*b (c)']}
+
+        self.assertTrue(entry_filter.match('(cn=a\\2ab \\28c\\29)', entry))
+        self.assertTrue(entry_filter.match('(cn=*\\2a*)', entry))
+
+    def test_005_unknown(self):
+        # Attributes not at hand
+        self.assertEqual(entry_filter.match('(nsroledn=*)', user), None)
+        self.assertEqual(entry_filter.match('(&%s(nsroledn=*))' % (user_filter), user), None)
+        self.assertEqual(entry_filter.match('(!(nsroledn=*))', user), None)
+
+        # ... do not matter if the result is clear without them
+        self.assertFalse(entry_filter.match('(&%s(nsroledn=*))' % (user_filter), group))
+        self.assertTrue(entry_filter.match('(|%s(nsroledn=*))' % (user_filter), user))
+
+        # Matches not evaluated locally
+        self.assertEqual(entry_filter.match('(uidnumber>=1000)', user), None)
+        self.assertEqual(entry_filter.match('(cn:dn:=sales)', group), None)
+        self.assertEqual(entry_filter.match('(objectclass=kolabinetorgperson', user), None)
+
+    def test_006_compiled_once(self):
+        self.assertTrue(entry_filter.compile_filter(group_filter) is entry_filter.compile_filter(group_filter))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import ldap
+
+import pykolab
+
+from pykolab.auth.ldap import LDAP
+from pykolab.auth.ldap import entry_cache
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+entry_cache.stamp_file = '/tmp/%s.entry_cache.stamp' % (os.getpid())
+
+dn = 'uid=doe,ou=People,dc=example,dc=org'
+
+
+class MockConnection(object):
+    def __init__(self):
+        self.modified = []
+        self.msgid = 0
+        self.completed = []
+
+    def modify_s(self, dn, modlist):
+        self.modified.append((dn, modlist))
+
+    def modify_ext(self, dn, modlist):
+        self.modified.append((dn, modlist))
+        self.msgid += 1
+        return self.msgid
+
+    def result(self, msgid):
+        self.completed.append(msgid)
+
+
+class TestLDAPModifications(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = LDAP('example.org')
+        self.auth.ldap_priv = MockConnection()
+        self.auth._bind = lambda *args: True
+        self.auth._bind_priv = lambda: True
+
+    def tearDown(self):
+        self.auth.ldap_priv = None
+
+        if os.path.exists(entry_cache.stamp_file):
+            os.unlink(entry_cache.stamp_file)
+
+    def test_001_coalesce(self):
+        self.auth._buffer_modifications(
+            dn,
+            {
+                'uid': ['doe'],
+                'mail': ['john.doe@example.org'],
+                'alias': ['doe@example.org', 'j.doe@example.org'],
+                'mailQuota': ['1024']
+            }
+        )
+
+        entry = {'dn': dn}
+
+        self.auth.set_entry_attribute(entry, 'mail', 'john.doe@example.org')
+        self.auth.set_entry_attribute(entry, 'alias', ['j.doe@example.org', 'doe@example.org'])
+        self.auth.set_entry_attribute(entry, 'mailhost', 'imap.example.org')
+        self.auth.set_entry_attribute(entry, 'mailhost', 'imap2.example.org')
+        self.auth.set_entry_attribute(entry, 'mailquota', None)
+        self.auth.set_entry_attribute(entry, 'preferredlanguage', None)
+
+        self.assertEqual(self.auth.ldap_priv.modified, [])
+
+        self.auth._flush_modifications()
+
+        self.assertEqual(
+            self.auth.ldap_priv.modified,
+            [
+                (
+                    dn,
+                    [
+                        (ldap.MOD_ADD, 'mailhost', 'imap2.example.org'),
+                        (ldap.MOD_DELETE, 'mailquota', ['1024'])
+                    ]
+                )
+            ]
+        )
+
+        self.assertEqual(self.auth._modifications, {})
+
+    def test_002_nothing_changes(self):
+        self.auth._buffer_modifications(dn, {'mail': ['john.doe@example.org']})
+        self.auth.set_entry_attribute({'dn': dn}, 'mail', 'john.doe@example.org')
+        self.auth._flush_modifications()
+
+        self.assertEqual(self.auth.ldap_priv.modified, [])
+
+    def test_003_pipeline(self):
+        self.auth._pipeline_depth = 2
+
+        for uid in ['a', 'b', 'c']:
+            _dn = 'uid=%s,ou=People,dc=example,dc=org' % (uid)
+            self.auth._buffer_modifications(_dn, {'uid': [uid]})
+            self.auth.set_entry_attribute({'dn': _dn}, 'mailhost', 'imap.example.org')
+            self.auth._flush_modifications(pipeline=True)
+
+        self.assertEqual(len(self.auth.ldap_priv.modified), 3)
+        self.assertEqual(self.auth.ldap_priv.completed, [1])
+
+        # Only wait for the modifications of the attributes asked for
+        self.auth._complete_modifications(['mail'])
+        self.assertEqual(self.auth.ldap_priv.completed, [1])
+
+        self.auth._complete_modifications()
+        self.assertEqual(self.auth.ldap_priv.completed, [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import os
+
+from pykolab.auth.ldap import LDAP
+from pykolab.auth.ldap import entry_cache
+import pykolab
+conf = pykolab.getConf()
+conf.finalize_conf()
+
+entry_cache.stamp_file = '/tmp/%s.entry_cache.stamp' % (os.getpid())
+entry_cache.settings = {'ttl': 300, 'size': 3}
+entry_cache.dns.size = 3
+entry_cache.entries.size = 3
+
+uri = 'ldap://localhost'
+dn = 'uid=doe,ou=People,dc=example,dc=org'
+
+
+class MockConnection(object):
+    def __init__(self):
+        self.searches = []
+
+    def search_ext(self, base_dn, scope, filterstr=None, attrlist=None):
+        self.searches.append((base_dn, filterstr, attrlist))
+        return len(self.searches)
+
+    def result3(self, msgid):
+        (base_dn, filterstr, attrlist) = self.searches[msgid - 1]
+
+        if filterstr == '(objectclass=*)':
+            return (None, [(dn, {'uid': ['doe'], 'mailHost': ['imap.example.org']})], msgid, [])
+
+        return (None, [(dn, {})], msgid, [])
+
+
+class TestEntryCache(unittest.TestCase):
+    def setUp(self):
+        entry_cache.dns.clear()
+        entry_cache.entries.clear()
+
+    def tearDown(self):
+        if os.path.exists(entry_cache.stamp_file):
+            os.unlink(entry_cache.stamp_file)
+
+    def test_001_dn(self):
+        entry_cache.set_dn(uri, 'ABC-123', dn)
+
+        self.assertEqual(entry_cache.get_dn(uri, 'abc-123'), dn)
+        self.assertEqual(entry_cache.get_dn('ldap://elsewhere', 'abc-123'), None)
+
+    def test_002_attributes_by_name(self):
+        entry_cache.set_attributes(uri, dn, ['mail', 'mailHost'], {'mail': ['john.doe@example.org']})
+
+        self.assertEqual(
+            entry_cache.get_attributes(uri, dn.upper(), ['dn', 'Mail']),
+            {'mail': ['john.doe@example.org']}
+        )
+
+        # The entry does not have a mailhost
+        self.assertEqual(entry_cache.get_attributes(uri, dn, ['mailhost']), {})
+
+        # Not yet known
+        self.assertEqual(entry_cache.get_attributes(uri, dn, ['mail', 'mailquota']), None)
+        self.assertEqual(entry_cache.get_attributes(uri, dn, ['*']), None)
+
+    def test_003_all_attributes(self):
+        entry_cache.set_attributes(
+            uri,
+            dn,
+            ['*', 'nsRoleDN'],
+            {'uid': 'doe', 'mail': ['john.doe@example.org']}
+        )
+
+        self.assertEqual(
+            entry_cache.get_attributes(uri, dn, ['*']),
+            {'uid': ['doe'], 'mail': ['john.doe@example.org']}
+        )
+
+        self.assertEqual(entry_cache.get_attributes(uri, dn, ['nsroledn']), {})
+
+        # Operational attributes are not fetched with '*'
+        self.assertEqual(entry_cache.get_attributes(uri, dn, ['entrydn']), None)
+
+    def test_004_invalidate(self):
+        entry_cache.set_dn(uri, 'abc-123', dn)
+        entry_cache.set_attributes(uri, dn, ['mail'], {'mail': ['john.doe@example.org']})
+
+        entry_cache.invalidate(uri, dn)
+
+        self.assertEqual(entry_cache.get_attributes(uri, dn, ['mail']), None)
+        self.assertEqual(entry_cache.get_dn(uri, 'abc-123'), dn)
+
+        # Our own signal does not flush our cache
+        self.assertTrue(os.path.exists(entry_cache.stamp_file))
+
+        entry_cache.invalidate(uri)
+
+        self.assertEqual(entry_cache.get_dn(uri, 'abc-123'), None)
+
+    def test_005_signalled(self):
+        entry_cache.invalidate(uri)
+        entry_cache.set_dn(uri, 'abc-123', dn)
+
+        # Another process has seen a change
+        entry_cache.last_invalidation -= 1
+
+        self.assertEqual(entry_cache.get_dn(uri, 'abc-123'), None)
+
+    def test_006_ldap(self):
+        auth = LDAP('example.org')
+        auth.ldap = MockConnection()
+        auth._bind = lambda *args: True
+        auth._kolab_domain_root_dn = lambda domain: None
+
+        self.assertEqual(auth.entry_dn('abc-123'), dn)
+        self.assertEqual(auth.get_entry_attribute('abc-123', 'mailhost'), 'imap.example.org')
+        self.assertEqual(auth.get_entry_attribute('abc-123', 'uid'), 'doe')
+        self.assertEqual(auth.get_entry_attribute('abc-123', 'mailquota'), None)
+        self.assertEqual(auth.get_entry_attribute('abc-123', 'mailquota'), None)
+
+        # One search for the DN, one for the attributes, and one for the
+        # attribute not fetched with '*'
+        self.assertEqual(len(auth.ldap.searches), 3)
+
+        entry_cache.invalidate(uri)
+
+    def test_007_lru_size(self):
+        for uid in ['a', 'b', 'c', 'd']:
+            entry_cache.set_dn(uri, uid, 'uid=%s,dc=example,dc=org' % (uid))
+
+        self.assertEqual(len(entry_cache.dns), 3)
+        self.assertEqual(entry_cache.get_dn(uri, 'a'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pykolab
+
+from pykolab.cli import cmd_sync
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+
+class MockPool(object):
+    def __init__(self):
+        self.queued = []
+
+    def apply_async(self, func, args, kw, callback=None):
+        self.queued.append(kw['dn'])
+
+
+class TestCLISync(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self._checkpoint_file = cmd_sync.checkpoint_file
+        cmd_sync.checkpoint_file = lambda domain: os.path.join(self.path, domain)
+
+        cmd_sync.pool = MockPool()
+        cmd_sync.backlog = threading.BoundedSemaphore(10)
+        cmd_sync.stats_reset()
+
+    def tearDown(self):
+        cmd_sync.checkpoint_close('example.org')
+        cmd_sync.checkpoint_file = self._checkpoint_file
+        cmd_sync.pool = None
+        cmd_sync.backlog = None
+        shutil.rmtree(self.path)
+
+    def _synchronize(self, dns):
+        for dn in dns:
+            cmd_sync.backlog.acquire()
+            cmd_sync._synchronized(dn)
+
+    def test_001_checkpoint(self):
+        cmd_sync.checkpoint_open('example.org')
+        self._synchronize(['uid=a,dc=example,dc=org', None, 'uid=b,dc=example,dc=org'])
+
+        self.assertEqual(cmd_sync.stats['synchronized'], 2)
+        self.assertEqual(cmd_sync.stats['failed'], 1)
+
+        # An incomplete run leaves the checkpoint behind.
+        cmd_sync.checkpoint_close('example.org', complete=False)
+
+        cmd_sync.checkpoint_open('example.org')
+
+        self.assertEqual(
+            cmd_sync.completed,
+            set(['uid=a,dc=example,dc=org', 'uid=b,dc=example,dc=org'])
+        )
+
+        cmd_sync.checkpoint_close('example.org', complete=True)
+
+        self.assertFalse(os.path.exists(cmd_sync.checkpoint_file('example.org')))
+
+    def test_002_queue_add_skips_completed(self):
+        cmd_sync.checkpoint_open('example.org')
+        self._synchronize(['uid=a,dc=example,dc=org'])
+        cmd_sync.checkpoint_close('example.org')
+
+        cmd_sync.checkpoint_open('example.org')
+
+        cmd_sync.queue_add(
+            entry=[
+                ('uid=a,dc=example,dc=org', {}),
+                (None, ['ldap://elsewhere']),
+                ('uid=b,dc=example,dc=org', {})
+            ]
+        )
+
+        self.assertEqual(cmd_sync.pool.queued, ['uid=b,dc=example,dc=org'])
+        self.assertEqual(cmd_sync.stats['skipped'], 1)
+
+    def test_003_resync(self):
+        cmd_sync.checkpoint_open('example.org')
+        self._synchronize(['uid=a,dc=example,dc=org'])
+        cmd_sync.checkpoint_close('example.org')
+
+        cmd_sync.checkpoint_open('example.org', resync=True)
+
+        self.assertEqual(cmd_sync.completed, set())
+
+        cmd_sync.queue_add(entry=[('uid=a,dc=example,dc=org', {})])
+
+        self.assertEqual(cmd_sync.pool.queued, ['uid=a,dc=example,dc=org'])
+
+        # The checkpoint of the earlier run is gone.
+        cmd_sync.checkpoint_close('example.org')
+
+        with open(cmd_sync.checkpoint_file('example.org')) as f:
+            self.assertEqual(f.read(), '')
+
+    def test_004_rate_per_domain(self):
+        cmd_sync.checkpoint_open('example.org')
+        self._synchronize(['uid=a,dc=example,dc=org', 'uid=b,dc=example,dc=org', 'uid=c,dc=example,dc=org'])
+        cmd_sync.checkpoint_close('example.org')
+
+        # Not rounded down to whole entries per second
+        self.assertEqual(cmd_sync.rate(3, cmd_sync.stats['start'] + 2), 1.5)
+
+        # The next domain starts counting over again.
+        cmd_sync.stats['start'] -= 10
+        cmd_sync.stats_reset()
+
+        self.assertEqual(cmd_sync.stats['synchronized'], 0)
+        self.assertTrue(cmd_sync.rate(1) > 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import pykolab
+
+from kolabd import process
+
+conf = pykolab.getConf()
+
+if not hasattr(conf, 'defaults'):
+    conf.finalize_conf()
+
+
+class Stop(KeyboardInterrupt):
+    pass
+
+
+class MockAuth(object):
+    # The outcome of each call to synchronize(), as the value to return or
+    # the exception to raise.
+    outcomes = []
+    calls = []
+
+    def __init__(self, domain):
+        pass
+
+    def connect(self, domain=None):
+        pass
+
+    def synchronize(self, persistent=False):
+        MockAuth.calls.append(persistent)
+
+        outcome = MockAuth.outcomes.pop(0)
+
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        return outcome
+
+
+class TestKolabdProcess(unittest.TestCase):
+
+    def setUp(self):
+        self._auth = process.Auth
+        self._sleep = process.time.sleep
+        process.Auth = MockAuth
+        process.time.sleep = self._mock_sleep
+
+        MockAuth.calls = []
+        self.sleeps = []
+        self.max_sleeps = 1
+
+    def tearDown(self):
+        process.Auth = self._auth
+        process.time.sleep = self._sleep
+
+    def _mock_sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+        if len(self.sleeps) >= self.max_sleeps:
+            raise Stop()
+
+    def _synchronize(self):
+        try:
+            process.KolabdProcess('example.org').synchronize('example.org')
+        except Stop:
+            pass
+
+    def test_001_poll_without_persistent_search(self):
+        MockAuth.outcomes = [False, None, None]
+        self.max_sleeps = 2
+
+        self._synchronize()
+
+        # Persistent search is not attempted again once found unsupported.
+        self.assertEqual(MockAuth.calls, [True, False, False])
+        self.assertEqual(self.sleeps, [300, 300])
+
+    def test_002_reconnect_persistent_search(self):
+        MockAuth.outcomes = [True, True]
+        self.max_sleeps = 2
+
+        self._synchronize()
+
+        self.assertEqual(MockAuth.calls, [True, True])
+        self.assertEqual(self.sleeps, [2, 4])
+
+    def test_003_backoff(self):
+        MockAuth.outcomes = [Exception('Server down')] * 7
+        self.max_sleeps = 7
+
+        self._synchronize()
+
+        self.assertEqual(self.sleeps, [2, 4, 8, 16, 32, 60, 60])
+
+    def test_004_backoff_reset(self):
+        MockAuth.outcomes = [Exception('Server down')] * 3
+        self.max_sleeps = 3
+
+        _time = process.time.time
+        times = iter([0, 1, 10, 11, 20, 200])
+        process.time.time = lambda: next(times)
+
+        try:
+            self._synchronize()
+        finally:
+            process.time.time = _time
+
+        # Having been synchronizing for longer than the longest interval,
+        # the backoff starts over.
+        self.assertEqual(self.sleeps, [2, 4, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
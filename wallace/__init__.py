@@ -31,7 +31,6 @@ import socket
 import struct
 import sys
 import tempfile
-from threading import _Timer
 import time
 
 import pykolab
@@ -41,6 +40,7 @@ from pykolab.translate import _ as _l
 
 import modules
 from modules import cb_action_ACCEPT
+import spool
 
 # pylint: disable=invalid-name
 log = pykolab.getLogger('pykolab.wallace')
@@ -49,6 +49,17 @@ conf = pykolab.getConf()
 
 
 def pickup_message(filepath, *args, **kwargs):
+    """
+        Run the message in filepath through the Wallace modules. The modules
+        share the message as parsed from the spool until it is released here.
+    """
+    try:
+        _pickup_message(filepath, *args, **kwargs)
+    finally:
+        modules.release_messages()
+
+
+def _pickup_message(filepath, *args, **kwargs):
     wallace_modules = args[0]
 
     if 'module' in kwargs:
@@ -60,9 +71,16 @@ def pickup_message(filepath, *args, **kwargs):
 
         # Execute the module
         if 'stage' in kwargs:
-            modules.execute(kwargs['module'], filepath, stage=kwargs['stage'])
+            result_filepath = modules.execute(kwargs['module'], filepath, stage=kwargs['stage'])
         else:
-            modules.execute(kwargs['module'], filepath)
+            result_filepath = modules.execute(kwargs['module'], filepath)
+
+        # The module has consumed the message, or held it back to be picked
+        # up again later.
+        if result_filepath is None or result_filepath is False:
+            return
+
+        filepath = result_filepath
 
     # After all modules are executed, continue with a call to
     # accept the message and re-inject in to Postfix.
@@ -125,34 +143,77 @@ def worker_process(*args, **kwargs):
     log.debug("Worker process %s initializing" % (multiprocessing.current_process().name), level=1)
 
 
-# pylint: disable=too-few-public-methods
-class Timer(_Timer):
-    def run(self):
-        while True:
-            while not self.finished.is_set():
-                self.finished.wait(self.interval)
-                log.debug(_l("Timer looping function '%s' every %ss") % (
-                    self.function.__name__,
-                    self.interval
-                ), level=8)
-                self.function(*self.args, **self.kwargs)
+class SMTPChannel(smtpd.SMTPChannel):
+    """
+        An SMTP channel that releases its slot in the Wallace daemon's
+        connection count when it closes.
+    """
 
-            self.finished.set()
-            log.debug(
-                _l("Timer loop %s") % ('still active', 'finished')[self.finished.is_set()],
-                level=8
-            )
+    def __init__(self, server, conn, addr):
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+        self.wallace = server
+        self.released = False
 
-            break
+    def close(self):
+        smtpd.SMTPChannel.close(self)
+
+        if not self.released:
+            self.released = True
+            self.wallace.current_connections -= 1
+
+
+class SMTPListener(asyncore.dispatcher):
+    """
+        Accept connections on the listening socket, and handle each of them
+        in an SMTPChannel of its own, all from the same asyncore loop.
+
+        New connections are left in the socket's backlog for as long as the
+        maximum number of connections is being handled.
+    """
+
+    def __init__(self, wallace, sock):
+        asyncore.dispatcher.__init__(self, sock)
+        self.wallace = wallace
+
+        # The socket is listening already.
+        self.accepting = True
+
+    def readable(self):
+        return self.wallace.current_connections < self.wallace.max_connections
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+
+        log.debug(
+            _l("Accepted connection %r with address %r") % (
+                pair if pair is not None else (None, None)
+            ),
+            level=8
+        )
+
+        if pair is None:
+            return
+
+        (connection, address) = pair
+
+        self.wallace.current_connections += 1
+
+        log.debug(_l("Creating SMTPChannel for accepted message"), level=8)
+        SMTPChannel(self.wallace, connection, address)
+
+    def handle_error(self):
+        log.error(_l("Error accepting connection: %s") % (traceback.format_exc()))
 
 
 class WallaceDaemon:
     heartbeat = None
-    timer = None
+    spool_watcher = None
 
     def __init__(self):
         self.current_connections = 0
-        self.max_connections = 24
         self.parent_pid = None
         self.pool = None
 
@@ -192,6 +253,15 @@ class WallaceDaemon:
             help=_l("Number of threads to use.")
         )
 
+        daemon_group.add_option(
+            "--max-connections",
+            dest="max_connections",
+            action="store",
+            default=24,
+            type=int,
+            help=_l("Maximum number of simultaneous SMTP connections.")
+        )
+
         daemon_group.add_option(
             "--max-tasks",
             dest="max_tasks",
@@ -229,6 +299,8 @@ class WallaceDaemon:
 
         conf.finalize_conf()
 
+        self.max_connections = conf.max_connections
+
         utils.ensure_directory(
             os.path.dirname(conf.pidfile),
             conf.process_username,
@@ -256,7 +328,15 @@ class WallaceDaemon:
         else:
             self.pool = multiprocessing.Pool(conf.max_threads, worker_process, ())
 
-        self.pickup_spool_messages(sync=True)
+        # The messages already in the spool are picked up by the spool watcher
+        # as soon as it has scanned the spool.
+        self.spool_watcher = spool.SpoolWatcher(
+            self.pickup_spool_message,
+            index_file=conf.get('wallace', 'spool_index')
+        )
+
+        self.spool_watcher.daemon = True
+        self.spool_watcher.start()
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -295,14 +375,7 @@ class WallaceDaemon:
 
                 time.sleep(1)
 
-        s.listen(5)
-
-        self.timer = Timer(180, self.pickup_spool_messages, args=[], kwargs={'sync': True})
-
-        # pylint: disable=attribute-defined-outside-init
-        self.timer.daemon = True
-
-        self.timer.start()
+        s.listen(self.max_connections)
 
         # start background process to run periodic jobs in active modules
         try:
@@ -324,40 +397,13 @@ class WallaceDaemon:
                 level=8
             )
 
-        try:
-            while 1:
-                while self.current_connections >= self.max_connections:
-                    log.debug(
-                        _l("Reached limit of max connections of: %s. Sleeping for 0.5s") % (
-                            self.max_connections
-                        ),
-                        level=6
-                    )
-
-                    time.sleep(0.5)
-
-                pair = s.accept()
-                log.debug(
-                    _l("Accepted connection %r with address %r") % (
-                        pair if pair is not None else (None, None)
-                    ),
-                    level=8
-                )
-
-                if pair is not None:
-                    self.current_connections += 1
-                    connection, address = pair
-
-                    _smtpd = smtpd
-                    # Set DEBUGSTREAM of smtpd to log to pykolab logger
-                    if conf.debuglevel > 8:
-                        _smtpd.DEBUGSTREAM = pykolab.logger.StderrToLogger(log)
+        # Set DEBUGSTREAM of smtpd to log to pykolab logger
+        if conf.debuglevel > 8:
+            smtpd.DEBUGSTREAM = pykolab.logger.StderrToLogger(log)
 
-                    log.debug(_l("Creating SMTPChannel for accepted message"), level=8)
-                    _smtpd.SMTPChannel(self, connection, address)
-                    asyncore.loop()
-                else:
-                    log.error(_l("Socket accepted, but (conn, address) tuple is None."))
+        try:
+            SMTPListener(self, s)
+            asyncore.loop(timeout=1)
 
         # pylint: disable=broad-except
         except Exception:
@@ -367,8 +413,8 @@ class WallaceDaemon:
 
         # shut down hearbeat process
         self.heartbeat.terminate()
-        self.timer.cancel()
-        self.timer.join()
+        self.spool_watcher.finished.set()
+        self.spool_watcher.join()
 
     # pylint: disable=no-self-use
     def data_header(self, mailfrom, rcpttos):
@@ -377,94 +423,18 @@ class WallaceDaemon:
         return "X-Kolab-From: " + mailfrom + "\r\n" + \
             "X-Kolab-To: " + COMMASPACE.join(rcpttos) + "\r\n"
 
-    def pickup_spool_messages(self, sync=False):
-        # Mind you to include the trailing slash
-        pickup_path = '/var/spool/pykolab/wallace/'
-
-        messages = []
-        for root, _, files in os.walk(pickup_path):
-            for filename in files:
-                messages.append((root, filename))
-
-        for root, filename in messages:
-            filepath = os.path.join(root, filename)
-
-            try:
-                # ignore calls on too young files
-                if os.stat(filepath).st_mtime + 150 > time.time():
-                    log.debug("File not more than 150s old. Skipping %s" % (filepath), level=8)
-                    continue
-
-                # ignore calls on lock files
-                if '/locks/' in filepath:
-                    log.debug("File is in locks directory. Skipping %s" % (filepath), level=8)
-                    continue
-
-            # pylint: disable=broad-except
-            except Exception as errmsg:
-                log.error("Error: %s. Skipping %s" % (errmsg, filepath))
-                continue
-
-            if not root == pickup_path:
-                module = os.path.dirname(root).replace(pickup_path, '')
-
-                # Compare uppercase status (specifically, DEFER) with
-                # lowercase (plugin names).
-                #
-                # The messages in DEFER are supposed to be picked up by
-                # another thread, whereas the messages in other directories
-                # are pending being handled by their respective plugins.
-                #
-                # TODO: Handle messages in spool directories for which a
-                # plugin had been enabled, but is not enabled any longer.
-                #
-
-                if module.lower() == "defer":
-                    # Wallace was unable to deliver to re-injection smtpd.
-                    # Skip it, another thread is picking up the deferred
-                    # messages.
-                    continue
-
-                stage = root.replace(pickup_path, '').split('/')
-
-                if len(stage) < 2:
-                    stage = None
-                else:
-                    stage = stage[1]
-
-                if stage.lower() == "hold":
-                    continue
-
-                # Do not handle messages in a defer state.
-                if stage.lower() == "defer":
-                    continue
-
-                self.current_connections += 1
-
-                if sync:
-                    pickup_message(filepath, self.modules, module=module, stage=stage)
-                else:
-                    self.pool.apply_async(
-                        pickup_message,
-                        (
-                            filepath,
-                            (self.modules),
-                            {'module': module, 'stage': stage}
-                        )
-                    )
-
-                self.current_connections -= 1
-
-                continue
-
-            self.current_connections += 1
-
-            if sync:
-                pickup_message(filepath, self.modules)
-            else:
-                self.pool.apply_async(pickup_message, (filepath, (self.modules)))
-
-            self.current_connections -= 1
+    def pickup_spool_message(self, filepath, module, stage):
+        """
+            Pick up a message from the spool, as it becomes due in the spool
+            index.
+        """
+        if module is None:
+            pickup_message(filepath, self.modules)
+        elif module == 'DEFER':
+            modules.reinject_deferred(filepath)
+            modules.release_messages()
+        else:
+            pickup_message(filepath, self.modules, module=module, stage=stage)
 
     def process_message(self, peer, mailfrom, rcpttos, data):
         """
@@ -486,8 +456,6 @@ class WallaceDaemon:
         log.debug(_l("Started processing accepted message %s") % filename, level=8)
         self.pool.apply_async(pickup_message, (filename, (self.modules)))
 
-        self.current_connections -= 1
-
         return "250 OK Message %s queued" % (filename)
 
     def reload_config(self, *args, **kwargs):
@@ -501,11 +469,10 @@ class WallaceDaemon:
                 log.debug(_l("Terminating processes pool"), level=8)
                 self.pool.close()
 
-                if hasattr(self, 'timer'):
-                    if not self.timer.finished.is_set():
-                        log.debug("Canceling Wallace Timer", level=8)
-                        self.timer.finished.set()
-                        self.timer.cancel()
+                if self.spool_watcher is not None:
+                    if not self.spool_watcher.finished.is_set():
+                        log.debug("Stopping Wallace spool watcher", level=8)
+                        self.spool_watcher.finished.set()
 
                 log.debug(_l("Terminating heartbeat process"), level=8)
                 self.heartbeat.finished.set()
@@ -513,7 +480,9 @@ class WallaceDaemon:
 
                 self.pool.close()
                 self.pool.join(5)
-                self.timer.join(5)
+                if self.spool_watcher is not None:
+                    self.spool_watcher.join(5)
+
                 self.heartbeat.join(5)
 
                 if os.access(conf.pidfile, os.R_OK):
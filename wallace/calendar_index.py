@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010-2019 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    An index of the events in a calendar folder, by IMAP UID, with the
+    time span each event covers including all of its occurrences.
+
+    The index is stored on disk, and brought up to date by fetching only the
+    messages that have been added to the folder since. Messages in IMAP do
+    not change, so that the UIDs that have gone from the folder are all that
+    needs to be dropped. A change of UIDVALIDITY invalidates the index.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import pykolab
+
+from pykolab.constants import KOLAB_LIB_PATH
+from pykolab.translate import _
+
+# pylint: disable=invalid-name
+log = pykolab.getLogger('pykolab.wallace/calendar_index')
+conf = pykolab.getConf()
+
+index_path = os.path.join(KOLAB_LIB_PATH, 'calendar_index')
+
+
+def overlaps(entry, start, end):
+    """
+        Whether the span of an index entry overlaps with the span from start
+        to end, where None stands for an open end.
+    """
+    if entry['start'] is not None and end is not None and entry['start'] > end:
+        return False
+
+    if entry['end'] is not None and start is not None and entry['end'] < start:
+        return False
+
+    return True
+
+
+class CalendarIndex(object):
+    """
+        The index of the calendar folder mailbox.
+
+        Entries are dictionaries with the event 'uid', and the 'start' and
+        'end' of its span as UNIX timestamps, None for an open end. Messages
+        that do not hold an event have an entry with a 'uid' of None.
+    """
+
+    def __init__(self, mailbox, owner=None):
+        """
+            The mailbox name may be relative to the namespace of the owner
+            (such as 'Calendar'), in which case the owner tells apart the
+            mailboxes of the same name.
+        """
+        self.mailbox = mailbox
+        self.owner = owner
+
+        if owner is not None:
+            mailbox = u'%s\0%s' % (owner, mailbox)
+
+        if isinstance(mailbox, unicode):
+            mailbox = mailbox.encode('utf-8')
+
+        self.filepath = os.path.join(index_path, '%s.json' % (hashlib.sha1(mailbox).hexdigest()))
+
+        self.uidvalidity = None
+        self.entries = {}
+        self.mtime = None
+
+    def load(self):
+        """
+            (Re-)read the index from disk, if it has changed.
+        """
+        try:
+            mtime = os.stat(self.filepath).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.mtime:
+            return
+
+        try:
+            with open(self.filepath, 'r') as f:
+                data = json.loads(f.read())
+
+            self.uidvalidity = data['uidvalidity']
+            self.entries = data['entries']
+            self.mtime = mtime
+
+        except (IOError, ValueError, KeyError) as errmsg:
+            log.warning(_("Discarding calendar index %s: %r") % (self.filepath, errmsg))
+            self.uidvalidity = None
+            self.entries = {}
+
+    def save(self):
+        try:
+            if not os.path.isdir(index_path):
+                os.makedirs(index_path)
+
+            (fp, filename) = tempfile.mkstemp(dir=index_path)
+            os.write(
+                fp,
+                json.dumps({
+                    'mailbox': self.mailbox,
+                    'owner': self.owner,
+                    'uidvalidity': self.uidvalidity,
+                    'entries': self.entries
+                })
+            )
+            os.close(fp)
+            os.rename(filename, self.filepath)
+
+            self.mtime = os.stat(self.filepath).st_mtime
+
+        except (IOError, OSError) as errmsg:
+            log.error(_("Could not write calendar index %s: %r") % (self.filepath, errmsg))
+
+    def update(self, uidvalidity, uids, fetch):
+        """
+            Bring the index up to date with the list of (string) UIDs in the
+            folder. The fetch callable is passed the list of UIDs not yet
+            indexed, and returns a dictionary of their entries.
+        """
+        self.load()
+
+        changed = False
+
+        if not self.uidvalidity == uidvalidity:
+            if self.uidvalidity is not None:
+                log.debug(
+                    _("UIDVALIDITY of %r changed, rebuilding calendar index") % (self.mailbox),
+                    level=8
+                )
+
+            self.uidvalidity = uidvalidity
+            self.entries = {}
+            changed = True
+
+        current = set(uids)
+
+        for uid in [x for x in self.entries if x not in current]:
+            del self.entries[uid]
+            changed = True
+
+        new_uids = [x for x in uids if x not in self.entries]
+
+        if new_uids:
+            log.debug(
+                _("Indexing %d new message(s) in %r") % (len(new_uids), self.mailbox),
+                level=8
+            )
+
+            self.entries.update(fetch(new_uids))
+            changed = True
+
+        if changed:
+            self.save()
+
+    def candidates(self, uid, start, end):
+        """
+            Return the UIDs of the messages with the event uid, or with an
+            event that may conflict with the span from start to end, in
+            ascending order.
+        """
+        result = [
+            x for x, entry in self.entries.items()
+            if entry['uid'] is not None and (entry['uid'] == uid or overlaps(entry, start, end))
+        ]
+
+        return sorted(result, key=int)
+
+    def find(self, uid):
+        """
+            Return the UIDs of the messages with the event uid, in ascending
+            order.
+        """
+        return sorted([x for x, entry in self.entries.items() if entry['uid'] == uid], key=int)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010-2019 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    Named locks shared between the Wallace worker processes.
+
+    Each lock is a file in a directory, held with flock(), so that a lock
+    held by a process that has gone away is released by the kernel, rather
+    than having to be found stale.
+"""
+
+import errno
+import fcntl
+import os
+import time
+
+import pykolab
+
+from pykolab.translate import _
+
+# pylint: disable=invalid-name
+log = pykolab.getLogger('pykolab.wallace/locks')
+conf = pykolab.getConf()
+
+# How long to wait in between attempts at a lock held elsewhere, doubling
+# with every attempt up to the maximum.
+retry_interval = 0.01
+retry_max_interval = 0.5
+
+
+class LockTimeout(Exception):
+    def __init__(self, key, timeout):
+        Exception.__init__(self, _("Timed out waiting %ds for lock %r") % (timeout, key))
+        self.key = key
+        self.timeout = timeout
+
+
+class LockManager(object):
+    """
+        The locks in path, and the ones this process holds, with statistics
+        on how often and how long the locks were contended.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.held = {}
+
+        self.stats = {
+            'acquired': 0,
+            'contended': 0,
+            'timeouts': 0,
+            'wait_time': 0.0
+        }
+
+    def acquire(self, key, timeout=None):
+        """
+            Acquire the lock for key, waiting for up to timeout seconds (None
+            to wait forever, 0 to not wait at all) if it is held elsewhere.
+            Returns whether the lock has been acquired.
+        """
+        if key in self.held:
+            return True
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        filename = os.path.join(self.path, key + '.lock')
+
+        start = time.time()
+        interval = retry_interval
+        contended = False
+
+        while True:
+            fd = self._lock(filename)
+
+            if fd is not None:
+                break
+
+            if not contended:
+                contended = True
+                self.stats['contended'] += 1
+
+            waited = time.time() - start
+
+            if timeout is not None and waited + interval > timeout:
+                self.stats['timeouts'] += 1
+                self.stats['wait_time'] += waited
+                return False
+
+            log.debug(_("%r is locked, waiting...") % (key), level=8)
+
+            time.sleep(interval)
+            interval = min(interval * 2, retry_max_interval)
+
+        self.held[key] = (fd, filename)
+        self.stats['acquired'] += 1
+
+        if contended:
+            waited = time.time() - start
+            self.stats['wait_time'] += waited
+            log.debug(_("Acquired lock %r after %.3fs") % (key, waited), level=8)
+
+        return True
+
+    def release(self, key):
+        if key not in self.held:
+            return
+
+        (fd, filename) = self.held.pop(key)
+
+        # Remove the file while still holding the lock, so that the next one
+        # in line notices and locks a new file.
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+        os.close(fd)
+
+    def release_all(self):
+        for key in list(self.held):
+            self.release(key)
+
+    def _lock(self, filename):
+        """
+            Return a file descriptor for filename with the lock held on it,
+            or None if it is held elsewhere.
+        """
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as errmsg:
+            os.close(fd)
+
+            if errmsg.errno in [errno.EAGAIN, errno.EACCES]:
+                return None
+
+            raise
+
+        # The holder before us may have removed the file in the meanwhile.
+        try:
+            if os.fstat(fd).st_ino == os.stat(filename).st_ino:
+                return fd
+        except OSError:
+            pass
+
+        os.close(fd)
+
+        return self._lock(filename)
@@ -19,10 +19,8 @@
 
 import os
 import re
-import tempfile
 import time
 
-from email import message_from_file
 from email.encoders import encode_quopri
 
 import modules
@@ -104,7 +102,7 @@ def execute(*args, **kw):
     filepath = new_filepath
 
     # parse message
-    message = message_from_file(open(filepath, 'r'))
+    message = modules.message_from_spool(filepath)
 
     # Possible footer answers are limited to ACCEPT only
     answers = [ 'ACCEPT' ]
@@ -177,9 +175,7 @@ def execute(*args, **kw):
         log.debug("Footer attached.")
         message.add_header("X-Wallace-Footer", "YES")
 
-    (fp, new_filepath) = tempfile.mkstemp(dir="/var/spool/pykolab/wallace/footer/ACCEPT")
-    os.write(fp, message.as_string())
-    os.close(fp)
-    os.unlink(filepath)
-
-    exec('modules.cb_action_%s(%r, %r)' % ('ACCEPT','footer', new_filepath))
+        # The message is written out only if it can not be re-injected.
+        modules.cb_action_ACCEPT('footer', filepath, message=message)
+    else:
+        exec('modules.cb_action_%s(%r, %r)' % ('ACCEPT','footer', filepath))
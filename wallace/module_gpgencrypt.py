@@ -18,13 +18,11 @@
 #
 
 import os
-import tempfile
 import time
 
 from email import message_from_string
 from email.MIMEBase import MIMEBase
 from email.MIMEText import MIMEText
-from email.parser import Parser
 from email.utils import formataddr
 from email.utils import getaddresses
 
@@ -120,7 +118,7 @@ def execute(*args, **kw):
 
     # parse message headers
     # @TODO: make sure we can use True as the 2nd argument here
-    message = Parser().parse(open(filepath, 'r'), True)
+    message = modules.message_from_spool(filepath, True)
 
     # Possible gpgencrypt answers are limited to ACCEPT only
     answers = [ 'ACCEPT' ]
@@ -280,12 +278,8 @@ def execute(*args, **kw):
 
             message.add_header('X-wallace-gpg-encrypted', 'true')
 
-        (fp, new_filepath) = tempfile.mkstemp(dir="/var/spool/pykolab/wallace/gpgencrypt/ACCEPT")
-        os.write(fp, message.as_string())
-        os.close(fp)
-        os.unlink(filepath)
-
-        exec('modules.cb_action_%s(%r, %r)' % ('ACCEPT','gpgencrypt', new_filepath))
+        # The message is written out only if it can not be re-injected.
+        modules.cb_action_ACCEPT('gpgencrypt', filepath, message=message)
     except Exception as errmsg:
         log.error(_("An error occurred: %r") % (errmsg))
         if conf.debuglevel > 8:
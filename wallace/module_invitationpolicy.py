@@ -23,17 +23,18 @@ import random
 import signal
 import tempfile
 import time
+from collections import OrderedDict
 from urlparse import urlparse
 import urllib
 import hashlib
 import traceback
-import re
 
 from email import message_from_string
-from email.parser import Parser
 from email.utils import formataddr
 from email.utils import getaddresses
 
+import calendar_index
+import locks
 import modules
 
 import pykolab
@@ -43,13 +44,15 @@ from pykolab import utils
 from pykolab.auth import Auth
 from pykolab.conf import Conf
 from pykolab.imap import IMAP
+from pykolab.imap import parse_appenduid
 from pykolab.xml import to_dt
 from pykolab.xml import utils as xmlutils
 from pykolab.xml import todo_from_message
 from pykolab.xml import event_from_message
 from pykolab.xml import participant_status_label
 from pykolab.itip import objects_from_message
-from pykolab.itip import check_event_conflict
+from pykolab.itip import check_event_conflicts
+from pykolab.itip import event_span
 from pykolab.itip import send_reply
 from pykolab.translate import _
 
@@ -155,7 +158,29 @@ mybasepath = '/var/spool/pykolab/wallace/invitationpolicy/'
 
 auth = None
 imap = None
-write_locks = []
+lock_manager = None
+
+# The connection logged in as the administrator for the message at hand,
+# which imap is switched away from to the sessions of the users.
+admin_imap = None
+
+# The IMAP sessions authorized as the users acted on, by login, in the order
+# they have last been used in. Sessions idle for longer than session_idle
+# seconds are dropped, as are the least recently used beyond the pool size.
+imap_sessions = OrderedDict()
+session_pool_size = 100
+session_idle = 300
+
+# How long the metadata of a user's folders is used for
+session_metadata_ttl = 60
+
+# The calendar indexes of the users' event folders, by the user's login and
+# the folder name. They are kept on disk as well.
+calendar_indexes = utils.LRUCache(size=1000)
+
+# Where objects have last been seen, as (folder, message UID) by the user
+# and object UID.
+object_locations = utils.LRUCache(size=10000)
 
 def __init__():
     modules.register('invitationpolicy', execute, description=description())
@@ -187,7 +212,7 @@ def description():
     return """Invitation policy execution module."""
 
 def cleanup():
-    global auth, imap, write_locks, extra_log_params
+    global auth, imap, admin_imap, extra_log_params
 
     log.debug("cleanup(): %r, %r" % (auth, imap), level=8)
 
@@ -196,16 +221,25 @@ def cleanup():
     auth.disconnect()
     del auth
 
-    # Disconnect IMAP or we lock the mailbox almost constantly
-    imap.disconnect()
+    # Disconnect IMAP or we lock the mailbox almost constantly, but keep the
+    # sessions of the users for the next message
+    if imap not in [x['imap'] for x in imap_sessions.values()]:
+        imap.disconnect()
+
     del imap
 
+    if admin_imap is not None:
+        admin_imap.disconnect()
+        admin_imap = None
+
     # remove remaining write locks
-    for key in write_locks:
-        remove_write_lock(key, False)
+    if lock_manager is not None:
+        lock_manager.release_all()
+
+        log.debug(_("Write locks: %r") % (lock_manager.stats), level=8)
 
 def execute(*args, **kw):
-    global auth, imap, extra_log_params
+    global auth, imap, admin_imap, extra_log_params
 
     filepath = args[0]
 
@@ -224,7 +258,7 @@ def execute(*args, **kw):
     log.debug(_("Invitation policy called for %r, %r") % (args, kw), level=8)
 
     auth = Auth()
-    imap = IMAP()
+    imap = admin_imap = IMAP()
 
     # ignore calls on lock files
     if '/locks/' in filepath or 'stage' in kw and kw['stage'] == 'locks':
@@ -262,7 +296,7 @@ def execute(*args, **kw):
             filepath = new_filepath
 
     # parse full message
-    message = Parser().parse(open(filepath, 'r'))
+    message = modules.message_from_spool(filepath)
 
     # invalid message, skip
     if not message.get('X-Kolab-To'):
@@ -375,16 +409,24 @@ def execute(*args, **kw):
         # connect as cyrus-admin
         imap.connect()
 
-        for policy in policies:
-            log.debug(_("Apply invitation policy %r for sender %r") % (policy_value_map[policy], sender_email), level=8)
-            done = processor_func(itip_event, policy, recipient_email, sender_email, receiving_user)
+        try:
+            for policy in policies:
+                log.debug(_("Apply invitation policy %r for sender %r") % (policy_value_map[policy], sender_email), level=8)
+                done = processor_func(itip_event, policy, recipient_email, sender_email, receiving_user)
 
-            # matching policy found
-            if done is not None:
-                break
+                # matching policy found
+                if done is not None:
+                    break
 
-            # remove possible write lock from this iteration
-            remove_write_lock(get_lock_key(receiving_user, itip_event['uid']))
+                # remove possible write lock from this iteration
+                remove_write_lock(get_lock_key(receiving_user, itip_event['uid']))
+
+        except locks.LockTimeout as errmsg:
+            # Leave the message in the incoming stage to be picked up again,
+            # rather than keeping this worker waiting.
+            log.info(_("Postponing message %s: %s") % (filepath, errmsg))
+            cleanup()
+            return None
 
     else:
         log.debug(_("Ignoring '%s' iTip method") % (itip_event['method']), level=8)
@@ -757,10 +799,22 @@ def get_matching_invitation_policies(receiving_user, sender_email, type_conditio
 
 def imap_proxy_auth(user_rec):
     """
-        Perform IMAP login using proxy authentication with admin credentials
+        Perform IMAP login using proxy authentication with admin credentials,
+        or switch to the session logged in as the user before.
     """
     global imap
 
+    session = get_user_session(user_rec)
+
+    if session is None:
+        return False
+
+    imap = session['imap']
+
+    return True
+
+
+def session_login(user_rec):
     mail_attribute = conf.get('cyrus-sasl', 'result_attribute')
     if mail_attribute is None:
         mail_attribute = 'mail'
@@ -769,22 +823,107 @@ def imap_proxy_auth(user_rec):
 
     if mail_attribute not in user_rec:
         log.error(_("User record doesn't have the mailbox attribute %r set" % (mail_attribute)))
-        return False
+        return None
 
-    # do IMAP prox auth with the given user
-    backend = conf.get('kolab', 'imap_backend')
-    admin_login = conf.get(backend, 'admin_login')
-    admin_password = conf.get(backend, 'admin_password')
+    return user_rec[mail_attribute]
 
-    try:
-        imap.disconnect()
-        imap.connect(login=False)
-        imap.login_plain(admin_login, admin_password, user_rec[mail_attribute])
-    except Exception as errmsg:
-        log.error(_("IMAP proxy authentication failed: %r") % (errmsg))
-        return False
 
-    return True
+def get_user_session(user_rec):
+    """
+        Return the pooled IMAP session authorized as the user, logging in
+        with proxy authentication if there is none, or it has been dropped.
+    """
+    login = session_login(user_rec)
+
+    if login is None:
+        return None
+
+    now = time.time()
+
+    for _login, _session in list(imap_sessions.items()):
+        if _session['used'] + session_idle < now:
+            close_user_session(_login)
+
+    session = imap_sessions.pop(login, None)
+
+    if session is not None:
+        try:
+            session['imap'].imap.m.noop()
+        except Exception as errmsg:
+            log.debug(_("IMAP session for %r lost: %r") % (login, errmsg), level=8)
+            session['imap'].disconnect()
+            session = None
+
+    if session is None:
+        # do IMAP prox auth with the given user
+        backend = conf.get('kolab', 'imap_backend')
+        admin_login = conf.get(backend, 'admin_login')
+        admin_password = conf.get(backend, 'admin_password')
+
+        _imap = IMAP()
+
+        try:
+            _imap.connect(login=False)
+            _imap.login_plain(admin_login, admin_password, login)
+        except Exception as errmsg:
+            log.error(_("IMAP proxy authentication failed: %r") % (errmsg))
+            return None
+
+        session = {
+            'imap': _imap,
+            'namespaces': None,
+            'metadata': None,
+            'metadata_time': 0
+        }
+
+    session['used'] = now
+    imap_sessions[login] = session
+
+    while len(imap_sessions) > session_pool_size:
+        close_user_session(imap_sessions.keys()[0])
+
+    return session
+
+
+def close_user_session(login):
+    session = imap_sessions.pop(login, None)
+
+    if session is not None:
+        log.debug(_("Closing IMAP session for %r") % (login), level=8)
+        session['imap'].disconnect()
+
+
+def get_user_folder_metadata(user_rec):
+    """
+        Return the metadata of all folders the user can see, and the user's
+        namespaces, as cached with the user's session if not too old.
+    """
+    session = imap_sessions.get(session_login(user_rec))
+
+    if session is None:
+        return ({}, (None, None, None))
+
+    if session['namespaces'] is None:
+        session['namespaces'] = session['imap'].namespaces()
+
+    if session['metadata'] is None or session['metadata_time'] + session_metadata_ttl < time.time():
+        session['metadata'] = session['imap'].get_metadata('*')
+        session['metadata_time'] = time.time()
+
+    return (session['metadata'], session['namespaces'])
+
+
+def forget_user_folder_metadata(user_rec):
+    """
+        Have the metadata of the user's folders read again, after a folder
+        turned out to not be there (anymore).
+    """
+    user_rec.pop('_imap_folders', None)
+
+    login = session_login(user_rec)
+
+    if login in imap_sessions:
+        imap_sessions[login]['metadata'] = None
 
 
 def list_user_folders(user_rec, _type):
@@ -802,7 +941,7 @@ def list_user_folders(user_rec, _type):
     if not imap_proxy_auth(user_rec):
         return result
 
-    folders = imap.get_metadata('*')
+    (folders, (ns_personal, ns_other, ns_shared)) = get_user_folder_metadata(user_rec)
 
     log.debug(
         _("List %r folders for user %r: %r") % (
@@ -813,8 +952,6 @@ def list_user_folders(user_rec, _type):
         level=8
     )
 
-    (ns_personal, ns_other, ns_shared) = imap.namespaces()
-
     _folders = {}
 
     # Filter the folders by type relevance
@@ -898,27 +1035,17 @@ def find_existing_object(uid, type, recurrence_id, user_rec, lock=False):
         lock_key = get_lock_key(user_rec, uid)
         set_write_lock(lock_key)
 
+    location_key = (user_rec['mail'], uid)
+
     event = None
     master = None
-    for folder in list_user_folders(user_rec, type):
-        log.debug(_("Searching folder %r for %s %r") % (folder, type, uid), level=8)
-        imap.imap.m.select(imap.folder_utf7(folder))
-
-        res, data = imap.imap.m.search(None, '(UNDELETED HEADER SUBJECT "%s")' % (uid))
-        for num in reversed(data[0].split()):
-            res, data = imap.imap.m.fetch(num, '(UID RFC822)')
-
-            try:
-                msguid = re.search(r"\WUID (\d+)", data[0][0]).group(1)
-            except Exception:
-                log.error(_("No UID found in IMAP response: %r") % (data[0][0]))
-                continue
-
+    for folder, msguids in find_object_messages(uid, type, user_rec):
+        for msguid, data in imap.fetch_messages(reversed(msguids)):
             try:
                 if type == 'task':
-                    event = todo_from_message(message_from_string(data[0][1]))
+                    event = todo_from_message(message_from_string(data))
                 else:
-                    event = event_from_message(message_from_string(data[0][1]))
+                    event = event_from_message(message_from_string(data))
 
                 # find instance in a recurring series
                 if recurrence_id and (event.is_recurring() or event.has_exceptions() or event.get_recurrence_id()):
@@ -926,23 +1053,27 @@ def find_existing_object(uid, type, recurrence_id, user_rec, lock=False):
                     event = master.get_instance(recurrence_id)
                     setattr(master, '_imap_folder', folder)
                     setattr(master, '_msguid', msguid)
+                    setattr(master, '_location_key', location_key)
 
                     # return master, even if instance is not found
                     if not event and master.uid == uid:
+                        object_locations.set(location_key, (folder, msguid))
                         return (event, master)
 
                 if event is not None:
                     setattr(event, '_imap_folder', folder)
                     setattr(event, '_lock_key', lock_key)
                     setattr(event, '_msguid', msguid)
+                    setattr(event, '_location_key', location_key)
 
             except Exception:
-                log.error(_("Failed to parse %s from message %s/%s: %s") % (type, folder, num, traceback.format_exc()))
+                log.error(_("Failed to parse %s from message %s/%s: %s") % (type, folder, msguid, traceback.format_exc()))
                 event = None
                 master = None
                 continue
 
             if event and event.uid == uid:
+                object_locations.set(location_key, (folder, msguid))
                 return (event, master)
 
     if lock_key is not None:
@@ -951,6 +1082,45 @@ def find_existing_object(uid, type, recurrence_id, user_rec, lock=False):
     return (event, master)
 
 
+def find_object_messages(uid, type, user_rec):
+    """
+        Yield the user's folders of the given type, each selected in turn,
+        with the UIDs of the messages in it that may hold the object. The
+        message the object has last been seen in comes first.
+    """
+    # The folders are selected in the user's session.
+    if not imap_proxy_auth(user_rec):
+        return
+
+    location = object_locations.get((user_rec['mail'], uid))
+
+    if location is not None:
+        (folder, msguid) = location
+        log.debug(_("Looking up %s %r in folder %r by UID %s") % (type, uid, folder, msguid), level=8)
+
+        res, data = imap.imap.m.select(imap.folder_utf7(folder))
+
+        # The message may have been replaced by a client, and be about to be
+        # expunged.
+        if res == 'OK' and imap.message_deleted(msguid):
+            object_locations.delete((user_rec['mail'], uid))
+
+        elif res == 'OK':
+            yield (folder, [msguid])
+
+    for folder in list_user_folders(user_rec, type):
+        log.debug(_("Searching folder %r for %s %r") % (folder, type, uid), level=8)
+
+        if type == 'event':
+            msguids = read_calendar_index(folder, user_rec)[0].find(uid)
+        else:
+            imap.imap.m.select(imap.folder_utf7(folder))
+            res, data = imap.imap.m.uid('SEARCH', None, '(UNDELETED HEADER SUBJECT "%s")' % (uid))
+            msguids = data[0].split()
+
+        yield (folder, msguids)
+
+
 def check_availability(itip_event, receiving_user):
     """
         For the receiving user, determine if the event in question is in conflict.
@@ -964,30 +1134,27 @@ def check_availability(itip_event, receiving_user):
     if '_conflicts' in itip_event:
         return not itip_event['_conflicts']
 
+    (start, end) = event_span(itip_event['xml'])
+
     for folder in list_user_folders(receiving_user, 'event'):
         log.debug(_("Listing events from folder %r") % (folder), level=8)
-        imap.imap.m.select(imap.folder_utf7(folder))
 
-        res, data = imap.imap.m.search(None, '(UNDELETED HEADER X-Kolab-Type "application/x-vnd.kolab.event")')
-        num_messages += len(data[0].split())
+        (index, events) = read_calendar_index(folder, receiving_user)
+        num_messages += len(index.entries)
 
-        for num in reversed(data[0].split()):
-            event = None
-            res, data = imap.imap.m.fetch(num, '(RFC822)')
+        # Only the events the index can not rule out are read and checked.
+        candidates = index.candidates(itip_event['uid'], start, end)
+        events.update(fetch_events(folder, [x for x in candidates if x not in events]))
 
-            try:
-                event = event_from_message(message_from_string(data[0][1]))
-            except Exception as errmsg:
-                log.error(_("Failed to parse event from message %s/%s: %r") % (folder, num, errmsg))
-                continue
-
-            if event and event.uid:
-                conflict = check_event_conflict(event, itip_event)
-                if conflict:
-                    log.info(_("Existing event %r conflicts with invitation %r") % (event.uid, itip_event['uid']))
-                    break
+        conflicts = check_event_conflicts(
+            [events[x] for x in reversed(candidates) if events.get(x) is not None],
+            itip_event,
+            first=True
+        )
 
-        if conflict:
+        if conflicts:
+            log.info(_("Existing event %r conflicts with invitation %r") % (conflicts[0].uid, itip_event['uid']))
+            conflict = True
             break
 
     end = time.time()
@@ -999,54 +1166,101 @@ def check_availability(itip_event, receiving_user):
     return not conflict
 
 
-def set_write_lock(key, wait=True):
+def fetch_events(folder, uids):
     """
-        Set a write-lock for the given key and wait if such a lock already exists
+        Fetch and parse the events in the messages with the given UIDs in the
+        selected folder. Returns a dictionary of UID to event, or None for
+        messages that do not parse.
     """
-    if not os.path.isdir(mybasepath):
-        os.makedirs(mybasepath)
-    if not os.path.isdir(os.path.join(mybasepath, 'locks')):
-        os.makedirs(os.path.join(mybasepath, 'locks'))
+    events = {}
 
-    filename = os.path.join(mybasepath, 'locks', key + '.lock')
-    locktime = 0
+    for msguid, data in imap.fetch_messages(uids):
+        try:
+            events[msguid] = event_from_message(message_from_string(data))
+        except Exception as errmsg:
+            log.error(_("Failed to parse event from message %s/%s: %r") % (folder, msguid, errmsg))
+            events[msguid] = None
 
-    if os.path.isfile(filename):
-        locktime = os.path.getmtime(filename)
+    return events
 
-    # wait if file lock is in place
-    while time.time() < locktime + 300:
-        if not wait:
-            return False
 
-        log.debug(_("%r is locked, waiting...") % (key), level=8)
-        time.sleep(0.5)
-        locktime = os.path.getmtime(filename) if os.path.isfile(filename) else 0
+def read_calendar_index(folder, user_rec):
+    """
+        Select the user's event folder and bring its calendar index up to
+        date with the messages added since. Returns the index, and the events
+        that were fetched for it by message UID.
 
-    # touch the file
-    if os.path.isfile(filename):
-        os.utime(filename, None)
-    else:
-        open(filename, 'w').close()
+        The folder name is relative to the user's namespace, so that the
+        index is the user's.
+    """
+    login = session_login(user_rec)
 
-    # register active lock
-    write_locks.append(key)
+    imap.imap.m.select(imap.folder_utf7(folder))
+    typ, data = imap.imap.m.response('UIDVALIDITY')
+    uidvalidity = data[-1]
 
-    return True
+    res, data = imap.imap.m.uid('SEARCH', None, '(UNDELETED HEADER X-Kolab-Type "application/x-vnd.kolab.event")')
+    uids = data[0].split()
+
+    index = calendar_indexes.get((login, folder))
+
+    if index is None:
+        index = calendar_index.CalendarIndex(folder, owner=login)
+        calendar_indexes.set((login, folder), index)
+
+    # The events fetched for the index, so they need not be fetched again.
+    events = {}
+
+    def fetch(new_uids):
+        events.update(fetch_events(folder, new_uids))
+        entries = {}
+
+        for msguid in new_uids:
+            event = events.get(msguid)
+
+            if event is None or not event.uid:
+                entries[msguid] = {'uid': None, 'start': None, 'end': None}
+                continue
 
+            (start, end) = event_span(event)
+            entries[msguid] = {'uid': event.uid, 'start': start, 'end': end}
 
-def remove_write_lock(key, update=True):
+        return entries
+
+    index.update(uidvalidity, uids, fetch)
+
+    return (index, events)
+
+
+def set_write_lock(key, wait=True):
     """
-        Remove the lock file for the given key
+        Set a write-lock for the given key and wait if such a lock already exists.
+
+        Waits for up to the configured lock_timeout, and raises LockTimeout
+        if the lock is still held elsewhere by then.
     """
-    global write_locks
+    global lock_manager
+
+    if lock_manager is None:
+        lock_manager = locks.LockManager(os.path.join(mybasepath, 'locks'))
 
-    if key is not None:
-        file = os.path.join(mybasepath, 'locks', key + '.lock')
-        if os.path.isfile(file):
-            os.remove(file)
-            if update:
-                write_locks = [k for k in write_locks if not k == key]
+    if not wait:
+        return lock_manager.acquire(key, 0)
+
+    timeout = int(conf.get('wallace', 'invitationpolicy_lock_timeout'))
+
+    if not lock_manager.acquire(key, timeout):
+        raise locks.LockTimeout(key, timeout)
+
+    return True
+
+
+def remove_write_lock(key):
+    """
+        Remove the lock for the given key
+    """
+    if key is not None and lock_manager is not None:
+        lock_manager.release(key)
 
 
 def get_lock_key(user, uid):
@@ -1120,6 +1334,12 @@ def store_object(object, user_rec, targetfolder=None, master=None):
             None,
             saveobj.to_message(creator="Kolab Server <wallace@localhost>").as_string()
         )
+
+        msguid = parse_appenduid(result[1])
+
+        if msguid is not None:
+            object_locations.set((user_rec['mail'], saveobj.uid), (targetfolder, msguid))
+
         return result
 
     except Exception as errmsg:
@@ -1127,6 +1347,8 @@ def store_object(object, user_rec, targetfolder=None, master=None):
             saveobj.type, targetfolder, errmsg
         ))
 
+        forget_user_folder_metadata(user_rec)
+
     return False
 
 
@@ -1158,6 +1380,14 @@ def delete_object(existing):
                 imap.imap.m.store(num, '+FLAGS', '(\\Deleted)')
 
         imap.imap.m.expunge()
+
+        # forget about the message, unless the object has been stored anew
+        if hasattr(existing, '_location_key'):
+            location = object_locations.get(existing._location_key)
+
+            if location is not None and location[0] == targetfolder and msguid in [None, location[1]]:
+                object_locations.delete(existing._location_key)
+
         return True
 
     except Exception as errmsg:
@@ -1304,7 +1534,7 @@ def send_update_notification(object, receiving_user, old=None, reply=True, sende
     log.debug(_("Set alarm to %s seconds") % (alarm_after), level=8)
     signal.alarm(alarm_after)
 
-    result = modules._sendmail(orgemail, receiving_user['mail'], msg.as_string())
+    result = modules._sendmail_or_defer(orgemail, receiving_user['mail'], msg.as_string())
     log.debug(_("Sent update notification to %r: %r") % (receiving_user['mail'], result), level=8)
     signal.alarm(0)
 
@@ -1374,7 +1604,7 @@ def send_cancel_notification(object, receiving_user, deleted=False, sender=None,
     log.debug(_("Set alarm to %s seconds") % (alarm_after), level=8)
     signal.alarm(alarm_after)
 
-    result = modules._sendmail(orgemail, receiving_user['mail'], msg.as_string())
+    result = modules._sendmail_or_defer(orgemail, receiving_user['mail'], msg.as_string())
     log.debug(_("Sent cancel notification to %r: %r") % (receiving_user['mail'], result), level=8)
     signal.alarm(0)
 
@@ -1418,7 +1648,14 @@ def propagate_changes_to_attendees_accounts(object, updated_attendees=None):
         attendee_user_dn = user_dn_from_email_address(attendee.get_email())
         if attendee_user_dn:
             attendee_user = auth.get_entry_attributes(None, attendee_user_dn, ['*'])
-            (attendee_object, master_object) = find_existing_object(object.uid, object.type, recurrence_id, attendee_user, True)  # does IMAP authenticate
+
+            try:
+                (attendee_object, master_object) = find_existing_object(object.uid, object.type, recurrence_id, attendee_user, True)  # does IMAP authenticate
+            except locks.LockTimeout as errmsg:
+                # The changes to this object have been applied already, so do not
+                # have the message picked up again just for this copy of it.
+                log.warning(_("Not updating %s's copy of %r: %s") % (attendee_user['mail'], object.uid, errmsg))
+                continue
             if attendee_object:
                 # find attendee's entry by one of its email addresses
                 attendee_emails = auth.extract_recipient_addresses(attendee_user)
@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 import json
 import os
 import random
@@ -25,7 +26,6 @@ import time
 from urlparse import urlparse
 import urllib
 
-from email import message_from_file
 from email.utils import formataddr
 from email.utils import getaddresses
 
@@ -69,7 +69,7 @@ def execute(*args, **kw):
 
     log.debug(_("Consulting opt-out service for %r, %r") % (args, kw), level=8)
 
-    message = message_from_file(open(filepath, 'r'))
+    message = modules.message_from_spool(filepath)
     envelope_sender = getaddresses(message.get_all('From', []))
 
     recipients = {
@@ -132,7 +132,9 @@ def execute(*args, **kw):
 
         # Write out a message file representing the new contents for the message
         # use formataddr(recipient)
-        _message = message_from_file(open(filepath, 'r'))
+        # Deleting a header replaces the list of headers of the copy, so
+        # the headers set after that do not end up in the original.
+        _message = copy.copy(message)
 
         use_this = False
 
@@ -22,7 +22,6 @@ import base64
 import datetime
 
 from email import message_from_string
-from email.parser import Parser
 from email.utils import formataddr
 from email.utils import getaddresses
 
@@ -37,16 +36,20 @@ import uuid
 from dateutil.tz import tzlocal
 
 import modules
+import calendar_index
 
 import kolabformat
 
 import pykolab
+from pykolab import utils
 from pykolab.auth import Auth
 from pykolab.conf import Conf
 from pykolab.imap import IMAP
+from pykolab.imap import parse_appenduid
 from pykolab.logger import LoggerAdapter
 from pykolab.itip import events_from_message
 from pykolab.itip import check_event_conflict
+from pykolab.itip import event_span
 from pykolab.translate import _
 from pykolab.xml import to_dt
 from pykolab.xml import utils as xmlutils
@@ -83,6 +86,13 @@ mybasepath = '/var/spool/pykolab/wallace/resources/'
 auth = None
 imap = None
 
+# The calendar indexes of the resource folders, by folder name.
+calendar_indexes = {}
+
+# The message UIDs events have last been seen in, by the resource folder
+# name and event UID.
+object_locations = utils.LRUCache(size=10000)
+
 
 def __init__():
     modules.register('resources', execute, description=description(), heartbeat=heartbeat)
@@ -186,7 +196,7 @@ def execute(*args, **kw):
             filepath = new_filepath
 
     # parse full message
-    message = Parser().parse(open(filepath, 'r'))
+    message = modules.message_from_spool(filepath)
 
     # invalid message, skip
     if not message.get('X-Kolab-To'):
@@ -653,18 +663,16 @@ def expunge_resource_calendar(mailbox):
 
     imap.imap.m.select(targetfolder)
 
-    typ, data = imap.imap.m.search(None, 'UNDELETED')
+    typ, data = imap.imap.m.uid('SEARCH', None, 'UNDELETED')
 
-    for num in data[0].split():
+    for num, data in imap.fetch_messages(data[0].split()):
         log.debug(
-            _("Fetching message ID %r from folder %r") % (num, mailbox),
+            _("Fetched message UID %r from folder %r") % (num, mailbox),
             level=8
         )
 
-        typ, data = imap.imap.m.fetch(num, '(RFC822)')
-
         try:
-            event = event_from_message(message_from_string(data[0][1]))
+            event = event_from_message(message_from_string(data))
         # pylint: disable=broad-except
         except Exception as errmsg:
             log.error(_("Failed to parse event from message %s/%s: %r") % (mailbox, num, errmsg))
@@ -693,7 +701,7 @@ def expunge_resource_calendar(mailbox):
                     level=8
                 )
 
-                imap.imap.m.store(num, '+FLAGS', '\\Deleted')
+                imap.imap.m.uid('STORE', num, '+FLAGS', '\\Deleted')
 
     imap.imap.m.expunge()
 
@@ -874,10 +882,37 @@ def check_availability(itip_events, resource_dns, resources, receiving_attendee=
     return (available_resource, itip_event)
 
 
+def fetch_resource_events(mailbox, uids):
+    """
+        Fetch and parse the events in the messages with the given UIDs in the
+        selected folder. Returns a dictionary of UID to event, or None for
+        messages that do not parse.
+    """
+    events = {}
+
+    for msguid, data in imap.fetch_messages(uids):
+        log.debug(
+            _("Fetched message UID %r from folder %r") % (msguid, mailbox),
+            level=8
+        )
+
+        try:
+            events[msguid] = event_from_message(message_from_string(data))
+        # pylint: disable=broad-except
+        except Exception as e:
+            log.error(_("Failed to parse event from message %s/%s: %r") % (mailbox, msguid, e))
+            events[msguid] = None
+
+    return events
+
+
 def read_resource_calendar(resource_rec, itip_events):
     """
-        Read all booked events from the given resource's calendar
-        and check for conflicts with the given list if itip events
+        Read the booked events from the given resource's calendar that may
+        conflict with the given list of itip events, and check for conflicts.
+
+        The calendar index of the folder decides which of the events need to
+        be read, and is brought up to date with the messages added since.
     """
     global imap
 
@@ -897,36 +932,61 @@ def read_resource_calendar(resource_rec, itip_events):
 
     # might raise an exception, let that bubble
     imap.imap.m.select(imap.folder_quote(mailbox))
-    typ, data = imap.imap.m.search(None, 'UNDELETED')
+    typ, data = imap.imap.m.response('UIDVALIDITY')
+    uidvalidity = data[-1]
 
-    num_messages = len(data[0].split())
+    typ, data = imap.imap.m.uid('SEARCH', None, 'UNDELETED')
+    uids = data[0].split()
 
-    for num in data[0].split():
-        # For efficiency, makes the routine non-deterministic
-        if resource_rec['conflict']:
-            continue
+    num_messages = len(uids)
 
-        log.debug(
-            _("Fetching message UID %r from folder %r") % (num, mailbox),
-            level=8
-        )
+    if mailbox not in calendar_indexes:
+        calendar_indexes[mailbox] = calendar_index.CalendarIndex(mailbox)
 
-        typ, data = imap.imap.m.fetch(num, '(UID RFC822)')
+    index = calendar_indexes[mailbox]
 
-        try:
-            msguid = re.search(r"\WUID (\d+)", data[0][0]).group(1)
-        # pylint: disable=broad-except
-        except Exception:
-            log.error(_("No UID found in IMAP response: %r") % (data[0][0]))
-            continue
+    # The events fetched for the index, so they need not be fetched again.
+    events = {}
 
-        try:
-            event = event_from_message(message_from_string(data[0][1]))
-        # pylint: disable=broad-except
-        except Exception as e:
-            log.error(_("Failed to parse event from message %s/%s: %r") % (mailbox, num, e))
+    def fetch(new_uids):
+        entries = {}
+
+        for msguid, event in fetch_resource_events(mailbox, new_uids).items():
+            events[msguid] = event
+
+            if event is None:
+                entries[msguid] = {'uid': None, 'start': None, 'end': None}
+                continue
+
+            (start, end) = event_span(event)
+            entries[msguid] = {'uid': event.get_uid(), 'start': start, 'end': end}
+
+        return entries
+
+    index.update(uidvalidity, uids, fetch)
+
+    candidates = set()
+
+    for itip in itip_events:
+        (start, end) = event_span(itip['xml'])
+        candidates.update(index.candidates(itip['uid'], start, end))
+
+    candidates = sorted(candidates, key=int)
+
+    log.debug(
+        _("Checking %d of %d events in %r for conflicts") % (len(candidates), num_messages, mailbox),
+        level=8
+    )
+
+    events.update(fetch_resource_events(mailbox, [x for x in candidates if x not in events]))
+
+    for msguid in candidates:
+        # For efficiency, makes the routine non-deterministic
+        if resource_rec['conflict']:
             continue
 
+        event = events.get(msguid)
+
         if event:
             for itip in itip_events:
                 conflict = check_event_conflict(event, itip)
@@ -966,63 +1026,83 @@ def find_existing_event(uid, recurrence_id, resource_rec):
 
     try:
         imap.imap.m.select(imap.folder_quote(mailbox))
-        typ, data = imap.imap.m.search(None, '(UNDELETED HEADER SUBJECT "%s")' % (uid))
     # pylint: disable=broad-except
     except Exception as errmsg:
         log.error(_("Failed to access resource calendar:: %r") % (errmsg))
         return event
 
-    for num in reversed(data[0].split()):
-        typ, data = imap.imap.m.fetch(num, '(UID RFC822)')
+    for msguids in find_event_messages(mailbox, uid):
+        for msguid, data in imap.fetch_messages(msguids):
+            try:
+                event = event_from_message(message_from_string(data))
+
+                # find instance in a recurring series
+                if recurrence_id and (event.is_recurring() or event.has_exceptions()):
+                    master = event
+                    event = master.get_instance(recurrence_id)
+                    setattr(master, '_msguid', msguid)
+
+                    # return master, even if instance is not found
+                    if not event and master.uid == uid:
+                        object_locations.set((mailbox, uid), msguid)
+                        return (event, master)
+
+                # compare recurrence-id and skip to next message if not matching
+                elif recurrence_id:
+                    if not xmlutils.dates_equal(recurrence_id, event.get_recurrence_id()):
+                        log.debug(
+                            _("Recurrence-ID not matching on message %s, skipping: %r != %r") % (
+                                msguid,
+                                recurrence_id,
+                                event.get_recurrence_id()
+                            ),
+                            level=8
+                        )
 
-        try:
-            msguid = re.search(r"\WUID (\d+)", data[0][0]).group(1)
-        # pylint: disable=broad-except
-        except Exception:
-            log.error(_("No UID found in IMAP response: %r") % (data[0][0]))
-            continue
+                        continue
 
-        try:
-            event = event_from_message(message_from_string(data[0][1]))
+                if event is not None:
+                    setattr(event, '_msguid', msguid)
 
-            # find instance in a recurring series
-            if recurrence_id and (event.is_recurring() or event.has_exceptions()):
-                master = event
-                event = master.get_instance(recurrence_id)
-                setattr(master, '_msguid', msguid)
+            # pylint: disable=broad-except
+            except Exception as errmsg:
+                log.error(_("Failed to parse event from message %s/%s: %r") % (mailbox, msguid, errmsg))
+                event = None
+                master = None
+                continue
 
-                # return master, even if instance is not found
-                if not event and master.uid == uid:
-                    return (event, master)
+            if event and event.uid == uid:
+                object_locations.set((mailbox, uid), msguid)
+                return (event, master)
 
-            # compare recurrence-id and skip to next message if not matching
-            elif recurrence_id:
-                if not xmlutils.dates_equal(recurrence_id, event.get_recurrence_id()):
-                    log.debug(
-                        _("Recurrence-ID not matching on message %s, skipping: %r != %r") % (
-                            msguid,
-                            recurrence_id,
-                            event.get_recurrence_id()
-                        ),
-                        level=8
-                    )
+    return (event, master)
 
-                    continue
 
-            if event is not None:
-                setattr(event, '_msguid', msguid)
+def find_event_messages(mailbox, uid):
+    """
+        Yield lists of the UIDs of the messages in the selected resource
+        calendar that may hold the event, the message it has last been seen
+        in first.
+    """
+    msguid = object_locations.get((mailbox, uid))
 
-        # pylint: disable=broad-except
-        except Exception as errmsg:
-            log.error(_("Failed to parse event from message %s/%s: %r") % (mailbox, num, errmsg))
-            event = None
-            master = None
-            continue
+    # The message may have been replaced by a client, and be about to be
+    # expunged.
+    if msguid is not None and imap.message_deleted(msguid):
+        object_locations.delete((mailbox, uid))
+        msguid = None
 
-        if event and event.uid == uid:
-            return (event, master)
+    if msguid is not None:
+        yield [msguid]
 
-    return (event, master)
+    try:
+        typ, data = imap.imap.m.uid('SEARCH', None, '(UNDELETED HEADER SUBJECT "%s")' % (uid))
+    # pylint: disable=broad-except
+    except Exception as errmsg:
+        log.error(_("Failed to access resource calendar:: %r") % (errmsg))
+        return
+
+    yield list(reversed(data[0].split()))
 
 
 def accept_reservation_request(
@@ -1152,6 +1232,11 @@ def save_resource_event(itip_event, resource):
             save_event.to_message(creator="Kolab Server <wallace@localhost>").as_string()
         )
 
+        msguid = parse_appenduid(result[1])
+
+        if msguid is not None:
+            object_locations.set((resource['kolabtargetfolder'], save_event.uid), msguid)
+
         return result
 
     # pylint: disable=broad-except
@@ -1196,6 +1281,13 @@ def delete_resource_event(uid, resource, msguid=None):
                 imap.imap.m.store(num, '+FLAGS', '\\Deleted')
 
         imap.imap.m.expunge()
+
+        # forget about the message, unless the event has been stored anew
+        location_key = (resource['kolabtargetfolder'], uid)
+
+        if msguid is None or object_locations.get(location_key) == msguid:
+            object_locations.delete(location_key)
+
         return True
 
     # pylint: disable=broad-except
@@ -1671,7 +1763,7 @@ def send_owner_notification(resource, owner, itip_event, success=True):
         log.debug(_("Set alarm to %s seconds") % (alarm_after), level=8)
         signal.alarm(alarm_after)
 
-        result = modules._sendmail(resource['mail'], owner['mail'], msg.as_string())
+        result = modules._sendmail_or_defer(resource['mail'], owner['mail'], msg.as_string())
         log.debug(_("Owner notification was sent successfully: %r") % result, level=8)
         signal.alarm(0)
 
@@ -20,10 +20,8 @@
 import json
 import os
 import re
-import tempfile
 
 from email.encoders import encode_quopri
-from email.parser import Parser
 from email.utils import getaddresses
 
 import modules
@@ -113,7 +111,7 @@ def execute(*args, **kw):  # noqa: C901
     filepath = new_filepath
 
     # parse message
-    message = Parser().parse(open(filepath, 'r'))
+    message = modules.message_from_spool(filepath)
 
     sender_address = [
         address for displayname, address in getaddresses(message.get_all('X-Kolab-From'))
@@ -246,9 +244,7 @@ def execute(*args, **kw):  # noqa: C901
         log.debug("Signature attached.", level=8)
         message.add_header("X-Wallace-Signature", "YES")
 
-    (fp, new_filepath) = tempfile.mkstemp(dir="/var/spool/pykolab/wallace/signature/ACCEPT")
-    os.write(fp, message.as_string())
-    os.close(fp)
-    os.unlink(filepath)
-
-    exec('modules.cb_action_%s(%r, %r)' % ('ACCEPT','signature', new_filepath))
+        # The message is written out only if it can not be re-injected.
+        modules.cb_action_ACCEPT('signature', filepath, message=message)
+    else:
+        exec('modules.cb_action_%s(%r, %r)' % ('ACCEPT', 'signature', filepath))
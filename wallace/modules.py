@@ -19,8 +19,12 @@
 
 from __future__ import print_function
 
+import atexit
+import copy
 import os
+import socket
 import sys
+import tempfile
 import time
 
 from email import message_from_string
@@ -50,6 +54,16 @@ conf = pykolab.getConf()
 
 modules = {}
 
+# Messages parsed from the spool, by file name, so that the modules handling
+# a message in turn do not each need to parse it again.
+parsed_messages = {}
+
+# The connection to the re-injection smtpd, kept open between messages.
+smtp_connection = None
+
+# Where messages go that could not be re-injected.
+defer_path = '/var/spool/pykolab/wallace/DEFER/'
+
 
 def initialize():
     # We only want the base path
@@ -132,6 +146,47 @@ def execute(name, *args, **kw):
     except Exception as errmsg:
         log.exception(_("Module %r - Unknown error occurred; %r") % (name, errmsg))
 
+def _spool_signature(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+def message_from_spool(filepath, headersonly=False):
+    """
+        Return the message in the spool file, parsed only if it has not been
+        parsed before, or the file has been written to since.
+
+        Renaming a spool file to another stage keeps the parsed message.
+    """
+    key = os.path.basename(filepath)
+    signature = _spool_signature(filepath)
+
+    if key in parsed_messages:
+        (_signature, _headersonly, message) = parsed_messages[key]
+
+        if _signature == signature and (headersonly or not _headersonly):
+            return message
+
+    with open(filepath, 'r') as f:
+        message = Parser().parse(f, headersonly)
+
+    parsed_messages[key] = (signature, headersonly, message)
+
+    return message
+
+def write_message(filepath, message):
+    """
+        Write out a message to the spool, replacing filepath.
+    """
+    (fp, new_filepath) = tempfile.mkstemp(dir=os.path.dirname(filepath))
+    os.write(fp, message.as_string())
+    os.close(fp)
+    os.rename(new_filepath, filepath)
+
+    parsed_messages[os.path.basename(filepath)] = (_spool_signature(filepath), False, message)
+
+def release_messages():
+    parsed_messages.clear()
+
 def heartbeat(name, *args, **kw):
     if name not in modules:
         log.warning(_("No such module %r in modules %r (1).") % (name, modules))
@@ -139,9 +194,22 @@ def heartbeat(name, *args, **kw):
     if 'heartbeat' in modules[name]:
         return modules[name]['heartbeat'](*args, **kw)
 
-def _sendmail(sender, recipients, msg):
-    # NOTE: Use "127.0.0.1" here for IPv6 (see also the service
-    # definition in master.cf).
+def _smtp_connection():
+    """
+        Return the connection to the re-injection smtpd of this process,
+        connecting if there is none yet, or if it has been dropped.
+    """
+    global smtp_connection
+
+    if smtp_connection is not None:
+        try:
+            # Start a new transaction on the existing connection.
+            smtp_connection.rset()
+            return smtp_connection
+
+        except (smtplib.SMTPException, socket.error) as errmsg:
+            log.debug(_("SMTP connection lost, reconnecting: %r") % (errmsg), level=8)
+            _smtp_close()
 
     sl = pykolab.logger.StderrToLogger(log)
     smtplib.stderr = sl
@@ -151,13 +219,47 @@ def _sendmail(sender, recipients, msg):
     if conf.debuglevel > 8:
         smtp.set_debuglevel(1)
 
+    # NOTE: Use "127.0.0.1" here for IPv6 (see also the service
+    # definition in master.cf).
+    smtp.connect("127.0.0.1", 10027)
+
+    smtp_connection = smtp
+
+    return smtp
+
+def _smtp_close():
+    global smtp_connection
+
+    if smtp_connection is None:
+        return
+
+    try:
+        smtp_connection.quit()
+    except Exception:
+        smtp_connection.close()
+
+    smtp_connection = None
+
+atexit.register(_smtp_close)
+
+def _sendmail(sender, recipients, msg):
+    """
+        Send a message through the re-injection smtpd, over the connection
+        this process keeps to it.
+
+        Nothing is retried here, other than a connection that turns out to
+        have been dropped; the caller decides what to do with a message that
+        could not be sent.
+    """
     success = False
     attempt = 1
 
-    while not success and attempt <= 5:
+    while not success and attempt <= 2:
+        reconnected = smtp_connection is None
+
         try:
             log.debug(_("Sending email via smtplib from %r, to %r (Attempt %r)") % (sender, recipients, attempt), level=8)
-            smtp.connect("127.0.0.1", 10027)
+            smtp = _smtp_connection()
             _response = smtp.sendmail(sender, recipients, msg)
 
             if len(_response) == 0:
@@ -165,8 +267,6 @@ def _sendmail(sender, recipients, msg):
             else:
                 log.debug(_("SMTP sendmail returned: %r") % (_response), level=8)
 
-            smtp.quit()
-
             success = True
             break
 
@@ -196,16 +296,42 @@ def _sendmail(sender, recipients, msg):
         except Exception as errmsg:
             log.exception(_("smtplib - Unknown error occurred: %r") % (errmsg))
 
-        try:
-            smtp.quit()
-        except Exception as errmsg:
-            log.error("smtplib quit() error - %r" % errmsg)
+        _smtp_close()
+
+        # Only a connection that had been used before gets another try.
+        if reconnected:
+            break
 
-        time.sleep(10)
         attempt += 1
 
     return success
 
+def _sendmail_or_defer(sender, recipients, msg):
+    """
+        Send a message a module has composed itself, such as a notification,
+        or put it in the DEFER queue to be re-injected later if it could not
+        be sent.
+    """
+    if _sendmail(sender, recipients, msg):
+        return True
+
+    if isinstance(recipients, basestring):
+        recipients = [recipients]
+
+    if not os.path.isdir(defer_path):
+        os.makedirs(defer_path)
+
+    # The same envelope headers as a message received by wallace has.
+    (fp, filepath) = tempfile.mkstemp(dir=defer_path)
+    os.write(fp, "X-Kolab-From: %s\r\n" % (sender))
+    os.write(fp, "X-Kolab-To: %s\r\n" % (', '.join(recipients)))
+    os.write(fp, msg)
+    os.close(fp)
+
+    log.info(_("Deferring re-injection of message %s") % (filepath))
+
+    return False
+
 def cb_action_HOLD(module, filepath):
     global extra_log_params
 
@@ -221,7 +347,7 @@ def cb_action_DEFER(module, filepath):
     log.info(_("Deferring message in %s (by module %s)") % (filepath, module))
 
     # parse message headers
-    message = Parser().parse(open(filepath, 'r'), True)
+    message = message_from_spool(filepath, True)
 
     internal_time = parsedate_tz(message.__getitem__('Date'))
     internal_time = time.mktime(internal_time[:9]) + internal_time[9]
@@ -270,7 +396,7 @@ def cb_action_REJECT(module, filepath):
     log.debug(_("Rejecting message in: %r") %(filepath), level=8)
 
     # parse message headers
-    message = Parser().parse(open(filepath, 'r'), True)
+    message = copy.copy(message_from_spool(filepath, True))
 
     envelope_sender = getaddresses(message.get_all('From', []))
 
@@ -337,20 +463,25 @@ X-Wallace-Result: REJECT
     part.add_header("Content-Description", "Undelivered Message")
     msg.attach(part)
 
-    result = _sendmail(
+    # A rejection message that could not be sent is re-injected from the
+    # DEFER queue, so the rejected message need not be kept around for it.
+    result = _sendmail_or_defer(
             "MAILER-DAEMON@%s" % (constants.fqdn),
             [formataddr(envelope_sender[0])],
             msg.as_string()
         )
 
     log.debug(_("Rejection message was sent successfully: %r") % result)
-    if result:
-        os.unlink(filepath)
-    else:
-        log.debug(_("Message %r was not removed from spool") % filepath)
+    os.unlink(filepath)
+    parsed_messages.pop(os.path.basename(filepath), None)
 
 
-def cb_action_ACCEPT(module, filepath):
+def cb_action_ACCEPT(module, filepath, message=None):
+    """
+        Re-inject the message in filepath. A module that has modified the
+        message passes it along, and it is only written out to the DEFER
+        queue if it could not be re-injected.
+    """
     global extra_log_params
 
     extra_log_params['qid'] = os.path.basename(filepath)
@@ -359,19 +490,25 @@ def cb_action_ACCEPT(module, filepath):
 
     log.debug(_("Accepting message in: %r") %(filepath), level=8)
 
-    # parse message headers
-    message = Parser().parse(open(filepath, 'r'), True)
+    if message is None:
+        # parse message headers
+        _message = message_from_spool(filepath, True)
+    else:
+        _message = message
 
-    messageid = message['message-id'] if 'message-id' in message else None
-    sender = [formataddr(x) for x in getaddresses(message.get_all('X-Kolab-From', []))]
-    recipients = [formataddr(x) for x in getaddresses(message.get_all('X-Kolab-To', []))]
+    # Leave the message itself intact, should it need to be written out.
+    _message = copy.copy(_message)
+
+    messageid = _message['message-id'] if 'message-id' in _message else None
+    sender = [formataddr(x) for x in getaddresses(_message.get_all('X-Kolab-From', []))]
+    recipients = [formataddr(x) for x in getaddresses(_message.get_all('X-Kolab-To', []))]
     log.debug(
         _("Message-ID: %s, sender: %r, recipients: %r") % (messageid, sender, recipients), level=6
     )
 
     # delete X-Kolab-* headers
-    del message['X-Kolab-From']
-    del message['X-Kolab-To']
+    del _message['X-Kolab-From']
+    del _message['X-Kolab-To']
     log.debug(_("Removed X-Kolab- headers"), level=8)
 
     result = _sendmail(
@@ -383,14 +520,57 @@ def cb_action_ACCEPT(module, filepath):
             # - Third, a character return is inserted somewhere. It
             #   divides the body from the headers - and we don't like (TODO)
             # @TODO: check if we need Parser().parse() to load the whole message
-            message.as_string()
+            _message.as_string()
         )
 
     log.debug(_("Message was sent successfully: %r") % result)
     if result:
         os.unlink(filepath)
+        parsed_messages.pop(os.path.basename(filepath), None)
+
     else:
-        log.debug(_("Message %r was not removed from spool") % filepath)
+        defer_reinjection(filepath, message)
+
+def defer_reinjection(filepath, message=None):
+    """
+        Move a message that could not be re-injected to the DEFER queue, from
+        which the spool watcher retries it with a backoff.
+
+        A message modified by a module is written out to the queue, rather
+        than moved there.
+    """
+    new_filepath = os.path.join(defer_path, os.path.basename(filepath))
+
+    if not os.path.isdir(defer_path):
+        os.makedirs(defer_path)
+
+    if message is not None:
+        write_message(new_filepath, message)
+
+        if not new_filepath == filepath:
+            os.unlink(filepath)
+
+    elif not new_filepath == filepath:
+        os.rename(filepath, new_filepath)
+
+    log.info(_("Deferring re-injection of message %s") % (new_filepath))
+
+def reinject_deferred(filepath):
+    """
+        Retry the re-injection of a message in the DEFER queue, or drop it if
+        it has been there for too long.
+    """
+    global extra_log_params
+
+    extra_log_params['qid'] = os.path.basename(filepath)
+
+    if os.stat(filepath).st_mtime + 432000 < time.time():
+        # TODO: Send NDR back to user
+        log.error(_("Message in file %s could not be re-injected for 5 days, deleting") % (filepath))
+        os.unlink(filepath)
+        return
+
+    cb_action_ACCEPT('wallace', filepath)
 
 def register_group(dirname, module):
     modules_base_path = os.path.join(os.path.dirname(__file__), module)
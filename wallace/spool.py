@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010-2019 Kolab Systems AG (http://www.kolabsys.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    Keep track of the messages in the Wallace spool.
+
+    The spool is scanned once at startup, after which an index of the
+    messages by module and stage, and the time each is due to be picked up,
+    is maintained from inotify events. Without pyinotify, the spool is
+    rescanned periodically instead.
+"""
+
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import pykolab
+
+from pykolab.translate import _ as _l
+
+# pylint: disable=invalid-name
+log = pykolab.getLogger('pykolab.wallace/spool')
+conf = pykolab.getConf()
+
+# Mind you to include the trailing slash
+pickup_path = '/var/spool/pykolab/wallace/'
+
+# How long a message is left alone after it has been written, because it is
+# likely still being handled.
+grace = 150
+
+# How long to wait before picking up a message again that is still in the
+# same place after it had been picked up.
+retry_interval = 180
+
+# How long to wait before retrying the re-injection of a deferred message,
+# doubling with every attempt up to the maximum.
+defer_interval = 60
+defer_max_interval = 3600
+
+# How often to rescan the spool when inotify is not available.
+poll_interval = 180
+
+# How often, at most, to write out the index.
+dump_interval = 5
+
+
+def parse_path(filepath):
+    """
+        Return the (module, stage) a message in the spool is in, with both
+        None for messages not (yet) handled by any module, and a module of
+        'DEFER' for messages that could not be re-injected. Return None if the
+        file is not a message that is to be picked up.
+    """
+    if not filepath.startswith(pickup_path):
+        return None
+
+    parts = filepath[len(pickup_path):].split('/')
+
+    if len(parts) == 1:
+        return (None, None)
+
+    if len(parts) == 2 and parts[0] == 'DEFER':
+        return ('DEFER', None)
+
+    if len(parts) == 3:
+        # Lock files are not messages.
+        if parts[1] == 'locks':
+            return None
+
+        return (parts[0], parts[1])
+
+    return None
+
+
+def backoff(attempts):
+    return min(defer_interval * 2 ** attempts, defer_max_interval)
+
+
+def held(module, stage):
+    """
+        Messages deferred or held for review by a module are not picked up
+        from the spool.
+    """
+    if stage is not None and stage.lower() in ["defer", "hold"]:
+        return True
+
+    return False
+
+
+class SpoolIndex(object):
+    """
+        The messages in the spool, with the module and stage they are in and
+        the time they are due to be picked up.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.schedule = []
+        self.lock = threading.Lock()
+        self.changed = False
+
+    def __contains__(self, filepath):
+        return filepath in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, filepath, mtime=None):
+        """
+            Add or update the entry for a message, to become due a grace
+            period after it has last been written, or after the backoff for
+            a message that could not be re-injected.
+        """
+        location = parse_path(filepath)
+
+        if location is None:
+            return
+
+        (module, stage) = location
+
+        if mtime is None:
+            mtime = time.time()
+
+        with self.lock:
+            if filepath in self.entries:
+                attempts = self.entries[filepath]['attempts']
+            else:
+                attempts = 0
+
+            if held(module, stage):
+                due = None
+            elif module == 'DEFER':
+                due = mtime + backoff(attempts)
+            else:
+                due = mtime + grace
+
+            self.entries[filepath] = {
+                'module': module,
+                'stage': stage,
+                'due': due,
+                'attempts': attempts
+            }
+
+            if due is not None:
+                heapq.heappush(self.schedule, (due, filepath))
+
+            self.changed = True
+
+    def remove(self, filepath):
+        with self.lock:
+            if self.entries.pop(filepath, None) is not None:
+                self.changed = True
+
+    def remove_tree(self, path):
+        """
+            Remove the entries for all messages below a directory.
+        """
+        path = path.rstrip('/') + '/'
+
+        with self.lock:
+            for filepath in [x for x in self.entries if x.startswith(path)]:
+                del self.entries[filepath]
+                self.changed = True
+
+    def reschedule(self, filepath, now=None):
+        """
+            Schedule a message that is still in place after it has been
+            picked up to be picked up again.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            if filepath not in self.entries:
+                return
+
+            entry = self.entries[filepath]
+
+            if entry['module'] == 'DEFER':
+                entry['attempts'] += 1
+                due = now + backoff(entry['attempts'])
+            else:
+                due = now + retry_interval
+
+            entry['due'] = due
+            heapq.heappush(self.schedule, (due, filepath))
+            self.changed = True
+
+    def next_due(self):
+        """
+            Return the time the next message is due, or None.
+        """
+        with self.lock:
+            self._discard_stale()
+
+            if self.schedule:
+                return self.schedule[0][0]
+
+        return None
+
+    def pop_due(self, now=None):
+        """
+            Return the (filepath, module, stage) of the messages that are due,
+            and take them off the schedule.
+        """
+        if now is None:
+            now = time.time()
+
+        result = []
+
+        with self.lock:
+            self._discard_stale()
+
+            while self.schedule and self.schedule[0][0] <= now:
+                (_, filepath) = heapq.heappop(self.schedule)
+                entry = self.entries[filepath]
+                entry['due'] = None
+                result.append((filepath, entry['module'], entry['stage']))
+                self._discard_stale()
+
+            if result:
+                self.changed = True
+
+        return result
+
+    def dump(self):
+        """
+            Return the index as a list of dictionaries, sorted by module,
+            stage and due time.
+        """
+        with self.lock:
+            result = [
+                {
+                    'path': filepath,
+                    'module': entry['module'],
+                    'stage': entry['stage'],
+                    'due': entry['due'],
+                    'attempts': entry['attempts']
+                } for filepath, entry in self.entries.items()
+            ]
+
+            self.changed = False
+
+        return sorted(
+            result,
+            key=lambda x: (x['module'] or '', x['stage'] or '', x['due'] or 0, x['path'])
+        )
+
+    def _discard_stale(self):
+        # Entries in the schedule that have since been removed or rescheduled
+        # are discarded lazily, rather than searched for in the heap.
+        while self.schedule:
+            (due, filepath) = self.schedule[0]
+
+            entry = self.entries.get(filepath)
+
+            if entry is not None and entry['due'] == due:
+                break
+
+            heapq.heappop(self.schedule)
+
+
+class SpoolWatcher(threading.Thread):
+    """
+        Maintain the index of the spool, and call back for each message as it
+        becomes due.
+    """
+
+    def __init__(self, callback, index_file=None):
+        threading.Thread.__init__(self, name='Wallace_Spool')
+        self.callback = callback
+        self.index = SpoolIndex()
+        self.index_file = index_file
+        self.finished = threading.Event()
+        self.last_dump = 0
+
+    def run(self):
+        if pyinotify is None:
+            log.debug(_l("Module pyinotify not available, polling the spool"), level=8)
+            self.run_polling()
+        else:
+            self.run_inotify()
+
+        self.write_index(force=True)
+
+    def run_polling(self):
+        self.scan()
+        last_scan = time.time()
+
+        while not self.finished.is_set():
+            self.fire()
+
+            if time.time() >= last_scan + poll_interval:
+                self.scan()
+                last_scan = time.time()
+
+            self.finished.wait(self.timeout(last_scan + poll_interval))
+
+    def run_inotify(self):
+        watch_manager = pyinotify.WatchManager()
+
+        notifier = pyinotify.Notifier(watch_manager, SpoolEventHandler(watcher=self))
+
+        watch_manager.add_watch(
+            pickup_path,
+            pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+            pyinotify.IN_DELETE | pyinotify.IN_DELETE_SELF | pyinotify.IN_CREATE,
+            rec=True,
+            auto_add=True
+        )
+
+        # Only scan once the watch is in place, so that no message written
+        # in between goes unnoticed. Directories created before the watch
+        # was added are not scanned by pyinotify either.
+        self.scan()
+
+        try:
+            while not self.finished.is_set():
+                self.fire()
+
+                if notifier.check_events(timeout=int(self.timeout() * 1000)):
+                    notifier.read_events()
+                    notifier.process_events()
+
+        finally:
+            notifier.stop()
+
+    def timeout(self, deadline=None):
+        """
+            The number of seconds to wait for events until the next message
+            is due, or the deadline passes.
+        """
+        due = self.index.next_due()
+
+        if deadline is None:
+            deadline = time.time() + poll_interval
+
+        if due is not None:
+            deadline = min(deadline, due)
+
+        if self.index_file is not None and self.index.changed:
+            deadline = min(deadline, self.last_dump + dump_interval)
+
+        return min(max(deadline - time.time(), 0.1), poll_interval)
+
+    def scan(self):
+        """
+            Bring the index in line with the contents of the spool.
+        """
+        found = set()
+
+        for root, _, files in os.walk(pickup_path):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                found.add(filepath)
+
+                if filepath in self.index:
+                    continue
+
+                try:
+                    self.index.add(filepath, mtime=os.stat(filepath).st_mtime)
+                except OSError:
+                    continue
+
+        for filepath in [x for x in self.index.entries if x not in found]:
+            self.index.remove(filepath)
+
+        log.debug(_l("Spool index holds %d message(s)") % (len(self.index)), level=8)
+
+    def fire(self):
+        """
+            Pick up the messages that are due, and reschedule those that are
+            still in the same place afterwards.
+        """
+        for filepath, module, stage in self.index.pop_due():
+            if self.finished.is_set():
+                break
+
+            if not os.path.isfile(filepath):
+                self.index.remove(filepath)
+                continue
+
+            log.debug(_l("Picking up spooled message %s") % (filepath), level=8)
+
+            try:
+                self.callback(filepath, module, stage)
+
+            # pylint: disable=broad-except
+            except Exception:
+                log.error(
+                    _l("Error picking up message %s: %s") % (
+                        filepath,
+                        traceback.format_exc()
+                    )
+                )
+
+            if os.path.isfile(filepath):
+                self.index.reschedule(filepath)
+            else:
+                self.index.remove(filepath)
+
+        self.write_index()
+
+    def write_index(self, force=False):
+        """
+            Write out the index for 'kolab list-wallace-spool'.
+        """
+        if self.index_file is None:
+            return
+
+        if not force:
+            if not self.index.changed or time.time() < self.last_dump + dump_interval:
+                return
+
+        self.last_dump = time.time()
+
+        try:
+            (fp, filename) = tempfile.mkstemp(dir=os.path.dirname(self.index_file))
+            os.write(fp, json.dumps(self.index.dump()))
+            os.close(fp)
+            os.chmod(filename, 0o644)
+            os.rename(filename, self.index_file)
+
+        except (IOError, OSError) as errmsg:
+            log.error(_l("Could not write spool index %s: %s") % (self.index_file, errmsg))
+
+
+def read_index(index_file):
+    """
+        Read an index as written out by the SpoolWatcher.
+    """
+    with open(index_file, 'r') as f:
+        return json.loads(f.read())
+
+
+if pyinotify is not None:
+    class SpoolEventHandler(pyinotify.ProcessEvent):
+        # pylint: disable=arguments-differ
+        def my_init(self, watcher=None):
+            self.watcher = watcher
+
+        def process_IN_CLOSE_WRITE(self, event):
+            if not event.dir:
+                self.watcher.index.add(event.pathname)
+
+        def process_IN_MOVED_TO(self, event):
+            if event.dir:
+                self.watcher.scan()
+            else:
+                self.watcher.index.add(event.pathname)
+
+        def process_IN_MOVED_FROM(self, event):
+            if event.dir:
+                self.watcher.index.remove_tree(event.pathname)
+            else:
+                self.watcher.index.remove(event.pathname)
+
+        def process_IN_DELETE(self, event):
+            if not event.dir:
+                self.watcher.index.remove(event.pathname)
+
+        def process_IN_Q_OVERFLOW(self, event):
+            log.warning(_l("Spool events have been lost, rescanning the spool"))
+            self.watcher.scan()